@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor # Enable running work away from the UI thread
+from kivy.clock import Clock # Enable passing results back to the UI thread
+
+class BackgroundTasks:
+    def __init__(self, max_workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # {key: future} of the latest task of each kind, e.g. "search" or "timetable"
+        self.latest_tasks = {}
+
+    # Run a function in the background. on_success is called with its result, or on_error with the
+    # exception it raised, on the UI thread. Starting a task cancels the previous task with the same key
+    def submit(self, key, function, args=(), on_success=None, on_error=None):
+        self.cancel(key)
+        future = self.executor.submit(function, *args)
+        self.latest_tasks[key] = future
+        future.add_done_callback(lambda done_future: Clock.schedule_once(lambda dt: self.finish(key, done_future, on_success, on_error)))
+        return future
+
+    # Called on the UI thread once a task has finished
+    def finish(self, key, future, on_success, on_error):
+        # Ignore tasks which were cancelled or replaced by a newer task
+        if self.latest_tasks.get(key) is not future:
+            return
+        del self.latest_tasks[key]
+
+        exception = future.exception()
+        if exception is not None:
+            if on_error is not None:
+                on_error(exception)
+        elif on_success is not None:
+            on_success(future.result())
+
+    # Stop a task; if it is already running its result is thrown away
+    def cancel(self, key):
+        future = self.latest_tasks.pop(key, None)
+        if future is not None:
+            future.cancel()
+
+    def is_running(self, key):
+        return key in self.latest_tasks
+
+    def shutdown(self):
+        self.latest_tasks.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,342 @@
+import argparse # Enable choosing the size of the benchmark from the command line
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+
+from bus_store import BusStore
+from dataset_store import DatasetStore
+from geocoding import NearbyStops
+from locate_zipfile import LocateBusFile
+from processing_timetable_data import ProcessData, StreamProcessData
+from stop_index import hash_stops_file, load_stop_index
+from timetable_cache import get_timetable_cache
+from timetable_index import TimetableIndex
+import requests
+
+try:
+    import resource # Enable measuring memory use, not available on Windows
+except ImportError:
+    resource = None
+
+# Measures how long the main lookups take and how much memory they use, on made up bus data of a chosen size,
+# so the effect of a change can be compared between versions:
+#   python benchmark.py --files 100 --journeys 300
+#   python benchmark.py --compare benchmark_results/<earlier run>.json
+# Nothing is downloaded: the bus stops, postcodes and bus files are all generated, and the internet is blocked
+
+# Stages which are measured, each in a new process so its memory use is measured on its own
+STAGES = ["postcode_lookup", "stop_search", "stop_timetable_files", "stop_timetable_index", "stop_timetable_cached",
+          "arrival_times", "arrival_times_stream"]
+
+# Area in which the made up bus stops are placed, within Surrey
+AREA_BBOX = (51.15, -0.75, 51.40, -0.05)
+AREA_SIZE = 0.02 # Width in degrees of each made up locality
+DESTINATIONS = ["Guildford", "Woking", "Epsom", "Redhill", "Camberley", "Staines", "Leatherhead", "Farnham"]
+
+# Generation of the made up data
+
+# Get (ATCO code, gazetteer ID, latitude, longitude) of every made up bus stop, area by area
+def generate_stops(area_count, stops_per_area, seed):
+    rng = random.Random(seed)
+    stops_by_area = []
+    for area in range(area_count):
+        # Each area is a small square somewhere in the county
+        area_lat = rng.uniform(AREA_BBOX[0], AREA_BBOX[2] - AREA_SIZE)
+        area_lon = rng.uniform(AREA_BBOX[1], AREA_BBOX[3] - AREA_SIZE)
+        stops_by_area.append([(f"4000BM{area:03d}{stop:04d}", f"E{area:07d}",
+                               area_lat + rng.random() * AREA_SIZE, area_lon + rng.random() * AREA_SIZE)
+                              for stop in range(stops_per_area)])
+    return stops_by_area
+
+# Write a NaPTAN file of the bus stops, in the same form as the one downloaded by RefreshBusStops
+def write_naptan_file(path, stops_by_area):
+    with open(path, "w", encoding="utf-8") as naptan_file:
+        naptan_file.write('<?xml version="1.0" encoding="UTF-8"?>\n<NaPTAN xmlns="http://www.naptan.org.uk/"><StopPoints>')
+        for stops in stops_by_area:
+            for atco_code, gazetteer_id, latitude, longitude in stops:
+                naptan_file.write(f'<StopPoint Status="active"><AtcoCode>{atco_code}</AtcoCode>'
+                                  f'<Descriptor><CommonName>Stop {atco_code[-7:]}</CommonName></Descriptor>'
+                                  f'<Place><NptgLocalityRef>{gazetteer_id}</NptgLocalityRef><Location><Translation>'
+                                  f'<Longitude>{longitude:.6f}</Longitude><Latitude>{latitude:.6f}</Latitude>'
+                                  f'</Translation></Location></Place></StopPoint>\n')
+        naptan_file.write('</StopPoints></NaPTAN>\n')
+
+# Made up postcode in the middle of an area, e.g. "BM4 2AA"
+def get_area_postcode(area):
+    return f"BM{area // 10 % 100} {area % 10}A{chr(ord('A') + area // 1000 % 26)}"
+
+# Write a postcode table, in the same form as the ONS Postcode Directory read by OfflinePostcodes
+def write_postcode_file(path, stops_by_area):
+    with open(path, "w", encoding="utf-8") as postcode_file:
+        postcode_file.write("pcds,lat,long,oscty\n")
+        for area, stops in enumerate(stops_by_area):
+            latitude = sum(stop[2] for stop in stops) / len(stops)
+            longitude = sum(stop[3] for stop in stops) / len(stops)
+            postcode_file.write(f"{get_area_postcode(area)},{latitude:.6f},{longitude:.6f},E10000030\n")
+
+# Make up a TransXChange file of one bus line, running along a route through the given stops
+def generate_transxchange(line, route, journey_count, rng):
+    # Journeys run one way along the route or the other, with a few stopping short
+    patterns = [route, list(reversed(route)), route[:max(2, len(route) // 2)]]
+    sections = []
+    journey_patterns = []
+    for pattern_number, pattern in enumerate(patterns):
+        links = []
+        for link_number in range(len(pattern) - 1):
+            run_time = rng.choice(["PT1M", "PT2M", "PT2M30S", "PT3M", "PT45S"])
+            wait_time = "<WaitTime>PT1M</WaitTime>" if rng.random() < 0.1 else ""
+            links.append(f'<JourneyPatternTimingLink id="L{pattern_number}_{link_number}">'
+                         f'<From><StopPointRef>{pattern[link_number]}</StopPointRef>{wait_time}</From>'
+                         f'<To><StopPointRef>{pattern[link_number + 1]}</StopPointRef></To>'
+                         f'<RunTime>{run_time}</RunTime></JourneyPatternTimingLink>')
+        sections.append(f'<JourneyPatternSection id="JPS{pattern_number}">{"".join(links)}</JourneyPatternSection>')
+        journey_patterns.append(f'<JourneyPattern id="JP{pattern_number}"><DestinationDisplay>{rng.choice(DESTINATIONS)}</DestinationDisplay>'
+                                f'<JourneyPatternSectionRefs>JPS{pattern_number}</JourneyPatternSectionRefs></JourneyPattern>')
+
+    vehicle_journeys = []
+    for journey in range(journey_count):
+        days = rng.choice(["<MondayToFriday/>", "<MondayToFriday/>", "<Saturday/>", "<Sunday/>"])
+        departure = rng.randrange(5 * 3600, 24 * 3600, 300)
+        vehicle_journeys.append(f'<VehicleJourney><OperatingProfile><RegularDayType><DaysOfWeek>{days}</DaysOfWeek></RegularDayType>'
+                                f'</OperatingProfile><VehicleJourneyCode>VJ{journey}</VehicleJourneyCode>'
+                                f'<JourneyPatternRef>JP{rng.randrange(len(patterns))}</JourneyPatternRef>'
+                                f'<DepartureTime>{departure // 3600:02d}:{departure // 60 % 60:02d}:00</DepartureTime></VehicleJourney>')
+
+    stop_points = "".join(f"<AnnotatedStopPointRef><StopPointRef>{atco_code}</StopPointRef><CommonName>Stop {atco_code[-7:]}</CommonName>"
+                          f"</AnnotatedStopPointRef>" for atco_code in route)
+    return (f'<?xml version="1.0" encoding="UTF-8"?>\n<TransXChange xmlns="http://www.transxchange.org.uk/">'
+            f'<StopPoints>{stop_points}</StopPoints><JourneyPatternSections>{"".join(sections)}</JourneyPatternSections>'
+            f'<Services><Service><ServiceCode>BM{line}</ServiceCode><Lines><Line id="BM{line}"><LineName>{line}</LineName></Line></Lines>'
+            f'<OperatingPeriod><StartDate>2020-01-01</StartDate></OperatingPeriod>'
+            f'<StandardService><Origin>A</Origin><Destination>B</Destination>{"".join(journey_patterns)}</StandardService>'
+            f'</Service></Services><VehicleJourneys>{"".join(vehicle_journeys)}</VehicleJourneys></TransXChange>\n')
+
+# Make up the bus data in the current folder: bus stops, postcodes, bus files, the dataset store and the
+# timetable index, as they would be after the app has downloaded everything. Returns details used by the stages
+def generate_world(area_count, stops_per_area, file_count, journey_count, route_length, seed):
+    rng = random.Random(seed)
+    stops_by_area = generate_stops(area_count, stops_per_area, seed)
+    write_naptan_file("400.xml", stops_by_area)
+    # Mark the NaPTAN file as just checked, so RefreshBusStops does not try to download it
+    with open("400_state.json", "w") as state_file:
+        json.dump({"hash": hash_stops_file("400.xml"), "checked_at": time.time()}, state_file)
+    write_postcode_file("postcodes.csv", stops_by_area)
+
+    bus_store = BusStore()
+    results = []
+    bus_files = []
+    served_stops = set()
+    for file_number in range(file_count):
+        # Each bus line runs through one to three neighbouring areas
+        first_area = rng.randrange(area_count)
+        areas = [(first_area + offset) % area_count for offset in range(rng.randint(1, min(3, area_count)))]
+        area_stops = [stop for area in areas for stop in stops_by_area[area]]
+        route = [stop[0] for stop in rng.sample(area_stops, min(route_length, len(area_stops)))]
+        served_stops.update(route)
+
+        line = str(file_number + 1)
+        result = {"id": 100000 + file_number, "operatorName": f"Bench Buses {file_number % 7}", "lines": [line],
+                  "extension": "xml", "modified": "2026-01-01T00:00:00+00:00", "url": "",
+                  "localities": [{"gazetteer_id": f"E{area:07d}"} for area in areas]}
+        filename = f'{result["operatorName"]}_{result["id"]}_{line}.xml'
+        with open(bus_store.get_download_path(filename), "w", encoding="utf-8") as bus_file:
+            bus_file.write(generate_transxchange(line, route, journey_count, rng))
+        bus_store.install(result["id"], filename, result["modified"], bus_store.get_download_path(filename))
+        results.append(result)
+        bus_files.append(bus_store.get_xml_files(filename)[0])
+
+    DatasetStore().replace_datasets(results)
+    TimetableIndex().build(results, bus_store)
+    return {"postcodes": [get_area_postcode(area) for area in range(area_count)], "served_stops": sorted(served_stops),
+            "bus_files": bus_files}
+
+# Running the stages
+
+# Stop any request going to the internet, so the benchmark only measures work done on this computer
+def block_network():
+    def refuse_request(*args, **kwargs):
+        raise requests.ConnectionError("The internet is not used while benchmarking")
+    requests.Session.request = refuse_request
+
+# Get the most memory the process has used so far, in MB
+def get_peak_rss_mb():
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Given in bytes on macOS and in kilobytes elsewhere
+    return round(peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+# Get the operations to time for a stage, as [(function run before it, untimed, or None, function to time)]
+def prepare_stage(stage, world, operation_count, rng):
+    postcodes = [rng.choice(world["postcodes"]) for _ in range(operation_count)]
+    if stage == "postcode_lookup":
+        return [(None, lambda postcode=postcode: NearbyStops(postcode)) for postcode in postcodes]
+    if stage == "stop_search":
+        searches = [NearbyStops(postcode) for postcode in postcodes]
+        return [(None, search.find_nearest_bus_stops) for search in searches]
+
+    stop_index = load_stop_index()
+    stops = [stop_index.find_stop(atco_code) for atco_code in rng.choices(world["served_stops"], k=operation_count)]
+    timetable_cache = get_timetable_cache()
+    if stage in ("stop_timetable_files", "stop_timetable_index"):
+        # Forget timetables between lookups, so each one is worked out again
+        return [(timetable_cache.clear, LocateBusFile(stop).get_bus_stop_timetable) for stop in stops]
+    if stage == "stop_timetable_cached":
+        for stop in stops:
+            LocateBusFile(stop).get_bus_stop_timetable()
+        return [(None, LocateBusFile(stop).get_bus_stop_timetable) for stop in stops]
+
+    # Read each bus file before timing, and look for a stop it serves
+    operations = []
+    for path in rng.choices(world["bus_files"], k=operation_count):
+        with open(path, "rb") as bus_file:
+            contents = bus_file.read()
+        atco_code = contents.split(b"<StopPointRef>", 2)[1].split(b"<", 1)[0].decode()
+        if stage == "arrival_times":
+            operations.append((None, lambda contents=contents, atco_code=atco_code:
+                               ProcessData(contents, atco_code).find_arrival_times_by_destination()))
+        else:
+            operations.append((None, lambda path=path, atco_code=atco_code:
+                               StreamProcessData(path, atco_code).find_arrival_times_by_destination()))
+    return operations
+
+# Run one stage in the folder of made up data, returning its measurements. Runs in its own process
+def run_stage(stage, work_dir, world, operation_count, seed):
+    os.chdir(work_dir)
+    os.environ["OFFLINE_POSTCODES"] = os.path.join(work_dir, "postcodes.csv")
+    block_network()
+
+    # Timetables are read straight from the bus files when there is no timetable index
+    hidden_index_path = "timetable_index.db.hidden"
+    if stage == "stop_timetable_files":
+        os.replace("timetable_index.db", hidden_index_path)
+    try:
+        start_rss_mb = get_peak_rss_mb()
+        operations = prepare_stage(stage, world, operation_count, random.Random(seed))
+        latencies = []
+        for before_operation, operation in operations:
+            if before_operation is not None:
+                before_operation()
+            start_time = time.perf_counter()
+            operation()
+            latencies.append(time.perf_counter() - start_time)
+    finally:
+        if os.path.exists(hidden_index_path):
+            os.replace(hidden_index_path, "timetable_index.db")
+    return summarise_latencies(latencies, start_rss_mb, get_peak_rss_mb())
+
+# Get the latency at a percentile of a sorted list of latencies (nearest rank)
+def get_percentile(sorted_latencies, percentile):
+    rank = max(1, -(-len(sorted_latencies) * percentile // 100))
+    return sorted_latencies[int(rank) - 1]
+
+def summarise_latencies(latencies, start_rss_mb, peak_rss_mb):
+    sorted_latencies = sorted(latencies)
+    total_seconds = sum(latencies)
+    return {"operations": len(latencies),
+            "first_ms": round(latencies[0] * 1000, 3),
+            "mean_ms": round(total_seconds / len(latencies) * 1000, 3),
+            "p50_ms": round(get_percentile(sorted_latencies, 50) * 1000, 3),
+            "p90_ms": round(get_percentile(sorted_latencies, 90) * 1000, 3),
+            "p99_ms": round(get_percentile(sorted_latencies, 99) * 1000, 3),
+            "max_ms": round(sorted_latencies[-1] * 1000, 3),
+            "throughput_per_second": round(len(latencies) / total_seconds, 2) if total_seconds > 0 else None,
+            "start_rss_mb": start_rss_mb,
+            "peak_rss_mb": peak_rss_mb}
+
+# Get the commit being benchmarked, if this is a git repository
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+# Print how each stage has changed since an earlier run
+def compare_results(old_results, new_results):
+    print(f'\nCompared with {old_results.get("commit") or "earlier run"} from {old_results.get("started_at")}:')
+    for stage, new_stage in new_results["stages"].items():
+        old_stage = old_results.get("stages", {}).get(stage)
+        if old_stage is None:
+            continue
+        changes = []
+        for measure in ("p50_ms", "p99_ms", "peak_rss_mb"):
+            if old_stage.get(measure) and new_stage.get(measure) is not None:
+                changes.append(f"{measure} {(new_stage[measure] - old_stage[measure]) / old_stage[measure] * 100:+.1f}%")
+        print(f"  {stage:<24} {', '.join(changes)}")
+    if old_results.get("parameters") != new_results["parameters"]:
+        print("  Note: the runs used different parameters, so they may not be comparable")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark postcode lookups, stop searches and timetable extraction on made up data")
+    parser.add_argument("--areas", type=int, default=40, help="number of localities")
+    parser.add_argument("--stops-per-area", type=int, default=50, help="bus stops in each locality")
+    parser.add_argument("--files", type=int, default=60, help="number of bus files (one bus line each)")
+    parser.add_argument("--journeys", type=int, default=200, help="journeys in each bus file")
+    parser.add_argument("--route-length", type=int, default=20, help="stops along each bus line")
+    parser.add_argument("--operations", type=int, default=50, help="operations timed in each stage")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="where to save the results as JSON (default: benchmark_results/<time>.json)")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    parser.add_argument("--keep", action="store_true", help="keep the folder of made up data")
+    arguments = parser.parse_args()
+
+    parameters = {"areas": arguments.areas, "stops_per_area": arguments.stops_per_area, "files": arguments.files,
+                  "journeys": arguments.journeys, "route_length": arguments.route_length,
+                  "operations": arguments.operations, "seed": arguments.seed}
+    results = {"started_at": datetime.now().isoformat(timespec="seconds"), "commit": get_git_commit(),
+               "python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+               "parameters": parameters, "stages": {}}
+
+    work_dir = tempfile.mkdtemp(prefix="bus_benchmark_")
+    # New processes are started from scratch, so each stage's memory use does not include the others
+    spawn_context = get_context("spawn")
+    try:
+        print(f"Generating data in {work_dir}...")
+        start_time = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=1, mp_context=spawn_context) as executor:
+            world = executor.submit(generate_world_in, work_dir, arguments.areas, arguments.stops_per_area, arguments.files,
+                                    arguments.journeys, arguments.route_length, arguments.seed).result()
+        results["generation_seconds"] = round(time.perf_counter() - start_time, 2)
+
+        for stage in arguments.stages:
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn_context) as executor:
+                stage_results = executor.submit(run_stage, stage, work_dir, world, arguments.operations, arguments.seed).result()
+            results["stages"][stage] = stage_results
+            print(f'{stage:<24} p50 {stage_results["p50_ms"]:>9.3f} ms  p99 {stage_results["p99_ms"]:>9.3f} ms  '
+                  f'{stage_results["throughput_per_second"] or 0:>9.1f}/s  peak RSS {stage_results["peak_rss_mb"]} MB')
+    finally:
+        if arguments.keep:
+            print(f"Made up data kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output_path = arguments.output or os.path.join("benchmark_results", f'{results["started_at"].replace(":", "-")}.json')
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "w") as output_file:
+        json.dump(results, output_file, indent=4)
+    print(f"Results saved to {output_path}")
+
+    if arguments.compare:
+        with open(arguments.compare, "r") as compare_file:
+            compare_results(json.load(compare_file), results)
+
+# Generate the made up data in a folder. Runs in its own process, as generating changes the current folder
+def generate_world_in(work_dir, *arguments):
+    os.chdir(work_dir)
+    block_network()
+    return generate_world(*arguments)
+
+if __name__ == "__main__":
+    main()
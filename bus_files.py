@@ -0,0 +1,32 @@
+# Name a bus file is stored under, or None if it is neither a .zip nor .xml file
+def get_bus_filename(result):
+    if result["extension"] == "zip":
+        return f'{result["operatorName"]}_{result["id"]}.zip'
+    elif result["extension"] == "xml":
+        return f'{result["operatorName"]}_{result["id"]}_{result["lines"][0]}.xml'
+    return None
+
+# Get (dataset, filename) of every bus file to download from the API results
+def get_bus_files(results):
+    bus_files = []
+    # Keeps track of selected files, to help prevent duplicate files
+    bus_files_info = []
+
+    # Goes through each bus service in the API
+    for result in reversed(results):
+
+        # Check if info of bus file is in the list
+        # i.e. if file of same bus line(s) and operator had already been selected
+        if [result["operatorName"], result["lines"]] in bus_files_info:
+            continue # Skip to next bus operator
+
+        # Use the API to check if the link is a .zip or .xml file, and create a filename for it
+        filename = get_bus_filename(result)
+        if filename is None:
+            continue
+        bus_files.append((result, filename))
+
+        # Add info of selected file to list
+        bus_files_info.append([result["operatorName"], result["lines"]])
+
+    return bus_files
@@ -0,0 +1,182 @@
+from zipfile import ZipFile, BadZipFile
+import shutil
+import json
+import mmap
+import re
+import os
+from instrumentation import count
+
+# Matches the ATCO code inside a StopPointRef, with or without a namespace prefix
+STOP_POINT_REF = re.compile(rb"<(?:\w+:)?StopPointRef(?:\s[^>]*)?>\s*([^<\s]+)\s*</(?:\w+:)?StopPointRef>")
+
+class BusStore:
+    def __init__(self, store_dir="bus_services"):
+        # Bus files are kept directly on disk: xml datasets as single files, and zip datasets unpacked
+        # into a folder of the same name, so each TransXChange file can be read on its own
+        self.store_dir = store_dir
+        self.manifest_path = os.path.join(store_dir, "manifest.json")
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.manifest = self.load_manifest()
+        self.stop_refs = {} # {filename: {file path: set of StopPointRefs}}, loaded when first needed
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path, "r") as manifest_file:
+                return json.load(manifest_file)
+        except (json.JSONDecodeError, OSError):
+            return {} # Download everything again if the manifest cannot be read
+
+    def save_manifest(self):
+        with open(self.manifest_path + ".tmp", "w") as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=4)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+    # Where a dataset is kept in the store
+    def get_path(self, filename):
+        if filename.endswith(".zip"):
+            return os.path.join(self.store_dir, filename[:-len(".zip")])
+        return os.path.join(self.store_dir, filename)
+
+    # Path to download a dataset to before it is added to the store
+    def get_download_path(self, filename):
+        return os.path.join(self.store_dir, filename + ".part")
+
+    # Check if a dataset is in the store, with the same modification time
+    def is_installed(self, dataset_id, filename, modified):
+        entry = self.manifest.get(str(dataset_id))
+        return (entry is not None
+                and entry["filename"] == filename
+                and entry["modified"] == modified
+                and os.path.exists(self.get_path(filename)))
+
+    # Check if a dataset is in the store under this filename, whatever its modification time
+    def has_dataset(self, dataset_id, filename):
+        entry = self.manifest.get(str(dataset_id))
+        return entry is not None and entry["filename"] == filename
+
+    # Move a downloaded dataset into the store, unpacking it if it is a zip file. Any older copy
+    # is kept until the new one has been unpacked
+    def install(self, dataset_id, filename, modified, download_path):
+        path = self.get_path(filename)
+
+        if filename.endswith(".zip"):
+            # Unpack into a temporary folder, then move the whole folder into place
+            temporary_dir = path + ".tmp"
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+            files = []
+            try:
+                with ZipFile(download_path, 'r') as operator_zip:
+                    # Keep the order of files in the zip, as lookups go through them in reverse order
+                    for member in operator_zip.infolist():
+                        if member.is_dir():
+                            continue
+                        extracted_path = operator_zip.extract(member, temporary_dir)
+                        count("files_decompressed")
+                        count("bytes_decompressed", member.file_size)
+                        files.append(os.path.relpath(extracted_path, temporary_dir))
+            except BadZipFile:
+                shutil.rmtree(temporary_dir, ignore_errors=True)
+                os.remove(download_path)
+                raise
+            self.remove(dataset_id)
+            shutil.rmtree(path, ignore_errors=True)
+            os.replace(temporary_dir, path)
+            os.remove(download_path)
+        else:
+            files = [filename]
+            self.remove(dataset_id)
+            os.replace(download_path, path)
+
+        self.manifest[str(dataset_id)] = {"filename": filename, "modified": modified, "files": files}
+        self.save_manifest()
+
+        # Note down which stops each file refers to, so files can be skipped without being parsed
+        self.build_stop_refs(filename)
+
+    # Delete a dataset from the store
+    def remove(self, dataset_id):
+        entry = self.manifest.pop(str(dataset_id), None)
+        if entry is None:
+            return
+        path = self.get_path(entry["filename"])
+        self.stop_refs.pop(entry["filename"], None)
+        if os.path.exists(path + ".stops.json"):
+            os.remove(path + ".stops.json")
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+        self.save_manifest()
+
+    # Get paths of the TransXChange files in a dataset, in the order they were in the zip file
+    def get_xml_files(self, filename):
+        for entry in self.manifest.values():
+            if entry["filename"] == filename:
+                if filename.endswith(".zip"):
+                    return [os.path.join(self.get_path(filename), file) for file in entry["files"]]
+                return [self.get_path(filename)]
+        return []
+
+    # Read the contents of a TransXChange file in the store
+    def read_file(self, path):
+        count("files_opened")
+        with open(path, "rb") as bus_file:
+            return bus_file.read()
+
+    # Find every StopPointRef in a file by searching its bytes, without parsing the XML
+    def find_stop_refs(self, path):
+        with open(path, "rb") as bus_file:
+            if os.fstat(bus_file.fileno()).st_size == 0:
+                return set()
+            with mmap.mmap(bus_file.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+                return {match.group(1).decode() for match in STOP_POINT_REF.finditer(contents)}
+
+    # Save the StopPointRefs of each file in a dataset next to it
+    def build_stop_refs(self, filename):
+        stop_refs = {path: self.find_stop_refs(path) for path in self.get_xml_files(filename)}
+        relative_stop_refs = {os.path.relpath(path, self.store_dir): sorted(refs) for path, refs in stop_refs.items()}
+        stops_path = self.get_path(filename) + ".stops.json"
+        with open(stops_path + ".tmp", "w") as stops_file:
+            json.dump(relative_stop_refs, stops_file)
+        os.replace(stops_path + ".tmp", stops_path)
+        self.stop_refs[filename] = stop_refs
+        return stop_refs
+
+    # Check if a file in a dataset could serve a stop. Files which do not refer to the stop anywhere cannot
+    def may_serve_stop(self, filename, path, atco_code):
+        if filename not in self.stop_refs:
+            stops_path = self.get_path(filename) + ".stops.json"
+            try:
+                with open(stops_path, "r") as stops_file:
+                    self.stop_refs[filename] = {os.path.join(self.store_dir, relative_path): set(refs)
+                                                for relative_path, refs in json.load(stops_file).items()}
+            except (OSError, json.JSONDecodeError):
+                # Datasets stored before stops were noted down get them worked out now
+                self.build_stop_refs(filename)
+
+        stop_refs = self.stop_refs[filename].get(path)
+        if stop_refs is None:
+            return True # Not known, so the file has to be checked
+        return atco_code in stop_refs
+
+# Keep the store in memory between lookups, along with the manifest it was loaded from, so
+# the manifest and the stops of each file are not read again for every lookup
+loaded_bus_store = None
+loaded_manifest = None
+
+# Get the bus store for lookups, only loading it again if the manifest has changed. Downloads use their own BusStore
+def load_bus_store(store_dir="bus_services"):
+    global loaded_bus_store, loaded_manifest
+    manifest_path = os.path.join(store_dir, "manifest.json")
+    try:
+        manifest_stat = os.stat(manifest_path)
+        manifest = (manifest_path, manifest_stat.st_mtime_ns, manifest_stat.st_size)
+    except OSError:
+        manifest = (manifest_path, None, None) # Nothing has been downloaded yet
+
+    if loaded_bus_store is None or loaded_manifest != manifest:
+        loaded_bus_store = BusStore(store_dir)
+        loaded_manifest = manifest
+    return loaded_bus_store
@@ -0,0 +1,89 @@
+import sqlite3 # Enable keeping the list of datasets in a single file database
+import json
+import os
+
+class DatasetStore:
+    def __init__(self, store_path="datasets.db", api_copy_path="API_copy.json"):
+        # Details of every Surrey dataset in the API, so a lookup only reads the datasets of the stop's area
+        self.store_path = store_path
+        connection = self.connect()
+        try:
+            with connection:
+                # Datasets in the order the API lists them, which decides which file is used for a line
+                connection.execute("""CREATE TABLE IF NOT EXISTS datasets (position INTEGER PRIMARY KEY, dataset_id INTEGER,
+                                      operator_name TEXT, lines TEXT, extension TEXT, modified TEXT, url TEXT)""")
+                connection.execute("CREATE TABLE IF NOT EXISTS dataset_localities (position INTEGER, gazetteer_id TEXT)")
+                # Localities are only ever read in whole, so stores made with an index on them no longer keep it
+                connection.execute("DROP INDEX IF EXISTS dataset_localities_gazetteer_id")
+            is_empty = connection.execute("SELECT COUNT(*) FROM datasets").fetchone()[0] == 0
+        finally:
+            connection.close()
+
+        # Datasets used to be kept in a copy of the API json, which is read in once so the app still works offline
+        if is_empty and os.path.exists(api_copy_path):
+            try:
+                with open(api_copy_path, "r") as BODSData:
+                    self.replace_datasets(json.load(BODSData)["results"])
+            except (json.JSONDecodeError, KeyError, TypeError, OSError):
+                pass # Datasets are fetched again on the next update
+
+    def connect(self):
+        return sqlite3.connect(self.store_path)
+
+    # Turn an API result into the rows stored for it
+    def get_rows(self, position, result):
+        dataset_row = (position, result["id"], result["operatorName"], json.dumps(result["lines"]),
+                       result["extension"], result.get("modified"), result.get("url"))
+        locality_rows = [(position, gazetteer_id) for gazetteer_id in sorted({place["gazetteer_id"] for place in result["localities"]})]
+        return dataset_row, locality_rows
+
+    # Turn stored rows back into the same form as an API result
+    def get_result(self, dataset_row, gazetteer_ids):
+        _, dataset_id, operator_name, lines, extension, modified, url = dataset_row
+        return {"id": dataset_id, "operatorName": operator_name, "lines": json.loads(lines), "extension": extension,
+                "modified": modified, "url": url, "localities": [{"gazetteer_id": gazetteer_id} for gazetteer_id in gazetteer_ids]}
+
+    # Store the datasets from the API in place of the old ones, if anything about them has changed.
+    # Returns whether anything changed
+    def replace_datasets(self, results):
+        new_rows = [self.get_rows(position, result) for position, result in enumerate(results)]
+        connection = self.connect()
+        try:
+            # Compare dataset by dataset, so the file is only written, and its modification time changed, when needed
+            old_datasets = connection.execute("SELECT * FROM datasets ORDER BY position").fetchall()
+            old_localities = connection.execute("SELECT * FROM dataset_localities ORDER BY position, gazetteer_id").fetchall()
+            if (old_datasets == [dataset_row for dataset_row, _ in new_rows]
+                    and old_localities == [locality_row for _, locality_rows in new_rows for locality_row in locality_rows]):
+                return False
+
+            # All changes are made in one transaction, so lookups never see half of the new datasets
+            with connection:
+                connection.execute("DELETE FROM datasets")
+                connection.execute("DELETE FROM dataset_localities")
+                connection.executemany("INSERT INTO datasets VALUES (?, ?, ?, ?, ?, ?, ?)", [dataset_row for dataset_row, _ in new_rows])
+                connection.executemany("INSERT INTO dataset_localities VALUES (?, ?)",
+                                       [locality_row for _, locality_rows in new_rows for locality_row in locality_rows])
+            return True
+        finally:
+            connection.close()
+
+    # Get every dataset, in the same form and order as the API results
+    def get_results(self):
+        connection = self.connect()
+        try:
+            gazetteer_ids = {}
+            for position, gazetteer_id in connection.execute("SELECT * FROM dataset_localities ORDER BY position, gazetteer_id"):
+                gazetteer_ids.setdefault(position, []).append(gazetteer_id)
+            return [self.get_result(dataset_row, gazetteer_ids.get(dataset_row[0], []))
+                    for dataset_row in connection.execute("SELECT * FROM datasets ORDER BY position")]
+        finally:
+            connection.close()
+
+# One store is shared by every lookup. Each call opens its own connection, so it can be used from any thread
+loaded_dataset_store = None
+
+def load_dataset_store(store_path="datasets.db"):
+    global loaded_dataset_store
+    if loaded_dataset_store is None or loaded_dataset_store.store_path != store_path:
+        loaded_dataset_store = DatasetStore(store_path)
+    return loaded_dataset_store
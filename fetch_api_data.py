@@ -1,101 +1,190 @@
 import requests # Enable accessing of API
-from zipfile import ZipFile, ZIP_DEFLATED # Enable manipulation of .zip files
-import json
+from requests.adapters import HTTPAdapter
+from zipfile import BadZipFile
+from concurrent.futures import ThreadPoolExecutor, as_completed # Enable downloading files at the same time
 import os
+import shutil
+import time
 from dotenv import load_dotenv
+from timetable_index import TimetableIndex
+from bus_files import get_bus_files
+from bus_store import BusStore
+from dataset_store import DatasetStore
+from timetable_cache import get_timetable_cache
+from instrumentation import span, count
+
+# Number of datasets asked for in each page of the API
+PAGE_SIZE = 100
 
 class GrabFiles:
-    def __init__(self):
+    def __init__(self, url="https://data.bus-data.dft.gov.uk/api/v1/dataset/", max_page_workers=4):
         # Store url of API and API key
         load_dotenv()
         self.API_KEY = os.getenv("BUS_API_KEY")
-        self.url = f"https://data.bus-data.dft.gov.uk/api/v1/dataset/?adminArea=400&limit=120&api_key={self.API_KEY}"
+        self.url = url
+        self.params = {"adminArea": 400, "limit": PAGE_SIZE, "api_key": self.API_KEY}
         self.is_API_request = False
-        self.response_contents = None
+        self.results = []
+        self.timeout = 60
+        self.max_page_workers = max_page_workers # Pages of the API fetched at the same time
+        self.failed_downloads = []
+        self.changed_datasets = []
+        self.removed_datasets = []
 
         # Fetch API contents with error handling
         try:
-            self.response = requests.get(self.url)
-            self.response.raise_for_status()  # Raise error for bad responses (4xx, 5xx)
-            # Convert it to JSON to make it easier to parse
-            self.response_contents = self.response.json()
-            # Fetch the relevant contents, 'results'
-            self.results = self.response_contents["results"]
+            self.results = self.fetch_datasets()
             self.is_API_request = True # Successful data retrieval
 
-        except (requests.RequestException, requests.ConnectionError, requests.Timeout):
+        except (requests.RequestException, requests.ConnectionError, requests.Timeout, ValueError, KeyError):
             self.is_API_request = False # Unsuccessful data retrieval
 
-    def download_timetables(self): 
-        print("Downloading...") # Notifies start of download
-
-        # Keeps track of downloaded files, to help prevent duplicate files
-        downloaded_files_info = []
-
-        # Create a zip file to store all the bus files
-        with ZipFile("bus_services.zip", 'w', ZIP_DEFLATED) as bus_service_files:
-
-            # Goes through each bus service in the API
-            for result in reversed(self.results):
-
-                # Check if info of bus file is in the list
-                # i.e. if file of same bus line(s) and operator had already been downloaded
-                if [result["operatorName"], result["lines"]] in downloaded_files_info:
-                    continue # Skip to next bus operator
-
-                # Fetch the contents in the file from the 'url' 
-                url_content = requests.get(result["url"])
-
-                # Use the API to check if the link is a .zip file
-                if result["extension"] == "zip":
-                    # Create a filename for the .zip file
-                    filename = f"{result["operatorName"]}_{result["id"]}.zip"
-
-                    # Create a file with the name of filename...
-                    with bus_service_files.open(filename,"w") as file:
-                        # and store the contents in there
-                        file.write(url_content.content)
-
-                    # Add info of downloaded file to list
-                    downloaded_files_info.append([result["operatorName"], result["lines"]])
-
-                # Use the API to check if the link is an .xml file
-                elif result["extension"] == "xml":
-                    # Create a filename for the .xml file
-                    filename = f"{result["operatorName"]}_{result["id"]}_{result["lines"][0]}.xml"
-
-                    # Create a file with the name of filename...
-                    with bus_service_files.open(filename,"w") as file:
-                        # and store the contents in there
-                        file.write(url_content.content)
-
-                    # Add info of downloaded file to list
-                    downloaded_files_info.append([result["operatorName"], result["lines"]])
-
-        print("Downloading complete") # Notifies end of download
-
-    def check_for_updates(self):
-        # Look for file storing copy of API json recently fetched
-        if not os.path.exists("API_copy.json"):
-
-            # Create API copy json file if file not found
-            with open("API_copy.json","w") as datafile:
-                json.dump(self.response_contents, datafile, indent=4)
-                #print("API_copy.json created")
-
-        else:
-            # Load up the json file
-            with open("API_copy.json","r") as datafile:
-                data = json.load(datafile)
-
-            # Checking if API has updated since last time
-            if self.response_contents != data:
-                #print("API has changed")      
-                with open("API_copy.json","w") as datafile:
-                    json.dump(self.response_contents, datafile, indent=4)
-                self.download_timetables()
-                
+    # Get one page of the API as JSON, either by its offset or by the link to it given in another page
+    def fetch_page(self, session, offset=None, url=None):
+        with span("bods.fetch_page"):
+            if url is not None:
+                response = session.get(url, timeout=self.timeout)
             else:
-                pass
-                #print("API has not changed")
-
+                response = session.get(self.url, params={**self.params, "offset": offset}, timeout=self.timeout)
+            response.raise_for_status()  # Raise error for bad responses (4xx, 5xx)
+            count("api_pages_fetched")
+            return response.json()
+
+    # Put the datasets on several pages into one list. A dataset can appear on two pages if the list
+    # changed between them, so it is only kept once
+    def get_unique_results(self, pages):
+        results = []
+        seen_ids = set()
+        for page in pages:
+            for result in page["results"]:
+                if result["id"] not in seen_ids:
+                    seen_ids.add(result["id"])
+                    results.append(result)
+        return results
+
+    # Get every Surrey dataset in the API, going through all of its pages
+    def fetch_datasets(self):
+        with requests.Session() as session:
+            first_page = self.fetch_page(session, offset=0)
+            # The server may give fewer datasets per page than asked for, so the offsets go up by how many it gave
+            page_size = len(first_page["results"])
+
+            # The first page says how many datasets there are, so the other pages can be fetched at the same time
+            if first_page.get("next") and first_page.get("count") and page_size:
+                with ThreadPoolExecutor(max_workers=self.max_page_workers) as executor:
+                    pages = [first_page] + list(executor.map(lambda offset: self.fetch_page(session, offset=offset),
+                                                             range(page_size, first_page["count"], page_size)))
+                results = self.get_unique_results(pages)
+                if len(results) == first_page["count"]:
+                    return results
+                # Datasets were added or removed while the pages were fetched, so some may have moved to a page
+                # already fetched. Go through the pages again one at a time, following the link to each next page
+                first_page = self.fetch_page(session, offset=0)
+
+            pages = [first_page]
+            next_url = first_page.get("next")
+            seen_urls = set()
+            while next_url and next_url not in seen_urls:
+                seen_urls.add(next_url)
+                pages.append(self.fetch_page(session, url=next_url))
+                next_url = pages[-1].get("next")
+            results = self.get_unique_results(pages)
+
+        # Datasets left out of the list would be deleted, so a list with some missing is never used
+        expected_count = pages[-1].get("count")
+        if expected_count is not None and len(results) < expected_count:
+            raise ValueError(f"Only {len(results)} of {expected_count} datasets were fetched")
+        return results
+
+    # Stream a bus file to disk, returning its size in bytes
+    def download_file(self, session, url, file_path):
+        size = 0
+        with span("bods.download_file"), session.get(url, stream=True, timeout=self.timeout) as url_content:
+            url_content.raise_for_status()  # Raise error for bad responses (4xx, 5xx)
+            # Write to a partial file, so an interrupted download is never mistaken for a complete one
+            with open(file_path, "wb") as file:
+                for chunk in url_content.iter_content(chunk_size=65536):
+                    file.write(chunk)
+                    size += len(chunk)
+        count("files_downloaded")
+        count("bytes_downloaded", size)
+        return size
+
+    # Download bus files at the same time, up to max_workers at once. progress_callback, if given, is called
+    # after each file with (files completed, total files, bytes downloaded, seconds taken)
+    def download_timetables(self, max_workers=8, progress_callback=None):
+        bus_store = BusStore()
+        self.failed_downloads = [] # Filenames of files which could not be downloaded
+
+        # Get the bus files to download, leaving out those already in the store with the same modification time
+        bus_files = get_bus_files(self.results)
+        files_to_download = [(result, filename) for result, filename in bus_files
+                             if not bus_store.is_installed(result["id"], filename, result.get("modified"))]
+        self.changed_datasets = [filename for _, filename in files_to_download] # Files which are new or have changed
+        self.removed_datasets = [] # Files no longer in the API
+
+        # Delete datasets which are no longer in the API
+        wanted_datasets = {str(result["id"]): filename for result, filename in bus_files}
+        for dataset_id, entry in list(bus_store.manifest.items()):
+            if wanted_datasets.get(dataset_id) != entry["filename"]:
+                bus_store.remove(dataset_id)
+                self.removed_datasets.append(entry["filename"])
+
+        completed = len(bus_files) - len(files_to_download)
+        downloaded_bytes = 0
+        start_time = time.monotonic()
+
+        # One session shared by all workers, so connections to the server are reused
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        with session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+            downloads = {executor.submit(self.download_file, session, result["url"], bus_store.get_download_path(filename)): (result, filename)
+                         for result, filename in files_to_download}
+
+            for download in as_completed(downloads):
+                result, filename = downloads[download]
+                try:
+                    size = download.result()
+                    # Add the completed file to the store straight away, so an interrupted run can carry on from here
+                    bus_store.install(result["id"], filename, result.get("modified"), bus_store.get_download_path(filename))
+                except (requests.RequestException, OSError, BadZipFile):
+                    self.failed_downloads.append(filename)
+                    # Keep any older copy until a new one is installed, so a network error does not lose the
+                    # last good timetables. Its modification time in the manifest is unchanged, so the next run tries again
+                    if os.path.exists(bus_store.get_download_path(filename)):
+                        os.remove(bus_store.get_download_path(filename))
+                    continue
+
+                completed += 1
+                downloaded_bytes += size
+                if progress_callback is not None:
+                    progress_callback(completed, len(bus_files), downloaded_bytes, time.monotonic() - start_time)
+
+        # Files from before bus files were stored unpacked are no longer used
+        if os.path.exists("bus_services.zip"):
+            os.remove("bus_services.zip")
+        shutil.rmtree("bus_services_downloads", ignore_errors=True)
+
+    # progress_callback, if given, is passed on to download_timetables
+    def check_for_updates(self, progress_callback=None):
+        # Keep the details of every dataset, which LocateBusFile uses to find the relevant files of a bus stop
+        datasets_changed = DatasetStore().replace_datasets(self.results)
+        # The datasets used to be kept in a copy of the API json, which is now in the dataset store
+        if os.path.exists("API_copy.json"):
+            os.remove("API_copy.json")
+
+        # Only download datasets which are new or have a different modification time, and drop removed ones
+        self.download_timetables(progress_callback=progress_callback)
+
+        # Make the same changes to the timetable index
+        timetable_index = TimetableIndex()
+        index_changed = self.changed_datasets or self.removed_datasets or not timetable_index.is_built()
+        if index_changed:
+            timetable_index.update(self.results)
+
+        # Cached stop timetables are out of date once the bus data or the index it is read from has changed
+        if index_changed or datasets_changed:
+            get_timetable_cache().clear()
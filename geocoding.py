@@ -1,7 +1,8 @@
 import requests
-import xml.etree.ElementTree as ET
-import os
-import hashlib
+from stop_index import load_stop_index
+from refresh_bus_stops import RefreshBusStops
+from postcode_cache import PostcodeCache, normalise_postcode, load_offline_postcodes
+from instrumentation import span
 
 class NearbyStops:
     def __init__(self, postcode):
@@ -10,113 +11,93 @@ class NearbyStops:
         self.is_bus_stop_request = False
         self.postcode_lat = 0
         self.postcode_lon = 0
+        self.stops_hash = None
         self.check_bus_stops_data()
         self.check_postcode(postcode)
 
     def check_bus_stops_data(self):
-        # Look for 400.xml, check if it exists
-        try:
-            # Retrieve Surrey bus stop data
-            self.stops_content_request = requests.get("https://naptan.api.dft.gov.uk/v1/access-nodes?dataFormat=xml&atcoAreaCodes=400")
-            file_path = "400.xml"
-            self.stops_content_request.raise_for_status()  # Raises an error for bad responses (4xx and 5xx)
-            xml_content = self.stops_content_request.text
-
-            # Compute hash of new data
-            new_hash = hashlib.md5(xml_content.encode()).hexdigest()
+        # Make sure 400.xml is up to date. It is only checked once the refresh time has passed, and
+        # only downloaded again if the server says it has changed
+        with span("check_bus_stops_data"):
+            bus_stops_data = RefreshBusStops()
+            self.is_bus_stop_request = bus_stops_data.refresh()
 
-            # If file does not exist, write the new content
-            if not os.path.exists(file_path):
-                with open(file_path, "w") as datafile:
-                    datafile.write(xml_content)
+        # Keep the hash, so the bus stop index is only rebuilt when the data changes
+        self.stops_hash = bus_stops_data.stops_hash
 
-            # Read existing file and compare hash values
-            with open(file_path, "r") as datafile:
-                existing_hash = hashlib.md5(datafile.read().encode()).hexdigest()
+    def check_postcode(self, postcode):
+        # Check the postcode is written like a postcode before looking it up, and tidy it up
+        postcode = normalise_postcode(postcode)
+        if postcode is None:
+            self.is_postcode_request = False
+            return
 
-            if new_hash != existing_hash:
-                with open(file_path, "w") as datafile:
-                    datafile.write(xml_content)
+        with span("look_up_postcode"):
+            postcode_info = self.look_up_postcode(postcode)
+        # Unsuccessful lookup or postcode does not exist
+        if postcode_info is None or not postcode_info["is_found"]:
+            self.is_postcode_request = False
+            return
 
-            self.is_bus_stop_request = True
+        self.is_postcode_request = True
+        # Retrieve and store latitude and longitude of postcode if it is in Surrey
+        if postcode_info["county"]=="E10000030" and postcode_info["lat"] is not None: # Check if postcode data has county code of Surrey
+            self.postcode_lat = postcode_info["lat"]
+            self.postcode_lon = postcode_info["lon"]
+            self.is_in_Surrey = True
+        else:
+            self.is_in_Surrey = False
 
-        except (requests.RequestException, requests.ConnectionError, requests.Timeout):
-            self.is_bus_stop_request = False
+    # Get {"is_found", "lat", "lon", "county"} of a postcode, or None if it could not be looked up
+    def look_up_postcode(self, postcode):
+        # Use the offline postcode table instead of the internet if one has been set up
+        offline_postcodes = load_offline_postcodes()
+        if offline_postcodes is not None:
+            return offline_postcodes.get(postcode)
 
-    def check_postcode(self, postcode):
+        # Use the postcode from the cache if it was looked up recently
+        postcode_cache = PostcodeCache()
         try:
-            # Retrieve data on the postcode which the user will input
-            self.postcode_request = requests.get(f"https://findthatpostcode.uk/postcodes/{postcode}.json")
-            # Retrieve and store latitude and longitude of postcode if postcode input is correct
-            if self.postcode_request.status_code == 200:
-                self.is_postcode_request = True
-                # Retrieve and store latitude and longitude of postcode if it is in Surrey
-                self.postcode_data = self.postcode_request.json() # Convert to json data
-                if self.postcode_data["data"]["attributes"]["cty"]=="E10000030": # Check if postcode data has county code of Surrey
-                    self.postcode_lat = self.postcode_data["data"]["attributes"]["location"]["lat"]
-                    self.postcode_lon = self.postcode_data["data"]["attributes"]["location"]["lon"]
-                    self.is_in_Surrey = True
-                else:
-                    self.is_in_Surrey = False
-            else:
-                self.is_postcode_request = False
-        except (requests.RequestException, requests.ConnectionError, requests.Timeout):
-            self.is_postcode_request = False
-    
-    # Parse XML and find the nearest bus stops
-    def find_nearest_bus_stops(self):
-        # Representing XML docs as tree structure, where each node is an element
-        tree = ET.parse("400.xml")
-        root = tree.getroot() # Get the root of the XML tree structure
-        
-        # Enable access to elements in a namespace
-        namespace = {"n": "http://www.naptan.org.uk/"}
-        # Initialise list to store relevant bus stops
-        bus_stops = []
+            postcode_info = postcode_cache.get(postcode)
+            if postcode_info is not None:
+                return postcode_info
 
-        # Setting boundaries in which relevant bus stops can be output
-        maxLat = self.postcode_lat + 0.005
-        minLat = self.postcode_lat - 0.005
-        maxLong = self.postcode_lon + 0.005
-        minLong = self.postcode_lon - 0.005
-        
-        # Iterate through all StopPoint elements
-        for stop_point in root.findall(".//n:StopPoint", namespace):
-            status = stop_point.get("Status") # Gets status of bus stop
-            if status != "active":
-                continue  # Skip inactive stops
+            try:
+                # Retrieve data on the postcode which the user will input, giving up if the server does not answer
+                self.postcode_request = requests.get(f"https://findthatpostcode.uk/postcodes/{postcode}.json", timeout=10)
+            except (requests.RequestException, requests.ConnectionError, requests.Timeout):
+                return None
 
-            # Extract ATCO code
-            atco_code = stop_point.find("n:AtcoCode", namespace)
-            atco_code = atco_code.text if atco_code is not None else "Unknown"
-            
-            # Extract common name
-            common_name = stop_point.find(".//n:Descriptor/n:CommonName", namespace)
-            common_name = common_name.text if common_name is not None else "Unnamed Stop"
+            if self.postcode_request.status_code == 200:
+                try:
+                    self.postcode_data = self.postcode_request.json() # Convert to json data
+                    attributes = self.postcode_data["data"]["attributes"]
+                    location = attributes.get("location") or {}
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    return None # Response is not in the expected format, so treat it as not found
+                postcode_cache.put_found(postcode, location.get("lat"), location.get("lon"), attributes.get("cty"))
+                return {"is_found": True, "lat": location.get("lat"), "lon": location.get("lon"), "county": attributes.get("cty")}
+
+            # Postcode does not exist, remember this too
+            if self.postcode_request.status_code == 404:
+                postcode_cache.put_not_found(postcode)
+                return {"is_found": False, "lat": None, "lon": None, "county": None}
 
-            # Extract locality reference ID
-            nptg_locality_ref = stop_point.find(".//n:Place/n:NptgLocalityRef", namespace)
-            nptg_locality_ref = nptg_locality_ref.text if nptg_locality_ref is not None else "Unknown"
-            
-            # Extract location
-            location = stop_point.find(".//n:Location/n:Translation", namespace)
-            if location is not None: # If there is location data...
-                # Get latitude and longitude of bus stop
-                latitude = float(location.find("n:Latitude", namespace).text)
-                longitude = float(location.find("n:Longitude", namespace).text)
+            return None # Any other error is not cached, so it is tried again next time
+        finally:
+            postcode_cache.close()
 
-                # If the bus stop is within the set boundaries...
-                if minLat < latitude < maxLat and minLong < longitude < maxLong:
-                    # Append stop details as dictionary
-                    bus_stops.append({
-                        "name": common_name,
-                        "atco_code": atco_code,
-                        "gazetteer_id": nptg_locality_ref,
-                        "latitude": latitude,
-                        "longitude": longitude
-                    })
-        
-        # Return the nearest bus stops
-        return bus_stops
+    # Find the nearest bus stops using the compiled bus stop index
+    def find_nearest_bus_stops(self):
+        with span("find_nearest_bus_stops"):
+            # Load the index, which is only compiled from 400.xml when the file has changed
+            stop_index = load_stop_index(self.stops_hash)
 
+            # Setting boundaries in which relevant bus stops can be output
+            maxLat = self.postcode_lat + 0.005
+            minLat = self.postcode_lat - 0.005
+            maxLong = self.postcode_lon + 0.005
+            minLong = self.postcode_lon - 0.005
 
+            # Return the nearest bus stops, closest first
+            return stop_index.find_stops_in_box(self.postcode_lat, self.postcode_lon, minLat, maxLat, minLong, maxLong)
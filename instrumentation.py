@@ -0,0 +1,160 @@
+import threading
+import time
+import os
+from datetime import datetime
+
+# Upper bounds in seconds of the buckets that span durations are counted in
+SPAN_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+# Times a with-block and records it once the block is finished
+class Span:
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.parent = None
+        self.start_time = None
+
+    def __enter__(self):
+        # Keep track of which span this one is inside, so the log shows where the time went
+        span_stack = self.instrumentation.get_span_stack()
+        self.parent = span_stack[-1].name if span_stack else None
+        span_stack.append(self)
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        duration = time.perf_counter() - self.start_time
+        self.instrumentation.get_span_stack().pop()
+        self.instrumentation.record_span(self.name, self.parent, duration, error_type is not None)
+        return False
+
+# Used in place of a span while instrumentation is switched off, so it costs next to nothing
+class NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        return False
+
+NO_SPAN = NoSpan()
+
+# Records how long each part of a lookup takes, and counts of things such as files opened, so slow
+# lookups can be tracked down. Switched off unless INSTRUMENTATION is set, or set_enabled is called
+class Instrumentation:
+    def __init__(self, enabled=None, log_path=None, metrics_path=None):
+        self.enabled = enabled if enabled is not None else os.getenv("INSTRUMENTATION", "") not in ("", "0")
+        # If given, every span is written to this file as it finishes
+        self.log_path = log_path if log_path is not None else os.getenv("INSTRUMENTATION_LOG")
+        # Where write_metrics saves everything recorded, in the Prometheus text format
+        self.metrics_path = metrics_path if metrics_path is not None else os.getenv("INSTRUMENTATION_METRICS", "instrumentation.prom")
+
+        # Spans and counts are recorded from background threads, so they are kept behind a lock
+        self.lock = threading.Lock()
+        self.spans = {} # {name: [count, total seconds, longest seconds, errors, count in each bucket]}
+        self.counters = {} # {name: total}
+        self.log_file = None
+        self.thread_data = threading.local()
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+
+    # Time a with-block, e.g. with span("process_data.parse"):
+    def span(self, name):
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, name)
+
+    # Add to a counter, e.g. the number of bytes read
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Get the spans currently open on this thread
+    def get_span_stack(self):
+        if not hasattr(self.thread_data, "span_stack"):
+            self.thread_data.span_stack = []
+        return self.thread_data.span_stack
+
+    def record_span(self, name, parent, duration, is_error):
+        with self.lock:
+            span_stats = self.spans.get(name)
+            if span_stats is None:
+                span_stats = self.spans[name] = [0, 0.0, 0.0, 0, [0] * len(SPAN_BUCKETS)]
+            span_stats[0] += 1
+            span_stats[1] += duration
+            span_stats[2] = max(span_stats[2], duration)
+            span_stats[3] += is_error
+            for position, bucket in enumerate(SPAN_BUCKETS):
+                if duration <= bucket:
+                    span_stats[4][position] += 1
+                    break
+
+            if self.log_path:
+                if self.log_file is None:
+                    self.log_file = open(self.log_path, "a", buffering=1) # Written line by line
+                self.log_file.write(f"{datetime.now().isoformat(timespec='milliseconds')} {threading.current_thread().name} "
+                                    f"{name} {duration * 1000:.3f} ms" + (f" in {parent}" if parent else "")
+                                    + (" (error)" if is_error else "") + "\n")
+
+    # Get {"spans": {name: {count, total_seconds, max_seconds, errors}}, "counters": {name: total}}
+    def get_stats(self):
+        with self.lock:
+            return {"spans": {name: {"count": span_stats[0], "total_seconds": span_stats[1], "max_seconds": span_stats[2],
+                                     "errors": span_stats[3]}
+                              for name, span_stats in self.spans.items()},
+                    "counters": dict(self.counters)}
+
+    def reset(self):
+        with self.lock:
+            self.spans.clear()
+            self.counters.clear()
+
+    # Save everything recorded in the Prometheus text format, e.g. for node_exporter's textfile collector
+    def write_metrics(self, metrics_path=None):
+        metrics_path = metrics_path if metrics_path is not None else self.metrics_path
+        lines = ["# HELP bus_timetable_span_seconds Time spent in each part of the lookups",
+                 "# TYPE bus_timetable_span_seconds histogram"]
+        with self.lock:
+            for name, (count, total_seconds, _, _, bucket_counts) in sorted(self.spans.items()):
+                # Buckets count every span up to their bound, including those in smaller buckets
+                cumulative_count = 0
+                for bucket, bucket_count in zip(SPAN_BUCKETS, bucket_counts):
+                    cumulative_count += bucket_count
+                    lines.append(f'bus_timetable_span_seconds_bucket{{span="{name}",le="{bucket}"}} {cumulative_count}')
+                lines.append(f'bus_timetable_span_seconds_bucket{{span="{name}",le="+Inf"}} {count}')
+                lines.append(f'bus_timetable_span_seconds_sum{{span="{name}"}} {total_seconds:.6f}')
+                lines.append(f'bus_timetable_span_seconds_count{{span="{name}"}} {count}')
+
+            lines += ["# HELP bus_timetable_span_errors_total Spans which ended with an error",
+                      "# TYPE bus_timetable_span_errors_total counter"]
+            lines += [f'bus_timetable_span_errors_total{{span="{name}"}} {span_stats[3]}' for name, span_stats in sorted(self.spans.items())]
+
+            lines += ["# HELP bus_timetable_events_total Counts of files opened, bytes read and similar",
+                      "# TYPE bus_timetable_events_total counter"]
+            lines += [f'bus_timetable_events_total{{event="{name}"}} {total}' for name, total in sorted(self.counters.items())]
+
+        # Write to a temporary file first, so a half-written file is never collected
+        with open(metrics_path + ".tmp", "w") as metrics_file:
+            metrics_file.write("\n".join(lines) + "\n")
+        os.replace(metrics_path + ".tmp", metrics_path)
+
+    def close(self):
+        with self.lock:
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
+
+# One set of measurements is shared by the whole process. Lookups run in other processes
+# (e.g. LocateBusFile with max_workers) record into their own copy, which is not collected
+shared_instrumentation = Instrumentation()
+
+def get_instrumentation():
+    return shared_instrumentation
+
+def span(name):
+    return shared_instrumentation.span(name)
+
+def count(name, amount=1):
+    shared_instrumentation.count(name, amount)
@@ -0,0 +1,69 @@
+import threading
+import os
+from bus_files import get_bus_filename
+from dataset_store import load_dataset_store
+
+class LocalityIndex:
+    def __init__(self, results):
+        # {gazetteer ID: [(position in API, operator and lines, extension, filename)]} of the
+        # bus files which operate in each locality, in the order LocateBusFile looks at them
+        self.files_by_locality = {}
+        # {gazetteer ID: operator and lines of files already selected}, to prevent duplicate files
+        selected_files_info = {}
+
+        # Search through the bus operators in reverse order
+        for position, result in enumerate(reversed(results)):
+            # Name of the bus file, as it was downloaded
+            filename = get_bus_filename(result)
+            if filename is None:
+                continue
+            file_info = (result["operatorName"], tuple(result["lines"]))
+
+            for gazetteer_id in {place["gazetteer_id"] for place in result["localities"]}:
+                # Check if file of same operator and same bus line has already been selected for this locality
+                if file_info in selected_files_info.setdefault(gazetteer_id, set()):
+                    continue
+                selected_files_info[gazetteer_id].add(file_info)
+                self.files_by_locality.setdefault(gazetteer_id, []).append((position, file_info, result["extension"], filename))
+
+    # Get names of the zip and xml files relevant to one or more localities
+    def find_relevant_files(self, gazetteer_ids):
+        candidates = []
+        for gazetteer_id in set(gazetteer_ids):
+            candidates.extend(self.files_by_locality.get(gazetteer_id, []))
+        candidates.sort(key=lambda candidate: candidate[0])
+
+        relevant_zip_files = [] # List to store name of relevant zip files
+        relevant_xml_files = [] # List to store name of relevant xml files
+        relevant_files_info = set() # Keep track of selected files, makes sure no duplicate files selected
+        for _, file_info, extension, filename in candidates:
+            if file_info in relevant_files_info:
+                continue # File of same operator and bus line already selected
+            relevant_files_info.add(file_info)
+            if extension == "zip":
+                relevant_zip_files.append(filename)
+            else:
+                relevant_xml_files.append(filename)
+        return relevant_zip_files, relevant_xml_files
+
+# Keep the index in memory between lookups, along with the dataset store it was built from
+loaded_locality_index = None
+loaded_dataset_store_version = None
+# Lookups run on background threads, so only one builds the index at a time
+loaded_locality_index_lock = threading.Lock()
+
+# Get the locality index, only building it again if the dataset store has changed
+def load_locality_index(dataset_store_path="datasets.db"):
+    global loaded_locality_index, loaded_dataset_store_version
+    with loaded_locality_index_lock:
+        dataset_store = load_dataset_store(dataset_store_path)
+        try:
+            dataset_store_stat = os.stat(dataset_store_path)
+            dataset_store_version = (dataset_store_path, dataset_store_stat.st_mtime_ns, dataset_store_stat.st_size)
+        except OSError:
+            dataset_store_version = (dataset_store_path, None, None)
+
+        if loaded_locality_index is None or loaded_dataset_store_version != dataset_store_version:
+            loaded_locality_index = LocalityIndex(dataset_store.get_results())
+            loaded_dataset_store_version = dataset_store_version
+        return loaded_locality_index
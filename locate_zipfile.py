@@ -1,136 +1,165 @@
-from zipfile import ZipFile
-from io import BytesIO
 import os
-import json
-from processing_timetable_data import ProcessData
+import threading
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor # Enable reading bus files in several processes at once
+from processing_timetable_data import StreamProcessData
+from timetable_index import TimetableIndex
+from bus_store import load_bus_store
+from locality_index import load_locality_index
+from dataset_store import load_dataset_store
+from stop_index import load_stop_index
+from timetable_model import StopTimetable
+from timetable_cache import get_timetable_cache, get_dataset_version
+from instrumentation import span, count
 
 class LocateBusFile:
-    def __init__(self, bus_stop_data):
+    def __init__(self, bus_stop_data, neighbour_radius=None, max_workers=None):
         # Get the bus stop data dictionary
         self.bus_stop_data = bus_stop_data
-        self.bus_operators_dataset = self.get_json_data()
-        self.results = self.bus_operators_dataset["results"]
+        # If given, also use bus files of localities with a stop within this many metres of the bus stop's locality
+        self.neighbour_radius = neighbour_radius
+        # If given, bus files are read by this many processes at the same time. Set with LOOKUP_WORKERS,
+        # and only used when the timetable index has not been built yet
+        if max_workers is None and os.getenv("LOOKUP_WORKERS"):
+            max_workers = int(os.getenv("LOOKUP_WORKERS"))
+        self.max_workers = max_workers
         self.all_bus_timetables = []
 
-    # Get data from the API copy instead of requesting
+    # Get data from the dataset store instead of requesting
     def get_json_data(self):
-        with open("API_copy.json","r") as BODSData:
-            bus_operators_dataset = json.load(BODSData)
-        return bus_operators_dataset
+        return {"results": load_dataset_store().get_results()}
 
     def find_bus_service_zipfile(self):
-        bus_services_zip_path = "bus_services.zip"
-        if os.path.exists(bus_services_zip_path):
-            print("Zipfile found")
+        bus_services_path = "bus_services"
+        if os.path.exists(bus_services_path):
+            print("Bus services found")
         else:
-            print("Zipfile not found")
+            print("Bus services not found")
 
-    def find_relevant_operators_by_place(self):
-        relevant_zip_files = [] # List to store name of relevant zip files
-        relevant_xml_files = [] # List to store name of relevant xml files
-        relevant_files_info = [] # Keep track of selected files, makes sure no duplicate files selected
+    # Get gazetteer IDs of the bus stop's locality, and of neighbouring localities if asked for
+    def get_gazetteer_ids(self):
         stop_gazetteer_id = self.bus_stop_data['gazetteer_id'] # Get gazetteer ID of bus stop
+        if self.neighbour_radius is None:
+            return [stop_gazetteer_id]
+        neighbouring_localities = load_stop_index().get_neighbouring_localities(stop_gazetteer_id, self.neighbour_radius)
+        return [stop_gazetteer_id] + sorted(neighbouring_localities)
 
-        # Search through the bus operators in reverse order
-        for result in reversed(self.results):
-            
-            # Check if file of same operator and same bus line has been selected
-            if [result["operatorName"], result["lines"]] in relevant_files_info:
-                    continue # Skip to next bus operator
-            
-            # Search through the list of places the bus company operates
-            for place in result["localities"]:
+    def find_relevant_operators_by_place(self):
+        # Look up the bus files operating in the same area as the bus stop, in the dataset store
+        return load_locality_index().find_relevant_files(self.get_gazetteer_ids())
 
-                # If bus company does operate in the same area as bus stop, get name of zip/xml file
-                if place["gazetteer_id"] == stop_gazetteer_id: 
-                    if result["extension"] == "zip":
-                        # Add relevant filename to list
-                        relevant_zip_files.append(f'{result["operatorName"]}_{result["id"]}.{result["extension"]}')
+    def get_bus_stop_timetable(self):
+        # Reuse the timetable if this stop was looked up since the bus data last changed
+        timetable_cache = get_timetable_cache()
+        gazetteer_ids = self.get_gazetteer_ids()
+        stop_key = f"{self.bus_stop_data['atco_code']}|{','.join(gazetteer_ids)}"
+        dataset_version = get_dataset_version()
+        with span("stop_timetable"):
+            timetable = timetable_cache.get(stop_key, dataset_version)
+            if timetable is None:
+                count("timetable_cache_misses")
+                timetable = self.find_bus_stop_timetable(gazetteer_ids)
+                timetable_cache.put(stop_key, dataset_version, timetable)
+            else:
+                count("timetable_cache_hits")
+        return timetable
+
+    # Work out the timetable of the bus stop from the bus data
+    def find_bus_stop_timetable(self, gazetteer_ids):
+        # Read the timetable straight from the index if it has been built
+        timetable_index = TimetableIndex()
+        if timetable_index.is_built():
+            with span("stop_timetable.index"):
+                return timetable_index.get_bus_stop_timetable(self.bus_stop_data['atco_code'], gazetteer_ids)
+
+        all_bus_timetables = StopTimetable() # Collect all bus arrival times at the target stop
+        relevant_zip_files, relevant_xml_files = load_locality_index().find_relevant_files(gazetteer_ids) # Get names of relevant files
+        atco_code = self.bus_stop_data['atco_code']
+
+        # Bus files are stored unpacked in the bus store, so each one can be read directly
+        bus_store = load_bus_store()
+
+        # List every file to read as (zip file it came from or None, path), xml files first
+        bus_files = []
+        for file in relevant_xml_files:
+            # Find the xml file in the bus store
+            xml_files = bus_store.get_xml_files(file)
+            if not xml_files:
+                continue # File has not been downloaded
+
+            # Skip the file without parsing it if it never refers to the stop
+            if bus_store.may_serve_stop(file, xml_files[0], atco_code):
+                bus_files.append((None, xml_files[0]))
+            else:
+                count("files_skipped")
+
+        for zip_file in relevant_zip_files:
+            # Go through all xml files from the zip file in reverse order
+            for xml_file in reversed(bus_store.get_xml_files(zip_file)):
+                # Skip the file without parsing it if it never refers to the stop
+                if bus_store.may_serve_stop(zip_file, xml_file, atco_code):
+                    bus_files.append((zip_file, xml_file))
+                else:
+                    count("files_skipped")
+
+        # Read the files, spread across processes if asked for. Results come back in the same order as bus_files
+        arguments = ([path for _, path in bus_files], [atco_code] * len(bus_files), [zip_file is not None for zip_file, _ in bus_files])
+        if self.max_workers is not None and self.max_workers > 1 and len(bus_files) > 1:
+            bus_file_results = get_process_pool(self.max_workers).map(process_bus_file, *arguments)
+        else:
+            bus_file_results = map(process_bus_file, *arguments)
 
-                        # Add info of relevant file to list
-                        relevant_files_info.append([result["operatorName"], result["lines"]])
+        # Lists to keep track of bus lines already checked in each zip file
+        checked_lines = {}
 
-                    elif result["extension"] == "xml":
-                        # Add relevant filename to list
-                        relevant_xml_files.append(f'{result["operatorName"]}_{result["id"]}_{result["lines"][0]}.{result["extension"]}')
+        for (zip_file, _), (lineNumber, arrival_times, calendars) in zip(bus_files, bus_file_results):
+            # Check if arrival times retrieval was successful
+            if not arrival_times:
+                continue
 
-                        # Add info of relevant file to list
-                        relevant_files_info.append([result["operatorName"], result["lines"]])
+            if zip_file is not None:
+                # Check if data of that bus line was already retrieved from this zip file
+                if lineNumber in checked_lines.setdefault(zip_file, []):
+                    continue # Skip to the next bus line file
+                checked_lines[zip_file].append(lineNumber) # 'Tick off' the line number
 
-                    break # Move on to next bus operator instead of checking the next locality code
+            # Add line number and its associated times to timetable
+            all_bus_timetables.add_service(lineNumber, arrival_times, calendars)
 
-        return relevant_zip_files, relevant_xml_files
-    
-    def get_bus_stop_timetable(self):
-        all_bus_timetables = [] # Collect all bus arrival times at the target stop
-        arrival_times = [] # Collect arrival times of a bus
-        relevant_zip_files, relevant_xml_files = self.find_relevant_operators_by_place() # Get names of relevant files
-
-        # Search through bus_services.zip containing all bus files operating in Surrey
-        with ZipFile("bus_services.zip",'r') as bus_services_zip:
-            # Search through xml files first
-            for file in relevant_xml_files:
-
-                # Fetch xml content of the xml file
-                with bus_services_zip.open(file,'r') as bus_file:
-                    xml_content = bus_file.read()
-
-                # Initialise object for retrieving data about the bus
-                bus_data = ProcessData(xml_content, self.bus_stop_data['atco_code'])
-
-                # Get arrival times
-                arrival_times = bus_data.find_arrival_times_by_destination()
-                
-                # Check if arrival times retrieval was successful
-                if arrival_times:
-
-                    # Get line number
-                    lineNumber = bus_data.get_line_number()
-
-                    # Add line number and its associated times to timetable list
-                    bus_info = {'line':lineNumber, 'arrival_times': arrival_times}
-                    all_bus_timetables.append(bus_info)
-
-            # Search through zip files
-            for zip_file in relevant_zip_files:
-
-                # List to keep track of bus lines already checked
-                checked_lines = []
-
-                with bus_services_zip.open(zip_file, 'r') as zf:
-
-                    # Store its contents in memory in order to access it
-                    zipfile_contents = BytesIO(zf.read())
-                    with ZipFile(zipfile_contents,'r') as operator_zip:
-                        
-                        # Go through all xml files in reverse order
-                        for xml_file in reversed(operator_zip.namelist()):
-
-                            # Fetch xml content of the xml file
-                            with operator_zip.open(xml_file,'r') as bus_file:
-                                xml_content = bus_file.read()
-
-                            # Initialise object for retrieving data about the bus
-                            bus_data = ProcessData(xml_content, self.bus_stop_data['atco_code'])
-
-                            # Get line number
-                            lineNumber = bus_data.get_line_number()
-
-                            # Check if data of that bus line was already retrieved
-                            if lineNumber in checked_lines:
-                                continue # Skip to the next bus line file
-
-                            # Get arrival times
-                            arrival_times = bus_data.find_arrival_times_by_destination()
-                            
-                            # Check if arrival times retrieval was successful
-                            if arrival_times:
-                                checked_lines.append(lineNumber) # 'Tick off' the line number
-
-                                # Add line number and its associated times to timetable list
-                                bus_info = {'line':lineNumber, 'arrival_times': arrival_times}
-                                all_bus_timetables.append(bus_info)
-                            
         return all_bus_timetables
 
-
+    # Get (arrival time in seconds since midnight, line, destination) of the next buses at the stop
+    # after a date and time, only counting journeys which run that day
+    def get_next_departures(self, when=None, limit=10):
+        if when is None:
+            when = datetime.now()
+        after_seconds = when.hour * 3600 + when.minute * 60 + when.second
+        return self.get_bus_stop_timetable().next_departures(after_seconds, limit, when.date())
+
+# Get (line number, arrival times, calendars) of a bus file at a stop. This is outside the class so that it
+# can be run in another process
+def process_bus_file(xml_path, atco_code, is_from_zip_file):
+    # Initialise object for retrieving data about the bus, reading the file a bit at a time
+    bus_data = StreamProcessData(xml_path, atco_code)
+    with span("process_data.arrival_times"):
+        arrival_times = bus_data.find_arrival_times_by_destination()
+
+    # Files from zip files always need their line number, to check for lines already retrieved
+    if is_from_zip_file:
+        return bus_data.get_line_number(), arrival_times, bus_data.calendars
+
+    if arrival_times:
+        return bus_data.get_line_number(), arrival_times, bus_data.calendars
+    return None, arrival_times, bus_data.calendars
+
+# Pools of processes shared by every lookup, as starting processes is slow. {number of processes: pool}
+process_pools = {}
+# Lookups run on background threads, so only one makes a pool at a time. Pools are never shut down
+# while the app is running, as another lookup may still be using them
+process_pools_lock = threading.Lock()
+
+def get_process_pool(max_workers):
+    with process_pools_lock:
+        if max_workers not in process_pools:
+            process_pools[max_workers] = ProcessPoolExecutor(max_workers=max_workers)
+        return process_pools[max_workers]
@@ -2,7 +2,6 @@ from kivy.app import App
 from kivy.uix.screenmanager import Screen, ScreenManager
 from kivy.uix.textinput import TextInput
 from kivy.uix.button import Button
-from kivy_garden.mapview import MapView, MapMarkerPopup
 from kivy.uix.floatlayout import FloatLayout
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.gridlayout import GridLayout
@@ -10,64 +9,33 @@ from kivy.uix.label import Label
 from kivy.uix.button import Button
 from kivy.uix.popup import Popup 
 from kivy.uix.scrollview import ScrollView
-from geocoding import NearbyStops
-from fetch_api_data import GrabFiles
-from locate_zipfile import LocateBusFile
-
-class BusStopMarkerPopup(MapMarkerPopup):
-    def __init__(self, stop_data, **kwargs):
-        super().__init__(**kwargs) # Inherit all methods and attributes from MapMarkerPopup class
-        self.stop_data = stop_data # Initialise stop data
-
-        # Create the popup content layout
-        popup_layout = BoxLayout(orientation="vertical", size_hint=(None, None), size=(200, 100))
-
-        # Add a label for the bus stop name
-        title_label = Label(text=self.stop_data['name'], size_hint=(1, 0.7), outline_width = 2)
-        popup_layout.add_widget(title_label)
-
-        # Add a button to view the timetable
-        view_button = Button(text="View Timetable", 
-                                 size_hint=(1, 0.3), 
-                                 background_normal='', # Gets rid of default dark shade
-                                 background_color=(4/255, 76/255, 54/255, 1), # Green 'Surrey' colour
-                                 )
-        # Set button so when pressed, gives stop data to function
-        view_button.bind(on_press=self.view_timetable)
-        popup_layout.add_widget(view_button)
-
-        # Set the popup content
-        self.add_widget(popup_layout)  
-
-    def view_timetable(self, instance):
-        timetable = LocateBusFile(self.stop_data).get_bus_stop_timetable()
-        timetable_popup = DisplayTimetable(timetable, self.stop_data)
-        timetable_popup.open()
-        #print(self.stop_data)
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
+from kivy.clock import Clock
+from background_tasks import BackgroundTasks
+from timetable_model import format_time_of_day
+from datetime import datetime
+from tile_cache import TileCache, prefetch_tiles
+from instrumentation import span, get_instrumentation
+import os
+
+class LoadingLabel(Label):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.opacity = 0 # Hidden until something is loading
+
+    def show(self, text):
+        self.text = text
+        self.opacity = 1
+
+    def hide(self):
+        self.opacity = 0
 
 class InputPostcode(Screen):
     def __init__ (self,**kwargs):
         super().__init__(**kwargs)
-        # Check for updates and download data if needed
-        update = GrabFiles()
-        # Check for internet connection
-        if update.is_API_request:
-            update.check_for_updates()
-        else:
-            layout = FloatLayout()
-            error_label = Label(text = "An error occured. Please make sure you are connected to the internet.",
-                                size_hint = (None, None),
-                                size = (200,50),
-                                pos_hint={'center_x': 0.5, 'center_y': 0.7}, text_size=(300,None))
-            layout.add_widget(error_label)
-            no_internet_popup = Popup(title = "Error", 
-                                content = layout, size_hint=(None, None), 
-                                size=(400, 400),
-                                background_color=[4/255, 76/255, 54/255, 1], # Green 'Surrey' colour
-                                auto_dismiss = False)       
-            no_internet_popup.open()
-            return
-        
+        self.background_tasks = App.get_running_app().background_tasks
+
         # Set up a layout to add widgets on the window
         self.layout = FloatLayout()
         self.add_widget(self.layout)
@@ -76,8 +44,9 @@ class InputPostcode(Screen):
         self.postcode_longitude = 0.0
         self.bus_stops = []  # Define bus_stops as an instance attribute
 
-        self.map_view = MapView(zoom=10, lat=51.25, lon=-0.33)  # Surrey coordinates
-        self.layout.add_widget(self.map_view) # Add map to window
+        # The map is added after the first frame, so the window is shown before mapview (and requests) are loaded
+        self.map_view = None
+        Clock.schedule_once(self.add_map)
 
         # Text input for postcode (with hint text inside)
         self.text_input = TextInput(
@@ -102,13 +71,86 @@ class InputPostcode(Screen):
         self.search_button.bind(on_press = self.search)
         self.layout.add_widget(self.search_button)
 
+        # Shows what is loading in the background
+        self.loading_label = LoadingLabel(size_hint=(1, 0.05), pos_hint={"x": 0, "y": 0.9}, outline_width = 2)
+        self.layout.add_widget(self.loading_label)
+
+        # Check for updates and download data in the background, so the search screen appears straight away
+        self.loading_label.show("Checking for timetable updates...")
+        self.background_tasks.submit("update", self.update_timetables,
+                                     on_success=self.finish_update, on_error=lambda error: self.finish_update(False))
+
+    def add_map(self, dt):
+        from kivy_garden.mapview import MapView
+        self.map_view = MapView(zoom=10, lat=51.25, lon=-0.33, map_source=App.get_running_app().get_map_source())  # Surrey coordinates
+        # Add map to window, behind the text box and buttons
+        self.layout.add_widget(self.map_view, index=len(self.layout.children))
+
+    # Runs in the background
+    def update_timetables(self):
+        # Imported here rather than at the top, so the app opens without waiting for requests and lxml to load
+        from fetch_api_data import GrabFiles
+        # Check for updates and download data if needed
+        update = GrabFiles()
+        # Check for internet connection
+        if update.is_API_request:
+            update.check_for_updates(progress_callback=self.show_download_progress)
+        return update.is_API_request
+
+    # Called on the download threads after each bus file, so the label is updated on the UI thread
+    def show_download_progress(self, completed, total, downloaded_bytes, seconds_taken):
+        text = f"Downloading timetables... {completed}/{total} files ({downloaded_bytes / 1_000_000:.1f} MB)"
+        Clock.schedule_once(lambda dt: self.loading_label.show(text))
+
+    def finish_update(self, is_API_request):
+        self.loading_label.hide()
+        if not is_API_request:
+            self.no_internet_message()
+
+    def no_internet_message(self):
+        layout = FloatLayout()
+        error_label = Label(text = "An error occured. Please make sure you are connected to the internet.",
+                            size_hint = (None, None),
+                            size = (200,50),
+                            pos_hint={'center_x': 0.5, 'center_y': 0.7}, text_size=(300,None))
+        layout.add_widget(error_label)
+        no_internet_popup = Popup(title = "Error", 
+                            content = layout, size_hint=(None, None), 
+                            size=(400, 400),
+                            background_color=[4/255, 76/255, 54/255, 1], # Green 'Surrey' colour
+                            auto_dismiss = False)       
+        no_internet_popup.open()
+
     def search(self, instance):
-        postcodeInfo = NearbyStops(self.text_input.text)
+        # Look up the postcode and nearby bus stops in the background
+        self.loading_label.show("Searching...")
+        self.background_tasks.submit("search", self.find_bus_stops, (self.text_input.text,),
+                                     on_success=self.show_search_results, on_error=self.search_failed)
+
+    # Runs in the background
+    def find_bus_stops(self, postcode):
+        from geocoding import NearbyStops
+        postcodeInfo = NearbyStops(postcode)
+        bus_stops = []
+        if postcodeInfo.is_in_Surrey and postcodeInfo.is_bus_stop_request:
+            bus_stops = postcodeInfo.find_nearest_bus_stops()
+        return postcodeInfo, bus_stops
+
+    def search_failed(self, error):
+        self.loading_label.hide()
+        self.error_message(self.search_button, "An error occurred. Please try again.", "Close")
+
+    def show_search_results(self, search_results):
+        self.loading_label.hide()
+        postcodeInfo, bus_stops = search_results
         self.postcode_latitude = postcodeInfo.postcode_lat
         self.postcode_longitude = postcodeInfo.postcode_lon
         if postcodeInfo.is_in_Surrey and postcodeInfo.is_bus_stop_request:
             # Correct postcode, move on
-            self.bus_stops = postcodeInfo.find_nearest_bus_stops()
+            self.bus_stops = bus_stops
+            # The bus stops screen and its map are only made when first needed, so the app opens sooner
+            if not self.manager.has_screen("BusStops"):
+                self.manager.add_widget(ShowBusStops(name='BusStops'))
             self.manager.current = "BusStops"
         elif postcodeInfo.is_postcode_request:
             # Notify user to put Surrey postcode
@@ -144,12 +186,88 @@ class InputPostcode(Screen):
 class ShowBusStops(Screen):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self.background_tasks = App.get_running_app().background_tasks
         self.layout = FloatLayout()
         self.add_widget(self.layout)
 
+        # Imported here rather than at the top, so the app opens without waiting for mapview and requests to load
+        from kivy_garden.mapview import MapView, MapMarkerPopup
+        from map_widgets import BusStopMarkerLayer
+
+        # One map is kept and reused for every search
+        self.map_view = MapView(zoom=16, lat=51.25, lon=-0.33, map_source=App.get_running_app().get_map_source())
+        self.layout.add_widget(self.map_view)
+        self.bus_stop_markers = BusStopMarkerLayer(self.map_view)
+
+        # Plotting postcode location with a different marker
+        self.postcode_marker = MapMarkerPopup(source='turquoise-map-marker.png')
+        self.postcode_label = Label(size_hint=(1, 0.7), outline_width = 2)
+        self.postcode_marker.add_widget(self.postcode_label)
+
+        # Back button to InputPostcode screen
+        back_button = Button(text="Back", size_hint=(0.1,0.05), pos_hint={"x":0,"y":0.95}, 
+                             background_normal='', # Gets rid of default dark shade
+                             background_color=(4/255, 76/255, 54/255, 1)) # Green 'Surrey' colour
+        back_button.bind(on_press=self.go_back_to_search_screen)
+        self.layout.add_widget(back_button)
+
+        # Shows which timetable is loading in the background, on top of the map
+        self.loading_label = LoadingLabel(size_hint=(0.8, 0.05), pos_hint={"x": 0.1, "y": 0.95}, outline_width = 2)
+        self.layout.add_widget(self.loading_label)
+
     def go_back_to_search_screen(self, instance):
+        # Stop loading a timetable which will no longer be shown
+        self.background_tasks.cancel("timetable")
+        self.loading_label.hide()
         self.manager.current="InputPostcode"
 
+    def load_timetable(self, stop_data):
+        # Find the timetable in the background. Tapping another marker cancels this one
+        self.loading_label.show(f"Loading timetable for {stop_data['name']}...")
+        self.background_tasks.submit("timetable", self.get_timetable, (stop_data,),
+                                     on_success=lambda timetable: self.show_timetable(timetable, stop_data),
+                                     on_error=lambda error: self.timetable_failed(stop_data))
+
+    # Runs in the background. Only today's buses and the next few departures are passed back to be shown
+    def get_timetable(self, stop_data):
+        from locate_zipfile import LocateBusFile
+        timetable = LocateBusFile(stop_data).get_bus_stop_timetable()
+        now = datetime.now()
+        after_seconds = now.hour * 3600 + now.minute * 60 + now.second
+        return list(timetable.get_services(now.date())), timetable.next_departures(after_seconds, limit=5, day=now.date())
+
+    def show_timetable(self, timetable, stop_data):
+        self.loading_label.hide()
+        services, next_departures = timetable
+        with span("display_timetable"):
+            timetable_popup = DisplayTimetable(services, next_departures, stop_data)
+            timetable_popup.open()
+
+    # Tell the user the timetable could not be loaded, rather than showing an empty timetable
+    # which looks the same as a stop with no buses
+    def timetable_failed(self, stop_data):
+        self.loading_label.hide()
+        layout = FloatLayout()
+        error_label = Label(text = f"The timetable for {stop_data['name']} could not be loaded. Please try again.",
+                            size_hint = (None, None),
+                            size = (200,50),
+                            pos_hint={'center_x': 0.5, 'center_y': 0.7}, text_size=(300,None))
+        close_button = Button(text = "Close",
+                              size_hint = (0.8,0.2),
+                              pos_hint = {"x":0.1,"y":0.1},
+                              background_normal='', # Gets rid of default dark shade
+                              background_color=(4/255, 76/255, 54/255, 1), # Green 'Surrey' colour
+                              )
+        layout.add_widget(error_label)
+        layout.add_widget(close_button)
+        error_popup = Popup(title = "Error",
+                            content = layout, size_hint=(None, None),
+                            size=(400, 400),
+                            background_color=[4/255, 76/255, 54/255, 1], # Green 'Surrey' colour
+                            auto_dismiss = False)
+        error_popup.open()
+        close_button.bind(on_press=error_popup.dismiss)
+
     def show_instructions(self):
         instructions_layout = FloatLayout()
         popup_label = Label(text = "Click on a marker to view its bus stop name, then click on 'View Timetable' above the marker to view the timetable of the bus stop.",
@@ -185,29 +303,45 @@ class ShowBusStops(Screen):
         postcode_longitude = input_postcode_screen.postcode_longitude
         map_coor = self.get_midpoint_coor(bus_stops) # Getting the midpoint of the nearby bus stop coordinates
 
-        # Set up a map to focus on midpoint coordinates
-        self.map_view = MapView(zoom=16, lat=map_coor['latitude'], lon=map_coor['longitude'])
-        # Plotting postcode location with a different marker
-        self.postcode_marker = MapMarkerPopup(lat=postcode_latitude, lon=postcode_longitude, source='turquoise-map-marker.png')
-        self.postcode_marker.add_widget(Label(text=input_postcode_screen.text_input.text, size_hint=(1, 0.7), outline_width = 2))
-        self.layout.add_widget(self.map_view)
-        self.map_view.add_widget(self.postcode_marker)
+        # Move the map to focus on midpoint coordinates
+        self.map_view.zoom = 16
+        self.map_view.center_on(map_coor['latitude'], map_coor['longitude'])
 
-        # Loop through all the bus stops and plot onto map
-        for stop in bus_stops:
-            marker = BusStopMarkerPopup(stop_data=stop, lat=stop["latitude"], lon=stop["longitude"])
-            self.map_view.add_widget(marker)
+        # Move the postcode marker to the new postcode
+        self.map_view.remove_marker(self.postcode_marker)
+        self.postcode_marker.lat = postcode_latitude
+        self.postcode_marker.lon = postcode_longitude
+        self.postcode_label.text = input_postcode_screen.text_input.text
+        self.map_view.add_marker(self.postcode_marker)
 
-        # Back button to InputPostcode screen
-        back_button = Button(text="Back", size_hint=(0.1,0.05), pos_hint={"x":0,"y":0.95}, 
-                             background_normal='', # Gets rid of default dark shade
-                             background_color=(4/255, 76/255, 54/255, 1)) # Green 'Surrey' colour
-        back_button.bind(on_press=self.go_back_to_search_screen)
-        self.layout.add_widget(back_button)
+        # Plot the bus stops which can be seen onto the map
+        self.bus_stop_markers.set_bus_stops(bus_stops)
         self.show_instructions()
 
+# Scrolling list of a bus line's destinations and arrival times. Only the labels which can be seen are
+# created, and they are reused for other rows while scrolling, so busy stops open straight away
+class ArrivalTimesView(RecycleView):
+    def __init__(self, arrival_times, **kwargs):
+        super().__init__(**kwargs)
+        self.viewclass = "Label"
+        rows_layout = RecycleBoxLayout(orientation="vertical", size_hint_y=None, default_size=(None, 40), default_size_hint=(1, None))
+        rows_layout.bind(minimum_height=rows_layout.setter("height"))
+        self.add_widget(rows_layout)
+
+        # Every row sets the same properties, as a label may have been showing a different kind of row before
+        rows = []
+        for destination, times in arrival_times:
+            # Destination name in bold, then the times underneath
+            rows.append({"text": destination, "bold": True, "height": 60, "text_size": (250, None), "halign": "center"})
+            for seconds in times:
+                # Times are kept as seconds since midnight until they are shown
+                rows.append({"text": format_time_of_day(seconds), "bold": False, "height": 40, "text_size": (None, None), "halign": "center"})
+        self.data = rows
+
 class DisplayTimetable(Popup):
-    def __init__(self, timetable, stop_data, **kwargs):
+    # services is a list of (line, [(destination, arrival times)]) running today, and
+    # next_departures a list of (arrival time, line, destination) of the next few buses
+    def __init__(self, services, next_departures, stop_data, **kwargs):
         super().__init__(*kwargs)
         self.title = stop_data["name"] # Bus stop name
         self.size_hint = (0.8, 0.8)
@@ -216,7 +350,16 @@ class DisplayTimetable(Popup):
         main_layout = BoxLayout(orientation="vertical")
 
         # Check if timetable is not empty
-        if timetable:
+        if services:
+            # Show the next few buses first, so the whole timetable does not need to be looked through
+            next_departures_text = "\n".join(f"{format_time_of_day(seconds)[:5]}   {line} to {destination}"
+                                             for seconds, line, destination in next_departures)
+            next_departures_label = Label(text=next_departures_text or "No more buses today",
+                                          size_hint=(1, None), height=25 * max(len(next_departures), 1) + 10,
+                                          halign="left", valign="middle")
+            next_departures_label.bind(size=next_departures_label.setter('text_size'))
+            main_layout.add_widget(next_departures_label)
+
             # Will contain whole table which will scroll horizontally
             whole_table_scroll = ScrollView(size_hint=(1, 1), do_scroll_x=True, do_scroll_y=False, bar_width="5dp")
 
@@ -225,36 +368,22 @@ class DisplayTimetable(Popup):
             table_layout.bind(minimum_width=table_layout.setter("width"))
             
             # Loop through timetable data, looking at timetable of each bus line
-            for bus in timetable:
+            for line, arrival_times in services:
 
                 # Headings - line number
-                heading_label = Label(text=bus["line"], bold=True, size_hint=(None, None), size=(250, 40), 
+                heading_label = Label(text=line, bold=True, size_hint=(None, None), size=(250, 40), 
                                     text_size=(250, None), halign="center", valign="middle")
                 table_layout.add_widget(heading_label)
 
-                # Add a scrolling widget underneath the heading
-                arrival_times_scroll = ScrollView()
-                arrival_times_grid = GridLayout(cols=1, size_hint_y=None)
-                arrival_times_grid.bind(minimum_height=arrival_times_grid.setter("height"))
-
-                # Loop through timetable of the bus line
-                for destination, times in bus["arrival_times"].items():
-                    # Add destination name in bold, then the times underneath
-                    destination_label = Label(text=destination, bold=True, size_hint_y=None, text_size=(250, None), halign="center")
-                    destination_label.bind(texture_size=destination_label.setter('size'))
-                    arrival_times_grid.add_widget(destination_label)
-                    for time in times:
-                        arrival_times_grid.add_widget(Label(text=time, size_hint_y=None, halign="center", height=40))
-
-                arrival_times_scroll.add_widget(arrival_times_grid)
-                table_layout.add_widget(arrival_times_scroll)
+                # Add a scrolling list of the line's times underneath the heading
+                table_layout.add_widget(ArrivalTimesView(arrival_times, size_hint=(None, 1), width=250))
 
             whole_table_scroll.add_widget(table_layout)
             
             main_layout.add_widget(whole_table_scroll)
         else:
             # Message displayed in the same popup if timetable data is empty
-            error_label = Label(text="There does not seem to be any buses stopping at this stop.", 
+            error_label = Label(text="There does not seem to be any buses stopping at this stop today.", 
                                 size_hint=(1, 0.5),
                                 halign='center',
                                 valign='middle')
@@ -272,10 +401,41 @@ class DisplayTimetable(Popup):
 
 class BusTimetableApp(App):
     def build(self):
+        # Network requests, XML parsing and file reading are run here instead of on the UI thread
+        self.background_tasks = BackgroundTasks()
+        # Map tiles are cached on disk and shared by both maps
+        self.tile_cache = TileCache()
+        self.map_source = None # Made when the first map is made
+        # Download the tiles of the whole of Surrey in the background if asked to, e.g. on a kiosk.
+        # Only done from a tile server set with TILE_SERVER_URL, as OpenStreetMap's does not allow it
+        if os.getenv("PREFETCH_MAP_TILES") and os.getenv("TILE_SERVER_URL"):
+            self.background_tasks.submit("prefetch_tiles", prefetch_tiles, (self.tile_cache,))
         my_screenmanager = ScreenManager()
         my_screenmanager.add_widget(InputPostcode(name='InputPostcode'))
-        my_screenmanager.add_widget(ShowBusStops(name='BusStops'))
+        # Load the lookups and their saved indexes in the background, so the first search is quick
+        self.background_tasks.submit("warm_up", self.warm_up)
         return my_screenmanager
+
+    # Get the map source shared by both maps, making it the first time
+    def get_map_source(self):
+        if self.map_source is None:
+            from map_widgets import CachedMapSource
+            self.map_source = CachedMapSource(self.tile_cache)
+        return self.map_source
+
+    # Runs in the background
+    def warm_up(self):
+        from warm_up import warm_up_lookups
+        warm_up_lookups()
+
+    def on_stop(self):
+        self.background_tasks.shutdown()
+        self.tile_cache.close()
+        # Save what was measured, if instrumentation was switched on
+        instrumentation = get_instrumentation()
+        if instrumentation.enabled:
+            instrumentation.write_metrics()
+        instrumentation.close()
     
 if __name__ == "__main__":
     BusTimetableApp().run()
\ No newline at end of file
@@ -0,0 +1,126 @@
+from kivy.app import App
+from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.label import Label
+from kivy.uix.button import Button
+from kivy.clock import Clock
+from kivy_garden.mapview import MapMarker, MapMarkerPopup, MapSource
+from kivy_garden.mapview.downloader import Downloader
+from marker_clusters import find_visible_stops, cluster_stops
+
+# Map widgets are kept apart from main.py, as loading mapview also loads requests. They are only
+# imported once the first map is made, so the app's window opens without waiting for them
+
+# Map source which loads tiles through the tile cache, so tiles seen before are shown without the internet
+class CachedMapSource(MapSource):
+    def __init__(self, tile_cache, **kwargs):
+        super().__init__(url=tile_cache.url, cache_key="tile_cache", subdomains="a", **kwargs)
+        self.tile_cache = tile_cache
+
+    def fill_tile(self, tile):
+        if tile.state == "done":
+            return
+        # Load on the map's download threads, which pass the result back to the UI thread
+        Downloader.instance(cache_dir=self.cache_dir).submit(self.load_tile, tile)
+
+    def load_tile(self, tile):
+        if tile.state == "done":
+            return None
+        # The map counts tile rows from the bottom, but the tile server counts them from the top
+        tile_y = self.get_row_count(tile.zoom) - tile.tile_y - 1
+        path = self.tile_cache.fetch(tile.zoom, tile.tile_x, tile_y)
+        if path is None:
+            return None # Tile could not be downloaded
+        return tile.set_source, (path,)
+
+class BusStopMarkerPopup(MapMarkerPopup):
+    def __init__(self, stop_data, **kwargs):
+        super().__init__(**kwargs) # Inherit all methods and attributes from MapMarkerPopup class
+        self.stop_data = stop_data # Initialise stop data
+
+    def on_is_open(self, *args):
+        # The popup content is only made the first time the marker is tapped
+        if self.is_open and self.placeholder is None:
+            self.build_popup()
+        super().on_is_open(*args)
+
+    def build_popup(self):
+        # Create the popup content layout
+        popup_layout = BoxLayout(orientation="vertical", size_hint=(None, None), size=(200, 100))
+
+        # Add a label for the bus stop name
+        title_label = Label(text=self.stop_data['name'], size_hint=(1, 0.7), outline_width = 2)
+        popup_layout.add_widget(title_label)
+
+        # Add a button to view the timetable
+        view_button = Button(text="View Timetable", 
+                                 size_hint=(1, 0.3), 
+                                 background_normal='', # Gets rid of default dark shade
+                                 background_color=(4/255, 76/255, 54/255, 1), # Green 'Surrey' colour
+                                 )
+        # Set button so when pressed, gives stop data to function
+        view_button.bind(on_press=self.view_timetable)
+        popup_layout.add_widget(view_button)
+
+        # Set the popup content
+        self.add_widget(popup_layout)  
+
+    def view_timetable(self, instance):
+        # Timetable is found in the background by the bus stops screen
+        App.get_running_app().root.get_screen("BusStops").load_timetable(self.stop_data)
+        #print(self.stop_data)
+
+# Marker standing for several bus stops close together, showing how many there are
+class ClusterMarker(MapMarker):
+    def __init__(self, stop_count, **kwargs):
+        super().__init__(**kwargs)
+        self.count_label = Label(text=str(stop_count), bold=True, outline_width = 2)
+        self.bind(pos=self.count_label.setter("pos"), size=self.count_label.setter("size"))
+        self.add_widget(self.count_label)
+
+# Shows bus stop markers on a map. Only markers inside the part of the map being looked at are added,
+# and stops close together are shown as one marker when zoomed out
+class BusStopMarkerLayer:
+    def __init__(self, map_view):
+        self.map_view = map_view
+        self.bus_stops = []
+        self.stop_markers = {} # {ATCO code: marker} of stops of the current search which have been made
+        self.shown_markers = [] # Markers currently on the map
+
+        # Update the markers at most once per frame when the map is moved or zoomed
+        self.update_trigger = Clock.create_trigger(self.update_markers)
+        self.map_view.bind(on_map_relocated=lambda *args: self.update_trigger(), zoom=lambda *args: self.update_trigger())
+
+    def set_bus_stops(self, bus_stops):
+        self.bus_stops = bus_stops
+        self.stop_markers = {} # Markers of the previous search are no longer needed
+        self.update_trigger()
+
+    def update_markers(self, *args):
+        # Stops inside the map, plus a border so markers are ready before they are dragged into view
+        visible_stops = find_visible_stops(self.bus_stops, self.map_view.get_bbox(margin=100))
+
+        markers = []
+        for latitude, longitude, stops in cluster_stops(visible_stops, self.map_view.zoom):
+            if len(stops) == 1:
+                # Reuse the stop's marker if it has already been made
+                atco_code = stops[0]["atco_code"]
+                if atco_code not in self.stop_markers:
+                    self.stop_markers[atco_code] = BusStopMarkerPopup(stop_data=stops[0], lat=latitude, lon=longitude)
+                markers.append(self.stop_markers[atco_code])
+            else:
+                cluster_marker = ClusterMarker(len(stops), lat=latitude, lon=longitude)
+                cluster_marker.bind(on_release=self.zoom_into_cluster)
+                markers.append(cluster_marker)
+
+        # Swap the markers on the map for the new ones, leaving markers which are still needed
+        for marker in self.shown_markers:
+            if marker not in markers:
+                self.map_view.remove_marker(marker)
+        for marker in markers:
+            if marker.parent is None:
+                self.map_view.add_marker(marker)
+        self.shown_markers = markers
+
+    def zoom_into_cluster(self, cluster_marker):
+        self.map_view.zoom = min(self.map_view.zoom + 2, self.map_view.map_source.get_max_zoom())
+        self.map_view.center_on(cluster_marker.lat, cluster_marker.lon)
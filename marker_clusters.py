@@ -0,0 +1,35 @@
+import math
+
+# Zoom level from which every bus stop gets its own marker
+CLUSTER_ZOOM = 15
+# Width in pixels of the squares that nearby stops are grouped into below CLUSTER_ZOOM
+CLUSTER_CELL_PIXELS = 80
+# Width in pixels of a map tile, which is the whole world at zoom 0
+TILE_SIZE = 256
+
+# Get the stops within a bounding box of (lowest latitude, lowest longitude, highest latitude, highest longitude)
+def find_visible_stops(stops, bbox):
+    lat_min, lon_min, lat_max, lon_max = bbox
+    return [stop for stop in stops
+            if lat_min <= stop["latitude"] <= lat_max and lon_min <= stop["longitude"] <= lon_max]
+
+# Group stops which would be drawn close together at a zoom level. Returns
+# [(latitude, longitude, stops)], with single stops in groups of their own
+def cluster_stops(stops, zoom):
+    if zoom >= CLUSTER_ZOOM:
+        return [(stop["latitude"], stop["longitude"], [stop]) for stop in stops]
+
+    # Size in degrees of a square CLUSTER_CELL_PIXELS wide at this zoom level
+    cell_size = CLUSTER_CELL_PIXELS * 360 / (TILE_SIZE * 2 ** zoom)
+    cells = {} # {(row, column): stops in the square}
+    for stop in stops:
+        cell = (math.floor(stop["latitude"] / cell_size), math.floor(stop["longitude"] / cell_size))
+        cells.setdefault(cell, []).append(stop)
+
+    # Place each group in the middle of its stops
+    clusters = []
+    for cell_stops in cells.values():
+        latitude = sum(stop["latitude"] for stop in cell_stops) / len(cell_stops)
+        longitude = sum(stop["longitude"] for stop in cell_stops) / len(cell_stops)
+        clusters.append((latitude, longitude, cell_stops))
+    return clusters
@@ -0,0 +1,232 @@
+from datetime import date, timedelta
+import lxml.etree as ET
+
+# Days of the week a journey can run on, as bits from Monday (bit 0) to Sunday (bit 6)
+EVERY_DAY = 0b1111111
+DAYS_OF_WEEK = {
+    "Monday": 0b0000001, "Tuesday": 0b0000010, "Wednesday": 0b0000100, "Thursday": 0b0001000,
+    "Friday": 0b0010000, "Saturday": 0b0100000, "Sunday": 0b1000000,
+    "MondayToFriday": 0b0011111, "MondayToSaturday": 0b0111111, "MondayToSunday": EVERY_DAY,
+    "Weekend": 0b1100000,
+    "NotMonday": EVERY_DAY & ~0b0000001, "NotTuesday": EVERY_DAY & ~0b0000010, "NotWednesday": EVERY_DAY & ~0b0000100,
+    "NotThursday": EVERY_DAY & ~0b0001000, "NotFriday": EVERY_DAY & ~0b0010000, "NotSaturday": EVERY_DAY & ~0b0100000,
+    "NotSunday": EVERY_DAY & ~0b1000000,
+}
+
+# TransXChange names which stand for several bank holidays at once
+HOLIDAY_GROUPS = {
+    "AllBankHolidays": {"ChristmasDay", "BoxingDay", "GoodFriday", "NewYearsDay", "LateSummerBankHolidayNotScotland",
+                        "MayDay", "EasterMonday", "SpringBank", "ChristmasDayHoliday", "BoxingDayHoliday", "NewYearsDayHoliday"},
+    "AllHolidaysExceptChristmas": {"GoodFriday", "NewYearsDay", "LateSummerBankHolidayNotScotland", "MayDay",
+                                   "EasterMonday", "SpringBank", "NewYearsDayHoliday"},
+    "Christmas": {"ChristmasDay", "BoxingDay"},
+    "DisplacementHolidays": {"ChristmasDayHoliday", "BoxingDayHoliday", "NewYearsDayHoliday"},
+    "EarlyRunOff": {"ChristmasEve", "NewYearsEve"},
+    "HolidayMondays": {"EasterMonday", "MayDay", "SpringBank", "LateSummerBankHolidayNotScotland"},
+}
+
+# Number of days worked out at once for each calendar, starting a little before the first day asked for
+BITMAP_DAYS = 400
+BITMAP_MARGIN = 7
+
+# Find Easter Sunday of a year (anonymous Gregorian algorithm)
+def get_easter_sunday(year):
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+# Find the first or last given weekday (0 is Monday) of a month
+def get_first_weekday(year, month, weekday):
+    first_day = date(year, month, 1)
+    return first_day + timedelta(days=(weekday - first_day.weekday()) % 7)
+
+def get_last_weekday(year, month, weekday):
+    last_day = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+    return last_day - timedelta(days=(last_day.weekday() - weekday) % 7)
+
+# Keep bank holidays already worked out for each year
+bank_holidays_by_year = {}
+
+# Get {date: set of TransXChange holiday names} of the bank holidays in England in a year
+def get_bank_holidays(year):
+    if year in bank_holidays_by_year:
+        return bank_holidays_by_year[year]
+
+    easter_sunday = get_easter_sunday(year)
+    holidays = {
+        "NewYearsDay": date(year, 1, 1),
+        "GoodFriday": easter_sunday - timedelta(days=2),
+        "EasterMonday": easter_sunday + timedelta(days=1),
+        "MayDay": get_first_weekday(year, 5, 0),
+        "SpringBank": get_last_weekday(year, 5, 0),
+        "LateSummerBankHolidayNotScotland": get_last_weekday(year, 8, 0),
+        "ChristmasEve": date(year, 12, 24),
+        "ChristmasDay": date(year, 12, 25),
+        "BoxingDay": date(year, 12, 26),
+        "NewYearsEve": date(year, 12, 31),
+    }
+
+    # Holidays falling on a weekend are given a day off on the next weekday instead
+    new_years_day = holidays["NewYearsDay"]
+    if new_years_day.weekday() >= 5:
+        holidays["NewYearsDayHoliday"] = new_years_day + timedelta(days=7 - new_years_day.weekday())
+    christmas_day_weekday = holidays["ChristmasDay"].weekday()
+    if christmas_day_weekday == 5: # Saturday: both days off move to Monday and Tuesday
+        holidays["ChristmasDayHoliday"] = date(year, 12, 27)
+        holidays["BoxingDayHoliday"] = date(year, 12, 28)
+    elif christmas_day_weekday == 6: # Sunday: Boxing Day is already on Monday
+        holidays["ChristmasDayHoliday"] = date(year, 12, 27)
+    elif christmas_day_weekday == 4: # Friday: Boxing Day is on Saturday
+        holidays["BoxingDayHoliday"] = date(year, 12, 28)
+
+    bank_holidays = {}
+    for name, holiday in holidays.items():
+        bank_holidays.setdefault(holiday, set()).add(name)
+    bank_holidays_by_year[year] = bank_holidays
+    return bank_holidays
+
+# Get the local name of each child of an element, e.g. "MondayToFriday"
+def get_child_names(element):
+    if element is None:
+        return []
+    return [ET.QName(child).localname for child in element if isinstance(child.tag, str)]
+
+# Get (start date, end date) of each DateRange under an element, as ISO format strings
+def get_date_ranges(element, namespace):
+    if element is None:
+        return ()
+    date_ranges = []
+    for date_range in element.iterfind('ns:DateRange', namespaces=namespace):
+        start_date = (date_range.findtext('ns:StartDate', namespaces=namespace) or "").strip()
+        end_date = (date_range.findtext('ns:EndDate', namespaces=namespace) or "").strip() or start_date
+        if not start_date:
+            continue # Date ranges without a start date are left out, rather than losing the whole file
+        date_ranges.append((start_date, end_date))
+    # Other public holidays are given as a single date
+    for holiday in element.iterfind('ns:OtherPublicHoliday', namespaces=namespace):
+        holiday_date = holiday.findtext('ns:Date', namespaces=namespace)
+        if holiday_date:
+            date_ranges.append((holiday_date.strip(), holiday_date.strip()))
+    return tuple(sorted(date_ranges))
+
+# Get the named bank holidays under an element, with groups such as AllBankHolidays expanded
+def get_holiday_names(element):
+    names = set()
+    for name in get_child_names(element):
+        if name == "OtherPublicHoliday":
+            continue # Dates of these are read by get_date_ranges
+        names |= HOLIDAY_GROUPS.get(name, {name})
+    return tuple(sorted(names))
+
+# Read an OperatingProfile element into a tuple which can be compared and stored:
+# (days of week, holidays only, bank holidays of operation, bank holidays of non-operation,
+#  dates of operation, dates of non-operation). Returns None if there is no OperatingProfile
+def parse_operating_profile(operating_profile, namespace):
+    if operating_profile is None:
+        return None
+
+    days_of_week = EVERY_DAY
+    holidays_only = False
+    regular_day_type = operating_profile.find('ns:RegularDayType', namespaces=namespace)
+    if regular_day_type is not None:
+        holidays_only = regular_day_type.find('ns:HolidaysOnly', namespaces=namespace) is not None
+        day_names = get_child_names(regular_day_type.find('ns:DaysOfWeek', namespaces=namespace))
+        if day_names:
+            days_of_week = 0
+            for day_name in day_names:
+                days_of_week |= DAYS_OF_WEEK.get(day_name, 0)
+
+    special_days = operating_profile.find('ns:SpecialDaysOperation', namespaces=namespace)
+    bank_holidays = operating_profile.find('ns:BankHolidayOperation', namespaces=namespace)
+    return (days_of_week, holidays_only,
+            get_holiday_names(bank_holidays.find('ns:DaysOfOperation', namespaces=namespace)) if bank_holidays is not None else (),
+            get_holiday_names(bank_holidays.find('ns:DaysOfNonOperation', namespaces=namespace)) if bank_holidays is not None else (),
+            get_date_ranges(special_days.find('ns:DaysOfOperation', namespaces=namespace), namespace) if special_days is not None else (),
+            get_date_ranges(special_days.find('ns:DaysOfNonOperation', namespaces=namespace), namespace) if special_days is not None else ())
+
+# Read an OperatingPeriod element into (start date, end date) as ISO format strings, either of which may be None
+def parse_operating_period(operating_period, namespace):
+    if operating_period is None:
+        return (None, None)
+    start_date = operating_period.findtext('ns:StartDate', namespaces=namespace)
+    end_date = operating_period.findtext('ns:EndDate', namespaces=namespace)
+    return (start_date.strip() if start_date else None, end_date.strip() if end_date else None)
+
+# Days on which a set of journeys run, from their operating profile and the service's operating period
+class OperatingCalendar:
+    # (first day, bits) of the days worked out in advance, where bit n is set if the journeys run on the nth day
+    # after the first. Calendars are shared between threads, so both are kept in one attribute and replaced
+    # together, and a reader never sees the first day of a new bitmap with the bits of the old one
+    day_bitmap = None
+
+    def __init__(self, operating_profile, operating_period):
+        # Journeys with no operating profile run every day
+        if operating_profile is None:
+            operating_profile = (EVERY_DAY, False, (), (), (), ())
+        (self.days_of_week, self.holidays_only, operation_holidays, non_operation_holidays,
+         operation_dates, non_operation_dates) = operating_profile
+        # Identifies calendars with the same days, also when read back from JSON as lists
+        self.key = ((self.days_of_week, bool(self.holidays_only), tuple(operation_holidays), tuple(non_operation_holidays),
+                     tuple(tuple(date_range) for date_range in operation_dates),
+                     tuple(tuple(date_range) for date_range in non_operation_dates)),
+                    tuple(operating_period))
+        self.operation_holidays = set(operation_holidays)
+        self.non_operation_holidays = set(non_operation_holidays)
+        self.operation_dates = [(date.fromisoformat(start), date.fromisoformat(end)) for start, end in operation_dates]
+        self.non_operation_dates = [(date.fromisoformat(start), date.fromisoformat(end)) for start, end in non_operation_dates]
+        start_date, end_date = operating_period
+        self.start_date = date.fromisoformat(start_date) if start_date else None
+        self.end_date = date.fromisoformat(end_date) if end_date else None
+
+    # Work out whether the journeys run on a day, following the rules in order of priority
+    def operates_on(self, day):
+        if self.start_date is not None and day < self.start_date:
+            return False
+        if self.end_date is not None and day > self.end_date:
+            return False
+
+        # Special days take priority over everything else
+        if any(start <= day <= end for start, end in self.non_operation_dates):
+            return False
+        if any(start <= day <= end for start, end in self.operation_dates):
+            return True
+
+        # Then bank holidays
+        holiday_names = get_bank_holidays(day.year).get(day, set())
+        if holiday_names & self.non_operation_holidays:
+            return False
+        if holiday_names & self.operation_holidays:
+            return True
+        if self.holidays_only:
+            return False
+
+        # Otherwise the usual days of the week
+        return bool(self.days_of_week >> day.weekday() & 1)
+
+    # Work out the days the journeys run on from bitmap_start onwards, returning the new (first day, bits)
+    def build_bitmap(self, bitmap_start):
+        bitmap = 0
+        for offset in range(BITMAP_DAYS):
+            if self.operates_on(bitmap_start + timedelta(days=offset)):
+                bitmap |= 1 << offset
+        # Only replaced once finished, so other threads carry on using the old bitmap until then
+        self.day_bitmap = (bitmap_start, bitmap)
+        return self.day_bitmap
+
+    # Check whether the journeys run on a day, using the bitmap of days worked out in advance
+    def runs_on(self, day):
+        # Read once, as another thread may replace it
+        day_bitmap = self.day_bitmap
+        offset = (day - day_bitmap[0]).days if day_bitmap is not None else -1
+        if not 0 <= offset < BITMAP_DAYS:
+            day_bitmap = self.build_bitmap(day - timedelta(days=BITMAP_MARGIN))
+            offset = BITMAP_MARGIN
+        return bool(day_bitmap[1] >> offset & 1)
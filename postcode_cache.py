@@ -0,0 +1,139 @@
+import sqlite3
+from array import array
+from bisect import bisect_left
+import pickle
+import threading
+import time
+import csv
+import sys
+import re
+import os
+
+# Shape of a UK postcode, e.g. GU1 1AA or SW1A 1AA
+POSTCODE_PATTERN = re.compile(r"^([A-Z]{1,2}[0-9][A-Z0-9]?)([0-9][A-Z]{2})$")
+
+# Tidy up a postcode typed by the user into the form "GU1 1AA", or None if it is not a valid postcode
+def normalise_postcode(postcode):
+    if postcode is None:
+        return None
+    postcode = "".join(postcode.split()).upper() # Remove all spaces
+    match = POSTCODE_PATTERN.match(postcode)
+    if match is None:
+        return None
+    return f"{match.group(1)} {match.group(2)}"
+
+class PostcodeCache:
+    def __init__(self, cache_path="postcode_cache.db", ttl=None, not_found_ttl=None):
+        self.cache_path = cache_path
+        # How many seconds to keep postcodes which were found (30 days) and not found (1 day) unless set otherwise
+        self.ttl = ttl if ttl is not None else float(os.getenv("POSTCODE_CACHE_TTL", 30 * 86400))
+        self.not_found_ttl = not_found_ttl if not_found_ttl is not None else float(os.getenv("POSTCODE_NOT_FOUND_TTL", 86400))
+
+        self.connection = sqlite3.connect(self.cache_path)
+        with self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS postcodes
+                                       (postcode TEXT PRIMARY KEY, is_found INTEGER, lat REAL, lon REAL, county TEXT, fetched_at REAL)""")
+
+    # Get a cached postcode as {"is_found", "lat", "lon", "county"}, or None if it is not cached or too old
+    def get(self, postcode):
+        row = self.connection.execute("SELECT is_found, lat, lon, county, fetched_at FROM postcodes WHERE postcode = ?", (postcode,)).fetchone()
+        if row is None:
+            return None
+        is_found, lat, lon, county, fetched_at = row
+        ttl = self.ttl if is_found else self.not_found_ttl
+        if time.time() - fetched_at >= ttl:
+            return None
+        return {"is_found": bool(is_found), "lat": lat, "lon": lon, "county": county}
+
+    def put_found(self, postcode, lat, lon, county):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO postcodes VALUES (?, 1, ?, ?, ?, ?)", (postcode, lat, lon, county, time.time()))
+
+    # Remember postcodes which do not exist, so they are not looked up again straight away
+    def put_not_found(self, postcode):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO postcodes VALUES (?, 0, NULL, NULL, NULL, ?)", (postcode, time.time()))
+
+    def close(self):
+        self.connection.close()
+
+class OfflinePostcodes:
+    def __init__(self):
+        self.source = None # (path, modification time, size) of the table this was compiled from
+        # Sorted postcodes, with the same position in each list referring to the same postcode
+        self.postcodes = []
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.counties = []
+
+    # Read a bulk postcode table, such as an ONS Postcode Directory extract, from a CSV file
+    def compile(self, csv_path, postcode_column="pcds", lat_column="lat", lon_column="long", county_column="oscty"):
+        csv_stat = os.stat(csv_path)
+        self.source = (csv_path, csv_stat.st_mtime_ns, csv_stat.st_size)
+
+        rows = []
+        with open(csv_path, "r", newline="", encoding="utf-8-sig") as csv_file:
+            for row in csv.DictReader(csv_file):
+                postcode = normalise_postcode(row[postcode_column])
+                try:
+                    lat = float(row[lat_column])
+                    lon = float(row[lon_column])
+                except (TypeError, ValueError):
+                    continue
+                # Postcodes with no known location are given a latitude of 99.999999
+                if postcode is None or abs(lat) > 90:
+                    continue
+                rows.append((postcode, lat, lon, sys.intern(row[county_column])))
+        rows.sort()
+
+        for postcode, lat, lon, county in rows:
+            self.postcodes.append(postcode)
+            self.latitudes.append(lat)
+            self.longitudes.append(lon)
+            self.counties.append(county)
+
+    # Get a postcode as {"is_found", "lat", "lon", "county"}
+    def get(self, postcode):
+        position = bisect_left(self.postcodes, postcode)
+        if position == len(self.postcodes) or self.postcodes[position] != postcode:
+            return {"is_found": False, "lat": None, "lon": None, "county": None}
+        return {"is_found": True, "lat": self.latitudes[position], "lon": self.longitudes[position], "county": self.counties[position]}
+
+# Keep the offline table in memory between searches
+loaded_offline_postcodes = None
+# Searches and the warm up at startup run on different threads, so only one loads the table at a time
+loaded_offline_postcodes_lock = threading.Lock()
+
+# Get the offline postcode table, compiling it only if the CSV file has changed.
+# Returns None if no offline table has been set up
+def load_offline_postcodes(csv_path=None, store_path="postcodes_offline.pickle"):
+    global loaded_offline_postcodes
+    with loaded_offline_postcodes_lock:
+        csv_path = csv_path if csv_path is not None else os.getenv("OFFLINE_POSTCODES")
+        if not csv_path or not os.path.exists(csv_path):
+            return None
+        csv_stat = os.stat(csv_path)
+        source = (csv_path, csv_stat.st_mtime_ns, csv_stat.st_size)
+
+        # Table already in memory
+        if loaded_offline_postcodes is not None and loaded_offline_postcodes.source == source:
+            return loaded_offline_postcodes
+
+        # Table saved on disk from a previous run
+        if os.path.exists(store_path):
+            try:
+                with open(store_path, "rb") as store_file:
+                    offline_postcodes = pickle.load(store_file)
+                if offline_postcodes.source == source:
+                    loaded_offline_postcodes = offline_postcodes
+                    return offline_postcodes
+            except (pickle.UnpicklingError, EOFError, AttributeError):
+                pass # Compile the table again if the store cannot be read
+
+        offline_postcodes = OfflinePostcodes()
+        offline_postcodes.compile(csv_path)
+        with open(store_path + ".tmp", "wb") as store_file:
+            pickle.dump(offline_postcodes, store_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(store_path + ".tmp", store_path)
+        loaded_offline_postcodes = offline_postcodes
+        return offline_postcodes
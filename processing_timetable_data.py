@@ -1,12 +1,42 @@
 import lxml.etree as ET
-from datetime import datetime, timedelta
+from array import array
+from itertools import accumulate
 import isodate
-from collections import defaultdict
+import re
+from io import BytesIO
+from timetable_model import TIME_TYPECODE, parse_time_of_day
+from operating_calendar import OperatingCalendar, parse_operating_profile, parse_operating_period
+from instrumentation import span, count
+
+# Matches the usual form of TransXChange durations, e.g. "PT2M30S", so they can be converted without isodate
+DURATION_PATTERN = re.compile(r"PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?")
+
+# {duration: seconds} of durations already converted, as files use the same few run times over and over
+duration_seconds = {}
+
+# Convert an ISO 8601 duration such as "PT2M30S" to a number of seconds
+def parse_duration_seconds(duration):
+    seconds = duration_seconds.get(duration)
+    if seconds is None:
+        match = DURATION_PATTERN.fullmatch(duration)
+        if match is not None and duration != "PT":
+            hours, minutes, seconds = (int(part) if part else 0 for part in match.groups())
+            seconds = hours * 3600 + minutes * 60 + seconds
+        else:
+            # Anything else, such as days or fractions of a second, is left to isodate
+            seconds = isodate.parse_duration(duration).total_seconds()
+            if seconds.is_integer():
+                seconds = int(seconds)
+        duration_seconds[duration] = seconds
+    return seconds
 
 class ProcessData:
     def __init__(self, file_contents, target_atco_code):
         # Parse the XML content using lxml
-        self.root = ET.fromstring(file_contents)
+        with span("process_data.parse"):
+            self.root = ET.fromstring(file_contents)
+        count("files_parsed")
+        count("bytes_parsed", len(file_contents))
 
         # Define the namespace mapping
         self.namespace = {'ns': 'http://www.transxchange.org.uk/'}
@@ -27,64 +57,303 @@ class ProcessData:
         # and return 'True' if found, otherwise 'False'
         return any(stop.text == self.target_atco_code for stop in stop_refs)
     
-    def find_arrival_times_by_destination(self):
-        # Initialise dictionary to collect arrival times and destination(s) for each bus line
-        arrival_times_by_destination = defaultdict(list)
+    # Function to look up journey patterns and sections by id without searching the whole document each time
+    def build_journey_pattern_maps(self):
+        # {id: element} for each JourneyPattern and JourneyPatternSection
+        self.journey_patterns = {}
+        self.journey_pattern_sections = {}
+
+        # Walk the document once, picking out both kinds of element
+        journey_pattern_tag = f"{{{self.namespace['ns']}}}JourneyPattern"
+        section_tag = f"{{{self.namespace['ns']}}}JourneyPatternSection"
+        for element in self.root.iter(journey_pattern_tag, section_tag):
+            # Keep the first element with each id, like the XPath search did
+            if element.tag == journey_pattern_tag:
+                self.journey_patterns.setdefault(element.get('id'), element)
+            else:
+                self.journey_pattern_sections.setdefault(element.get('id'), element)
+
+        # Keep track of journey patterns already worked out, as many journeys share the same pattern
+        self.pattern_offsets = {}
+
+        # Days the service runs on, used by journeys which do not give their own
+        service = self.root.find('.//ns:Service', namespaces=self.namespace)
+        self.service_operating_profile = parse_operating_profile(
+            service.find('ns:OperatingProfile', namespaces=self.namespace) if service is not None else None, self.namespace)
+        self.service_operating_period = parse_operating_period(
+            service.find('ns:OperatingPeriod', namespaces=self.namespace) if service is not None else None, self.namespace)
+        self.calendars = [] # Calendars of the journeys, referred to by position
+        self.calendar_ids = {}
+
+    # Function to get the position in self.calendars of the calendar of a journey with this operating profile
+    def get_calendar_id(self, operating_profile):
+        if operating_profile is None:
+            operating_profile = self.service_operating_profile
+        key = (operating_profile, self.service_operating_period)
+        if key not in self.calendar_ids:
+            self.calendar_ids[key] = len(self.calendars)
+            self.calendars.append(OperatingCalendar(operating_profile, self.service_operating_period))
+        return self.calendar_ids[key]
+
+    # Function to get (departure time, JourneyPatternRef, calendar position) of every vehicle journey
+    def get_vehicle_journeys(self):
+        for vehicle_journey in self.root.xpath('//ns:VehicleJourney', namespaces=self.namespace):
+            departure_time = vehicle_journey.find('ns:DepartureTime', namespaces=self.namespace).text
+            journey_pattern_ref = vehicle_journey.find('ns:JourneyPatternRef', namespaces=self.namespace).text
+            operating_profile = parse_operating_profile(vehicle_journey.find('ns:OperatingProfile', namespaces=self.namespace), self.namespace)
+            yield departure_time, journey_pattern_ref, self.get_calendar_id(operating_profile)
+
+    # Function to get the destination and JourneyPatternSectionRefs of a journey pattern
+    def get_journey_pattern(self, journey_pattern_ref):
+        # Find the associated JourneyPattern using JourneyPatternRef
+        journey_pattern = self.journey_patterns[journey_pattern_ref]
+
+        # Find the destination name
+        destination = journey_pattern.xpath('.//ns:DestinationDisplay', namespaces=self.namespace)[0].text.strip()
 
+        # Find the JourneyPatternSectionRefs
+        section_refs = [section_ref.text for section_ref in journey_pattern.xpath('.//ns:JourneyPatternSectionRefs', namespaces=self.namespace)]
+        return destination, section_refs
+
+    # Function to get (from stop, run time, wait at from stop, wait at to stop) of every timing link in a
+    # journey pattern section. Wait times are None if not given
+    def get_timing_links(self, section_id):
+        section = self.journey_pattern_sections[section_id]
+        timing_links = []
+        for timing_link in section.xpath('.//ns:JourneyPatternTimingLink', namespaces=self.namespace):
+            from_stop_ref = timing_link.find('ns:From/ns:StopPointRef', namespaces=self.namespace).text
+            run_time = timing_link.find('ns:RunTime', namespaces=self.namespace).text
+            timing_links.append((from_stop_ref, run_time,
+                                 timing_link.findtext('ns:From/ns:WaitTime', namespaces=self.namespace),
+                                 timing_link.findtext('ns:To/ns:WaitTime', namespaces=self.namespace)))
+        return timing_links
+
+    # Function to get the destination and the time offsets of every stop in a journey pattern
+    def get_journey_pattern_offsets(self, journey_pattern_ref):
+        # Reuse the offsets if this journey pattern has already been worked out
+        if journey_pattern_ref in self.pattern_offsets:
+            return self.pattern_offsets[journey_pattern_ref]
+
+        destination, section_refs = self.get_journey_pattern(journey_pattern_ref)
+
+        # For each section, store the total run time and, for the first time each stop appears,
+        # the run time before it and the run time up to and including its timing link
+        sections = []
+        for section_ref in section_refs:
+            timing_links = self.get_timing_links(section_ref)
+
+            # Time taken by each link: any wait at its From stop, then its run time. A wait at a stop can be given
+            # on the link leaving the stop or the link arriving at it, so the arriving link's is used if needed
+            link_seconds = []
+            arriving_wait_time = None
+            for _, run_time, from_wait_time, to_wait_time in timing_links:
+                wait_time = from_wait_time if from_wait_time is not None else arriving_wait_time
+                link_seconds.append((parse_duration_seconds(wait_time) if wait_time else 0) + parse_duration_seconds(run_time))
+                arriving_wait_time = to_wait_time
+            # Run time up to the end of each link
+            link_ends = list(accumulate(link_seconds))
+
+            first_stops = {} # {ATCO code: (run time before stop, run time including stop's link)}
+            for position, timing_link in enumerate(timing_links):
+                if timing_link[0] not in first_stops:
+                    first_stops[timing_link[0]] = (link_ends[position] - link_seconds[position], link_ends[position])
+            # The section lasts until the end of its last link, and any wait at its last stop
+            section_offset = (link_ends[-1] if link_ends else 0) + (parse_duration_seconds(arriving_wait_time) if arriving_wait_time else 0)
+            sections.append((section_offset, first_stops))
+
+        # Work out the offsets of each stop. Once a stop is found in a section, the time carries on into the
+        # next section from just before the stop, as find_arrival_times_by_destination has always done
+        stop_offsets = {} # {ATCO code: [seconds after departure]}
+        for _, first_stops in sections:
+            for atco_code in first_stops:
+                if atco_code in stop_offsets:
+                    continue # Offsets of this stop already worked out
+                stop_offsets[atco_code] = []
+                current_offset = 0
+                for section_offset, section_stops in sections:
+                    if atco_code in section_stops:
+                        offset_before, offset_including = section_stops[atco_code]
+                        stop_offsets[atco_code].append(current_offset + offset_including)
+                        current_offset += offset_before
+                    else:
+                        current_offset += section_offset
+
+        self.pattern_offsets[journey_pattern_ref] = (destination, stop_offsets)
+        return destination, stop_offsets
+
+    # Function to get {destination: (arrival times in seconds since midnight, calendar positions)} at the target stop.
+    # The calendars are in self.calendars
+    def find_arrival_times_by_destination(self):
         # Check if stop is in the file - if not, return empty list
         if not self.is_atco_code_there():
             return []
-        
+
         # If the file does not match the expected structure, return empty list
         try:
-            # Find all VehicleJourney elements
-            vehicle_journeys = self.root.xpath('//ns:VehicleJourney', namespaces=self.namespace)
+            self.build_journey_pattern_maps()
+            return self.get_arrival_times({self.target_atco_code}).get(self.target_atco_code, {})
+        except:
+            return []
 
-            # Loop through all vehicle journeys to extract data
-            for vehicle_journey in vehicle_journeys:
-                departure_time = vehicle_journey.find('ns:DepartureTime', namespaces=self.namespace).text
-                journey_pattern_ref = vehicle_journey.find('ns:JourneyPatternRef', namespaces=self.namespace).text
+    # Function to get arrival times at every stop in the file in one go
+    def find_arrival_times_for_all_stops(self):
+        # If the file does not match the expected structure, return empty dictionary
+        try:
+            self.build_journey_pattern_maps()
+            return self.get_arrival_times()
+        except:
+            return {}
 
-                # Convert departure time to a datetime object
-                current_time = datetime.strptime(departure_time, '%H:%M:%S')
+    # Function to get {ATCO code: {destination: (arrival times in seconds since midnight, calendar positions)}}
+    # of the given stops, or every stop if none are given. Arrival times are in the order of the journeys in the file
+    def get_arrival_times(self, atco_codes=None):
+        # Put the journeys into columns by journey pattern: (positions in the file, departure times, calendars)
+        journeys_by_pattern = {}
+        departure_seconds = {} # Departure times already converted, as many journeys leave at the same time
+        for position, (departure_time, journey_pattern_ref, calendar_id) in enumerate(self.get_vehicle_journeys()):
+            journeys = journeys_by_pattern.get(journey_pattern_ref)
+            if journeys is None:
+                journeys = journeys_by_pattern[journey_pattern_ref] = ([], array(TIME_TYPECODE), array('I'))
+            seconds = departure_seconds.get(departure_time)
+            if seconds is None:
+                seconds = departure_seconds[departure_time] = parse_time_of_day(departure_time)
+            journeys[0].append(position)
+            journeys[1].append(seconds)
+            journeys[2].append(calendar_id)
 
-                # Find the associated JourneyPattern using JourneyPatternRef
-                journey_pattern = self.root.xpath(f"//ns:JourneyPattern[@id='{journey_pattern_ref}']", namespaces=self.namespace)
+        # Find which journey patterns pass each stop towards each destination, and how long after departing
+        stop_patterns = {} # {(ATCO code, destination): [(JourneyPatternRef, visit number, seconds after departure)]}
+        for journey_pattern_ref in journeys_by_pattern:
+            destination, stop_offsets = self.get_journey_pattern_offsets(journey_pattern_ref)
+            for atco_code, offsets in stop_offsets.items():
+                if atco_codes is not None and atco_code not in atco_codes:
+                    continue
+                for visit, offset in enumerate(offsets):
+                    stop_patterns.setdefault((atco_code, destination), []).append((journey_pattern_ref, visit, int(offset)))
 
-                # Find the destination name
-                destination = journey_pattern[0].xpath('.//ns:DestinationDisplay', namespaces=self.namespace)[0].text.strip()
+        # Work out whole columns of arrival times at once: the departure times of a pattern's journeys plus the stop's offset
+        arrival_times_by_stop = {}
+        for (atco_code, destination), patterns in stop_patterns.items():
+            if len(patterns) == 1:
+                journey_pattern_ref, _, offset = patterns[0]
+                _, departures, calendar_ids = journeys_by_pattern[journey_pattern_ref]
+                times = array(TIME_TYPECODE, [departure + offset for departure in departures])
+                calendar_ids = array('I', calendar_ids)
+                first_journey = journeys_by_pattern[journey_pattern_ref][0][0]
+            else:
+                # Several patterns (or visits) share the stop and destination, so put the columns back into journey order
+                visit_count = max(visit for _, visit, _ in patterns) + 1
+                arrivals = []
+                for journey_pattern_ref, visit, offset in patterns:
+                    positions, departures, pattern_calendar_ids = journeys_by_pattern[journey_pattern_ref]
+                    arrivals.extend(zip([position * visit_count + visit for position in positions],
+                                        [departure + offset for departure in departures], pattern_calendar_ids))
+                arrivals.sort()
+                times = array(TIME_TYPECODE, [arrival[1] for arrival in arrivals])
+                calendar_ids = array('I', [arrival[2] for arrival in arrivals])
+                first_journey = arrivals[0][0] // visit_count
+            arrival_times_by_stop.setdefault(atco_code, []).append((first_journey, destination, (times, calendar_ids)))
 
-                # Find the JourneyPatternSectionRefs
-                section_refs = journey_pattern[0].xpath('.//ns:JourneyPatternSectionRefs', namespaces=self.namespace)
+        # Destinations of each stop are in the order a journey first went to them
+        return {atco_code: {destination: arrival_times for _, destination, arrival_times in sorted(destinations, key=lambda item: item[0])}
+                for atco_code, destinations in arrival_times_by_stop.items()}
 
-                for section_ref in section_refs:
-                    section_id = section_ref.text
 
-                    # Find all the timing links in this section
-                    section = self.root.xpath(f"//ns:JourneyPatternSection[@id='{section_id}']", namespaces=self.namespace)
+# Reads TransXChange files one element at a time, keeping only the data needed for arrival times, so memory
+# use stays the same however big the file is. Gives the same results as ProcessData
+class StreamProcessData(ProcessData):
+    def __init__(self, file_contents, target_atco_code):
+        # Define the namespace mapping
+        self.namespace = {'ns': 'http://www.transxchange.org.uk/'}
+        self.target_atco_code = target_atco_code
+        self.root = None # No tree is kept
 
-                    timing_links = section[0].xpath('.//ns:JourneyPatternTimingLink', namespaces=self.namespace)
+        self.stop_refs = set() # Every StopPointRef in the file
+        self.line_numbers = [] # LineNames of the services
+        self.vehicle_journeys = [] # [(departure time, JourneyPatternRef, operating profile)]
+        self.is_service_read = False
+        self.service_operating_profile = None
+        self.service_operating_period = (None, None)
+        self.calendars = []
+        self.calendar_ids = {}
+        self.journey_patterns = {} # {id: (destination, JourneyPatternSectionRefs)}
+        self.journey_pattern_sections = {} # {id: [(from stop, run time, wait at from stop, wait at to stop)]}
+        self.pattern_offsets = {}
 
-                    # Loop through each timing link to get the stop times
-                    for timing_link in timing_links:
-                        from_stop_ref = timing_link.find('ns:From/ns:StopPointRef', namespaces=self.namespace).text
-                        run_time = timing_link.find('ns:RunTime', namespaces=self.namespace).text
+        # Accept either the file's contents or a path to the file
+        source = BytesIO(file_contents) if isinstance(file_contents, bytes) else file_contents
+        if not isinstance(file_contents, bytes):
+            count("files_opened")
+        with span("process_data.stream_parse"):
+            self.parse(source)
+        count("files_parsed")
 
-                        # Calculate the arrival time by adding the runtime to the current time
-                        seconds = isodate.parse_duration(run_time)
-                        arrival_time = current_time + timedelta(seconds=seconds.total_seconds())
+    def parse(self, source):
+        ns = self.namespace['ns']
+        tags = [f"{{{ns}}}StopPointRef", f"{{{ns}}}JourneyPatternSection", f"{{{ns}}}JourneyPattern",
+                f"{{{ns}}}VehicleJourney", f"{{{ns}}}Service"]
 
-                        # Check if desired stop is found
-                        if self.target_atco_code == from_stop_ref:
+        for _, element in ET.iterparse(source, events=("end",), tag=tags):
+            tag = ET.QName(element).localname
 
-                            # {destination: arrival times}
-                            arrival_times_by_destination[destination].append(arrival_time.strftime('%H:%M:%S'))        
-                            break # Move onto the next section reference
+            if tag == "StopPointRef":
+                self.stop_refs.add(element.text)
+                continue # Left in the tree, as its section still needs it
 
-                        # Update the current time for the next stop
-                        current_time = arrival_time
+            if tag == "JourneyPatternSection":
+                timing_links = []
+                for timing_link in element.iterfind('.//ns:JourneyPatternTimingLink', namespaces=self.namespace):
+                    timing_links.append((timing_link.findtext('ns:From/ns:StopPointRef', namespaces=self.namespace),
+                                         timing_link.findtext('ns:RunTime', namespaces=self.namespace),
+                                         timing_link.findtext('ns:From/ns:WaitTime', namespaces=self.namespace),
+                                         timing_link.findtext('ns:To/ns:WaitTime', namespaces=self.namespace)))
+                self.journey_pattern_sections.setdefault(element.get('id'), timing_links)
 
-        except:
-            return []
-        return arrival_times_by_destination
-    
+            elif tag == "JourneyPattern":
+                destination = element.find('.//ns:DestinationDisplay', namespaces=self.namespace)
+                section_refs = [section_ref.text for section_ref in element.iterfind('.//ns:JourneyPatternSectionRefs', namespaces=self.namespace)]
+                self.journey_patterns.setdefault(element.get('id'), (destination.text if destination is not None else None, section_refs))
+
+            elif tag == "VehicleJourney":
+                self.vehicle_journeys.append((element.findtext('ns:DepartureTime', namespaces=self.namespace),
+                                              element.findtext('ns:JourneyPatternRef', namespaces=self.namespace),
+                                              parse_operating_profile(element.find('ns:OperatingProfile', namespaces=self.namespace), self.namespace)))
+
+            elif tag == "Service":
+                # Operating days of the first service are used by journeys which do not give their own
+                if not self.is_service_read:
+                    self.is_service_read = True
+                    self.service_operating_profile = parse_operating_profile(element.find('ns:OperatingProfile', namespaces=self.namespace), self.namespace)
+                    self.service_operating_period = parse_operating_period(element.find('ns:OperatingPeriod', namespaces=self.namespace), self.namespace)
+                self.line_numbers.extend(line_name.text for line_name in element.iterfind('ns:Lines/ns:Line/ns:LineName', namespaces=self.namespace))
+
+            # Free the memory used by this element and anything before it
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    def get_line_number(self):
+        return self.line_numbers[0]
+
+    def is_atco_code_there(self):
+        return self.target_atco_code in self.stop_refs
+
+    # Patterns and sections are collected while parsing, so there is nothing to build
+    def build_journey_pattern_maps(self):
+        pass
+
+    def get_vehicle_journeys(self):
+        for departure_time, journey_pattern_ref, operating_profile in self.vehicle_journeys:
+            if departure_time is None or journey_pattern_ref is None:
+                raise ValueError("VehicleJourney is missing its DepartureTime or JourneyPatternRef")
+            yield departure_time, journey_pattern_ref, self.get_calendar_id(operating_profile)
+
+    def get_journey_pattern(self, journey_pattern_ref):
+        destination, section_refs = self.journey_patterns[journey_pattern_ref]
+        return destination.strip(), section_refs
+
+    def get_timing_links(self, section_id):
+        timing_links = self.journey_pattern_sections[section_id]
+        if any(from_stop_ref is None or run_time is None for from_stop_ref, run_time, _, _ in timing_links):
+            raise ValueError("JourneyPatternTimingLink is missing its From stop or RunTime")
+        return timing_links
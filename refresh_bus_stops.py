@@ -0,0 +1,110 @@
+import requests
+import hashlib
+import tempfile
+import json
+import time
+import os
+
+class RefreshBusStops:
+    def __init__(self, url="https://naptan.api.dft.gov.uk/v1/access-nodes?dataFormat=xml&atcoAreaCodes=400",
+                 file_path="400.xml", state_path="400_state.json", ttl=None, chunk_size=65536, timeout=30):
+        self.url = url
+        self.file_path = file_path
+        self.state_path = state_path # Stores ETag, Last-Modified, hash and time of last check
+        # How many seconds to wait before checking for new bus stop data, one day unless set otherwise
+        self.ttl = ttl if ttl is not None else float(os.getenv("BUS_STOPS_TTL", 86400))
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.state = self.load_state()
+        self.stops_hash = self.state.get("hash")
+        self.is_bus_stop_request = False
+        self.is_updated = False # Whether new data was downloaded
+
+    def load_state(self):
+        if not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path, "r") as state_file:
+                return json.load(state_file)
+        except (json.JSONDecodeError, OSError):
+            return {} # Start again if the state cannot be read
+
+    # Make a temporary file next to a path, with a name of its own, so several processes refreshing at the
+    # same time (e.g. the workers of the timetable service) never write to the same temporary file
+    def make_temporary_file(self, path):
+        return tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path) + ".", suffix=".tmp")
+
+    def save_state(self):
+        file_descriptor, temporary_path = self.make_temporary_file(self.state_path)
+        try:
+            with os.fdopen(file_descriptor, "w") as state_file:
+                json.dump(self.state, state_file, indent=4)
+            os.replace(temporary_path, self.state_path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    # Check if the bus stop data was checked recently enough to skip checking again
+    def is_fresh(self):
+        if not os.path.exists(self.file_path) or "hash" not in self.state:
+            return False
+        return time.time() - self.state.get("checked_at", 0) < self.ttl
+
+    # Make sure the bus stop data is up to date, returning whether there is bus stop data to use
+    def refresh(self, force=False):
+        if not force and self.is_fresh():
+            self.is_bus_stop_request = True
+            return self.is_bus_stop_request
+
+        # Only ask for the data if it has changed since it was last downloaded
+        headers = {}
+        if os.path.exists(self.file_path) and "hash" in self.state:
+            if self.state.get("etag"):
+                headers["If-None-Match"] = self.state["etag"]
+            if self.state.get("last_modified"):
+                headers["If-Modified-Since"] = self.state["last_modified"]
+
+        try:
+            with requests.get(self.url, headers=headers, stream=True, timeout=self.timeout) as response:
+                # Data has not changed, so keep using the file on disk
+                if response.status_code == 304:
+                    self.state["checked_at"] = time.time()
+                    self.save_state()
+                    self.is_bus_stop_request = True
+                    return self.is_bus_stop_request
+
+                response.raise_for_status()  # Raises an error for bad responses (4xx and 5xx)
+                new_hash = self.download(response)
+
+                self.is_updated = new_hash != self.state.get("hash")
+                self.state = {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "hash": new_hash,
+                    "checked_at": time.time()
+                }
+                self.save_state()
+                self.stops_hash = new_hash
+                self.is_bus_stop_request = True
+
+        except (requests.RequestException, requests.ConnectionError, requests.Timeout, OSError):
+            # Carry on with the bus stop data already on disk if there is any
+            self.is_bus_stop_request = os.path.exists(self.file_path) and "hash" in self.state
+
+        return self.is_bus_stop_request
+
+    # Write the response to disk in chunks, working out its hash along the way
+    def download(self, response):
+        md5 = hashlib.md5()
+        file_descriptor, temporary_path = self.make_temporary_file(self.file_path)
+        try:
+            with os.fdopen(file_descriptor, "wb") as datafile:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    md5.update(chunk)
+                    datafile.write(chunk)
+            # Only replace the old file once the new one is completely downloaded
+            os.replace(temporary_path, self.file_path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        return md5.hexdigest()
@@ -0,0 +1,239 @@
+import xml.etree.ElementTree as ET
+from array import array # Compact storage of coordinates
+from math import radians, sin, cos, asin, sqrt, floor
+import pickle
+import hashlib
+import threading
+import sys
+import os
+
+# Size of each grid square in degrees, same as the search box around a postcode
+CELL_SIZE = 0.005
+EARTH_RADIUS = 6371000 # In metres
+METRES_PER_DEGREE = 111320
+
+# Distance in metres between two coordinates along the Earth's surface
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * asin(sqrt(a))
+
+# Hash of the bus stops file, same as RefreshBusStops works out when downloading it
+def hash_stops_file(xml_path):
+    md5 = hashlib.md5()
+    with open(xml_path, "rb") as datafile:
+        for chunk in iter(lambda: datafile.read(65536), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+# Keep the hash of the bus stops file, along with the modification time and size it was worked out for
+hashed_stops_file = None
+
+# Get the hash of the bus stops file, only reading the whole file again if it has changed
+def get_stops_file_hash(xml_path):
+    global hashed_stops_file
+    xml_stat = os.stat(xml_path)
+    source = (xml_path, xml_stat.st_mtime_ns, xml_stat.st_size)
+    if hashed_stops_file is None or hashed_stops_file[0] != source:
+        hashed_stops_file = (source, hash_stops_file(xml_path))
+    return hashed_stops_file[1]
+
+class StopIndex:
+    def __init__(self):
+        self.stops_hash = None
+        # Parallel lists, where the same position in each refers to the same bus stop
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.names = []
+        self.atco_codes = []
+        self.gazetteer_ids = []
+        # {ATCO code: position of the bus stop}, so a stop can be found without searching the whole list
+        self.atco_positions = {}
+        # {(row, column): positions of bus stops in that grid square}
+        self.grid = {}
+        # Smallest and largest (row, column) of the grid squares
+        self.grid_bounds = None
+
+    def get_cell(self, latitude, longitude):
+        return (floor(latitude / CELL_SIZE), floor(longitude / CELL_SIZE))
+
+    # Read all active bus stops from the NaPTAN file
+    def compile(self, xml_path, stops_hash):
+        self.stops_hash = stops_hash
+
+        # Enable access to elements in a namespace
+        namespace = {"n": "http://www.naptan.org.uk/"}
+
+        # Read one StopPoint at a time, rather than building the whole tree
+        for _, stop_point in ET.iterparse(xml_path):
+            if stop_point.tag != "{http://www.naptan.org.uk/}StopPoint":
+                continue
+            if stop_point.get("Status") != "active":
+                stop_point.clear()
+                continue # Skip inactive stops
+
+            # Extract location, skipping stops without one
+            location = stop_point.find(".//n:Location/n:Translation", namespace)
+            if location is None:
+                stop_point.clear()
+                continue
+
+            # Extract ATCO code, common name and locality reference ID
+            atco_code = stop_point.find("n:AtcoCode", namespace)
+            common_name = stop_point.find(".//n:Descriptor/n:CommonName", namespace)
+            nptg_locality_ref = stop_point.find(".//n:Place/n:NptgLocalityRef", namespace)
+
+            # Strings which repeat (such as locality IDs) are interned so they are only stored once
+            self.atco_codes.append(sys.intern(atco_code.text) if atco_code is not None else "Unknown")
+            self.names.append(sys.intern(common_name.text) if common_name is not None else "Unnamed Stop")
+            self.gazetteer_ids.append(sys.intern(nptg_locality_ref.text) if nptg_locality_ref is not None else "Unknown")
+            self.latitudes.append(float(location.find("n:Latitude", namespace).text))
+            self.longitudes.append(float(location.find("n:Longitude", namespace).text))
+
+            stop_point.clear() # Free the memory used by this StopPoint
+
+        self.index_atco_codes()
+
+        # Put each bus stop into its grid square
+        for position in range(len(self.latitudes)):
+            cell = self.get_cell(self.latitudes[position], self.longitudes[position])
+            self.grid.setdefault(cell, array('i')).append(position)
+        if self.grid:
+            rows = [row for row, _ in self.grid]
+            columns = [column for _, column in self.grid]
+            self.grid_bounds = (min(rows), min(columns), max(rows), max(columns))
+
+    # Note the position of each ATCO code. If a code appears twice, the first stop is kept
+    def index_atco_codes(self):
+        self.atco_positions = {}
+        for position, atco_code in enumerate(self.atco_codes):
+            self.atco_positions.setdefault(atco_code, position)
+
+    def save(self, store_path):
+        # Write to a temporary file first so a half-written store is never loaded
+        with open(store_path + ".tmp", "wb") as store_file:
+            pickle.dump(self, store_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(store_path + ".tmp", store_path)
+
+    # Get the details of the bus stop at a position, in the same format as NearbyStops.find_nearest_bus_stops
+    def get_stop(self, position):
+        return {
+            "name": self.names[position],
+            "atco_code": self.atco_codes[position],
+            "gazetteer_id": self.gazetteer_ids[position],
+            "latitude": self.latitudes[position],
+            "longitude": self.longitudes[position]
+        }
+
+    # Get the details of the bus stop with an ATCO code, or None if there is no such stop
+    def find_stop(self, atco_code):
+        position = self.atco_positions.get(atco_code)
+        if position is None:
+            return None
+        return self.get_stop(position)
+
+    # Positions of bus stops in the grid squares covering a box
+    def get_candidates(self, min_lat, max_lat, min_lon, max_lon):
+        min_row, min_column = self.get_cell(min_lat, min_lon)
+        max_row, max_column = self.get_cell(max_lat, max_lon)
+        for row in range(min_row, max_row + 1):
+            for column in range(min_column, max_column + 1):
+                yield from self.grid.get((row, column), ())
+
+    # Sort positions of bus stops by their distance from a coordinate
+    def sort_by_distance(self, positions, latitude, longitude):
+        distances = [(haversine(latitude, longitude, self.latitudes[position], self.longitudes[position]), position)
+                     for position in positions]
+        distances.sort()
+        return distances
+
+    # Bus stops strictly inside a box, nearest first
+    def find_stops_in_box(self, latitude, longitude, min_lat, max_lat, min_lon, max_lon):
+        positions = [position for position in self.get_candidates(min_lat, max_lat, min_lon, max_lon)
+                     if min_lat < self.latitudes[position] < max_lat and min_lon < self.longitudes[position] < max_lon]
+        return [self.get_stop(position) for _, position in self.sort_by_distance(positions, latitude, longitude)]
+
+    # Bus stops within a number of metres of a coordinate, nearest first
+    def find_stops_within_radius(self, latitude, longitude, radius):
+        lat_range = radius / METRES_PER_DEGREE
+        lon_range = radius / (METRES_PER_DEGREE * max(cos(radians(abs(latitude) + lat_range)), 0.01))
+        positions = self.get_candidates(latitude - lat_range, latitude + lat_range, longitude - lon_range, longitude + lon_range)
+        return [self.get_stop(position) for distance, position in self.sort_by_distance(positions, latitude, longitude)
+                if distance <= radius]
+
+    # Localities with a bus stop within a number of metres of a bus stop in the given locality
+    def get_neighbouring_localities(self, gazetteer_id, radius):
+        neighbouring_localities = set()
+        for position in range(len(self.gazetteer_ids)):
+            if self.gazetteer_ids[position] != gazetteer_id:
+                continue
+            for stop in self.find_stops_within_radius(self.latitudes[position], self.longitudes[position], radius):
+                neighbouring_localities.add(stop["gazetteer_id"])
+        neighbouring_localities.discard(gazetteer_id)
+        return neighbouring_localities
+
+    # The k nearest bus stops to a coordinate, nearest first
+    def find_k_nearest_stops(self, latitude, longitude, k):
+        if not self.grid or k <= 0:
+            return []
+        centre_row, centre_column = self.get_cell(latitude, longitude)
+        min_row, min_column, max_row, max_column = self.grid_bounds
+        # Furthest number of rings needed to cover the whole grid
+        max_ring = max(abs(centre_row - min_row), abs(centre_row - max_row),
+                       abs(centre_column - min_column), abs(centre_column - max_column))
+        # Shortest distance covered by one grid square, as squares are narrower east to west
+        cell_metres = CELL_SIZE * METRES_PER_DEGREE * max(cos(radians(abs(latitude) + CELL_SIZE * max_ring)), 0.01)
+
+        positions = []
+        # Search rings of grid squares outwards from the coordinate
+        for ring in range(max_ring + 1):
+            for row in range(centre_row - ring, centre_row + ring + 1):
+                for column in range(centre_column - ring, centre_column + ring + 1):
+                    # Only look at squares on the edge of this ring
+                    if max(abs(row - centre_row), abs(column - centre_column)) == ring:
+                        positions.extend(self.grid.get((row, column), ()))
+
+            # Stop once no bus stop outside the searched rings can be closer than the k-th nearest found
+            if len(positions) >= k:
+                distances = self.sort_by_distance(positions, latitude, longitude)
+                if distances[k - 1][0] <= ring * cell_metres:
+                    break
+        distances = self.sort_by_distance(positions, latitude, longitude)
+        return [self.get_stop(position) for _, position in distances[:k]]
+
+# Keep the index in memory between searches
+loaded_stop_index = None
+# Searches and the warm up at startup run on different threads, so only one loads the index at a time
+loaded_stop_index_lock = threading.Lock()
+
+# Get the bus stop index for the current NaPTAN file, compiling it only if the file has changed
+def load_stop_index(stops_hash=None, xml_path="400.xml", store_path="stop_index.pickle"):
+    global loaded_stop_index
+    with loaded_stop_index_lock:
+        if stops_hash is None:
+            stops_hash = get_stops_file_hash(xml_path)
+
+        # Index already in memory
+        if loaded_stop_index is not None and loaded_stop_index.stops_hash == stops_hash:
+            return loaded_stop_index
+
+        # Index saved on disk from a previous run
+        if os.path.exists(store_path):
+            try:
+                with open(store_path, "rb") as store_file:
+                    stop_index = pickle.load(store_file)
+                if stop_index.stops_hash == stops_hash:
+                    # Stores saved before ATCO codes were indexed do not have the positions
+                    if not hasattr(stop_index, "atco_positions"):
+                        stop_index.index_atco_codes()
+                    loaded_stop_index = stop_index
+                    return stop_index
+            except (pickle.UnpicklingError, EOFError, AttributeError):
+                pass # Rebuild the store if it cannot be read
+
+        # Compile a new index from the NaPTAN file
+        stop_index = StopIndex()
+        stop_index.compile(xml_path, stops_hash)
+        stop_index.save(store_path)
+        loaded_stop_index = stop_index
+        return stop_index
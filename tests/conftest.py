@@ -0,0 +1,48 @@
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+
+# Let the tests import the app's modules, which sit in the folder above
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# A local HTTP server standing in for the APIs the app uses. Each path is answered by a function given the
+# request's headers and full path (with its query), which returns (status code, headers, body).
+# Requests made are kept in self.requests
+class StandInServer:
+    def __init__(self):
+        self.routes = {}
+        self.requests = [] # [(path, headers)]
+        stand_in_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stand_in_server.requests.append((self.path, dict(self.headers)))
+                # "*" answers any path without its own route
+                route = stand_in_server.routes.get(self.path.split("?")[0], stand_in_server.routes.get("*"))
+                status, headers, body = route(self.headers, self.path) if route is not None else (404, {}, b"")
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass # Keep the test output quiet
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def stand_in_server():
+    server = StandInServer()
+    yield server
+    server.close()
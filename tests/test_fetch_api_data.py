@@ -0,0 +1,56 @@
+import json
+from urllib.parse import urlsplit, parse_qs
+from fetch_api_data import GrabFiles, PAGE_SIZE
+
+# Serve a list of datasets in pages like the bus data API, giving at most max_page_size datasets per page
+# whatever limit is asked for. count_change is added to the count given on every page, and
+# remove_after_first_page takes the first dataset out of the list the first time the first page is served
+def serve_datasets(server, datasets, max_page_size, count_change=0, remove_after_first_page=False):
+    removed = []
+    def answer(headers, path):
+        query = parse_qs(urlsplit(path).query)
+        offset = int(query.get("offset", ["0"])[0])
+        limit = min(int(query.get("limit", [str(PAGE_SIZE)])[0]), max_page_size)
+        page = {"count": len(datasets) + count_change, "next": None, "results": datasets[offset:offset + limit]}
+        if offset + limit < len(datasets):
+            page["next"] = f"{server.url}/datasets?limit={limit}&offset={offset + limit}"
+        if remove_after_first_page and offset == 0 and not removed:
+            removed.append(datasets.pop(0))
+        return 200, {"Content-Type": "application/json"}, json.dumps(page).encode()
+    server.routes["/datasets"] = answer
+
+def make_datasets(number):
+    return [{"id": dataset_id, "url": f"https://example.com/{dataset_id}.zip"} for dataset_id in range(number)]
+
+def get_offsets(server):
+    return sorted(int(parse_qs(urlsplit(path).query).get("offset", ["0"])[0]) for path, _ in server.requests)
+
+def test_pages_fetched_at_same_time(stand_in_server):
+    serve_datasets(stand_in_server, make_datasets(250), PAGE_SIZE)
+    update = GrabFiles(url=stand_in_server.url + "/datasets")
+    assert update.is_API_request
+    assert [result["id"] for result in update.results] == list(range(250))
+    assert get_offsets(stand_in_server) == [0, 100, 200]
+
+def test_smaller_pages_than_asked_for(stand_in_server):
+    # The server only gives 40 datasets a page, so the offsets go up by 40 rather than skipping datasets
+    serve_datasets(stand_in_server, make_datasets(250), 40)
+    update = GrabFiles(url=stand_in_server.url + "/datasets")
+    assert update.is_API_request
+    assert [result["id"] for result in update.results] == list(range(250))
+    assert get_offsets(stand_in_server) == [0, 40, 80, 120, 160, 200, 240]
+
+def test_list_changing_falls_back_to_following_pages(stand_in_server):
+    # A dataset is removed after the first page, so every other dataset moves back one place and dataset 100
+    # would be missed by the pages fetched at the same time
+    serve_datasets(stand_in_server, make_datasets(250), PAGE_SIZE, remove_after_first_page=True)
+    update = GrabFiles(url=stand_in_server.url + "/datasets")
+    assert update.is_API_request
+    assert [result["id"] for result in update.results] == list(range(1, 250))
+
+def test_missing_datasets_are_not_used(stand_in_server):
+    # The server says there are more datasets than it ever gives, so the list is never complete
+    serve_datasets(stand_in_server, make_datasets(250), PAGE_SIZE, count_change=10)
+    update = GrabFiles(url=stand_in_server.url + "/datasets")
+    assert not update.is_API_request
+    assert update.results == []
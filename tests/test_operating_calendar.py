@@ -0,0 +1,134 @@
+import pytest
+from datetime import date, timedelta
+import lxml.etree as ET
+from operating_calendar import (OperatingCalendar, get_bank_holidays, get_easter_sunday, parse_operating_profile,
+                                DAYS_OF_WEEK, BITMAP_DAYS, BITMAP_MARGIN)
+
+NAMESPACE = {'ns': 'http://www.transxchange.org.uk/'}
+
+# Read an OperatingProfile written out as TransXChange, without the namespace boilerplate
+def read_profile(profile_xml):
+    return parse_operating_profile(ET.fromstring(f'<OperatingProfile xmlns="{NAMESPACE["ns"]}">{profile_xml}</OperatingProfile>'),
+                                   NAMESPACE)
+
+# Monday to Friday, not on any bank holiday, with a week off in August and an extra Saturday
+WEEKDAY_PROFILE = """
+    <RegularDayType><DaysOfWeek><MondayToFriday/></DaysOfWeek></RegularDayType>
+    <SpecialDaysOperation>
+        <DaysOfOperation><DateRange><StartDate>2026-08-08</StartDate><EndDate>2026-08-08</EndDate></DateRange></DaysOfOperation>
+        <DaysOfNonOperation><DateRange><StartDate>2026-08-03</StartDate><EndDate>2026-08-07</EndDate></DateRange></DaysOfNonOperation>
+    </SpecialDaysOperation>
+    <BankHolidayOperation><DaysOfNonOperation><AllBankHolidays/></DaysOfNonOperation></BankHolidayOperation>
+"""
+
+# Only runs on the bank holidays which fall on a Monday
+HOLIDAYS_ONLY_PROFILE = """
+    <RegularDayType><HolidaysOnly/></RegularDayType>
+    <BankHolidayOperation><DaysOfOperation><HolidayMondays/></DaysOfOperation></BankHolidayOperation>
+"""
+
+@pytest.mark.parametrize("year, easter_sunday", [(2024, date(2024, 3, 31)), (2026, date(2026, 4, 5)), (2027, date(2027, 3, 28))])
+def test_easter_sunday(year, easter_sunday):
+    assert get_easter_sunday(year) == easter_sunday
+
+def test_bank_holidays_2026():
+    bank_holidays = get_bank_holidays(2026)
+    assert bank_holidays[date(2026, 4, 3)] == {"GoodFriday"}
+    assert bank_holidays[date(2026, 4, 6)] == {"EasterMonday"}
+    assert bank_holidays[date(2026, 5, 4)] == {"MayDay"}
+    assert bank_holidays[date(2026, 5, 25)] == {"SpringBank"}
+    assert bank_holidays[date(2026, 8, 31)] == {"LateSummerBankHolidayNotScotland"}
+    # Christmas Day is a Friday, so Boxing Day on the Saturday is given a day off on Monday 28th
+    assert bank_holidays[date(2026, 12, 25)] == {"ChristmasDay"}
+    assert bank_holidays[date(2026, 12, 28)] == {"BoxingDayHoliday"}
+    assert date(2026, 12, 27) not in bank_holidays
+
+@pytest.mark.parametrize("year, holidays", [
+    # Christmas Day on a Saturday: both days off move to Monday and Tuesday
+    (2027, {date(2027, 12, 27): {"ChristmasDayHoliday"}, date(2027, 12, 28): {"BoxingDayHoliday"}}),
+    # Christmas Day on a Sunday: Boxing Day is already on the Monday, so Christmas moves to Tuesday.
+    # New Year's Day that year was a Saturday, so moves to Monday 3rd
+    (2022, {date(2022, 12, 27): {"ChristmasDayHoliday"}, date(2022, 1, 3): {"NewYearsDayHoliday"}}),
+])
+def test_displaced_bank_holidays(year, holidays):
+    bank_holidays = get_bank_holidays(year)
+    for holiday, names in holidays.items():
+        assert bank_holidays[holiday] == names
+
+def test_parse_operating_profile():
+    days_of_week, holidays_only, operation_holidays, non_operation_holidays, operation_dates, non_operation_dates = read_profile(WEEKDAY_PROFILE)
+    assert days_of_week == DAYS_OF_WEEK["MondayToFriday"]
+    assert not holidays_only
+    assert operation_holidays == ()
+    # AllBankHolidays is expanded into the holidays it stands for
+    assert "EasterMonday" in non_operation_holidays and "BoxingDayHoliday" in non_operation_holidays
+    assert "ChristmasEve" not in non_operation_holidays
+    assert operation_dates == (("2026-08-08", "2026-08-08"),)
+    assert non_operation_dates == (("2026-08-03", "2026-08-07"),)
+
+@pytest.mark.parametrize("day, runs", [
+    (date(2026, 4, 2), True), # Thursday
+    (date(2026, 4, 3), False), # Good Friday
+    (date(2026, 4, 6), False), # Easter Monday
+    (date(2026, 4, 7), True), # Tuesday after Easter
+    (date(2026, 4, 11), False), # Saturday
+    (date(2026, 8, 3), False), # Monday, in the week off
+    (date(2026, 8, 7), False), # Friday, last day of the week off
+    (date(2026, 8, 8), True), # Saturday, added as a special day
+    (date(2026, 8, 10), True), # Monday after the week off
+    (date(2026, 12, 28), False), # Boxing Day moved to Monday
+])
+def test_special_days_and_bank_holidays(day, runs):
+    assert OperatingCalendar(read_profile(WEEKDAY_PROFILE), (None, None)).operates_on(day) == runs
+
+def test_special_days_take_priority_over_bank_holidays():
+    # Runs on all bank holidays except Easter Monday, which is given as a day of non-operation
+    profile = read_profile("""
+        <SpecialDaysOperation>
+            <DaysOfNonOperation><DateRange><StartDate>2026-04-06</StartDate></DateRange></DaysOfNonOperation>
+        </SpecialDaysOperation>
+        <BankHolidayOperation><DaysOfOperation><AllBankHolidays/></DaysOfOperation></BankHolidayOperation>
+    """)
+    calendar = OperatingCalendar(profile, (None, None))
+    assert calendar.operates_on(date(2026, 4, 3))
+    assert not calendar.operates_on(date(2026, 4, 6))
+
+@pytest.mark.parametrize("day, runs", [
+    (date(2026, 4, 6), True), # Easter Monday
+    (date(2026, 5, 4), True), # Early May bank holiday
+    (date(2026, 8, 31), True), # Summer bank holiday
+    (date(2026, 4, 3), False), # Good Friday is a holiday, but not a Monday one
+    (date(2026, 4, 13), False), # Ordinary Monday
+])
+def test_holidays_only(day, runs):
+    assert OperatingCalendar(read_profile(HOLIDAYS_ONLY_PROFILE), (None, None)).operates_on(day) == runs
+
+def test_operating_period():
+    calendar = OperatingCalendar(None, ("2026-03-01", "2026-03-31"))
+    assert not calendar.operates_on(date(2026, 2, 28))
+    assert calendar.operates_on(date(2026, 3, 1))
+    assert calendar.operates_on(date(2026, 3, 31))
+    assert not calendar.operates_on(date(2026, 4, 1))
+
+def test_runs_on_matches_operates_on_across_bitmap_edge():
+    calendar = OperatingCalendar(read_profile(WEEKDAY_PROFILE), ("2026-01-01", None))
+    first_day = date(2026, 1, 5)
+    assert calendar.runs_on(first_day)
+    bitmap_start = calendar.day_bitmap[0]
+    assert bitmap_start == first_day - timedelta(days=BITMAP_MARGIN)
+
+    # The last day in the bitmap is answered from it, the day after starts a new one
+    last_day = bitmap_start + timedelta(days=BITMAP_DAYS - 1)
+    calendar.runs_on(last_day)
+    assert calendar.day_bitmap[0] == bitmap_start
+    calendar.runs_on(last_day + timedelta(days=1))
+    assert calendar.day_bitmap[0] == last_day + timedelta(days=1 - BITMAP_MARGIN)
+
+    # Going back before the bitmap starts one from earlier again
+    calendar.runs_on(first_day)
+    assert calendar.day_bitmap[0] == bitmap_start
+
+    # Every day either side of the edge agrees with working it out directly, including days before the period starts
+    for offset in range(-20, BITMAP_DAYS + 20):
+        day = bitmap_start + timedelta(days=offset)
+        assert calendar.runs_on(day) == calendar.operates_on(day), day
@@ -0,0 +1,77 @@
+import os
+import pytest
+from datetime import date
+from processing_timetable_data import ProcessData, StreamProcessData, parse_duration_seconds
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "samples")
+
+# Arrival times worked out by hand for the sample files, as {ATCO code: {destination: ([seconds], [calendars])}}.
+# A stop's time is the end of the timing link leaving it, as the app has always done
+EXPECTED_ARRIVAL_TIMES = {
+    # Waits given on the From stop of a link, and on the To stop of the link before
+    "wait_times.xml": {
+        "4000SAMPLE01": {"Guildford": ([29100, 34500], [0, 1])},
+        "4000SAMPLE02": {"Guildford": ([29820, 35220], [0, 1])},
+        "4000SAMPLE03": {"Guildford": ([30030, 35430], [0, 1])},
+        "4000SAMPLE04": {"Guildford": ([30330, 35730], [0, 1])},
+    },
+    # Journey patterns made of two sections, with a wait at the end of the first, and two patterns to the same destination
+    "multi_section.xml": {
+        "4000SAMPLE11": {"Redhill": ([23640], [0]), "Woking": ([25440, 29040], [0, 0])},
+        "4000SAMPLE12": {"Redhill": ([24000], [0]), "Woking": ([25800, 29400], [0, 0])},
+        "4000SAMPLE13": {"Woking": ([26040, 26280, 29640], [0, 0, 0])},
+        "4000SAMPLE14": {"Woking": ([26340, 26580, 29940], [0, 0, 0])},
+    },
+    # A route which comes back to its first stop, so the stop is passed twice by each journey
+    "looping.xml": {
+        "4000SAMPLE21": {"Circular": ([36300, 36600, 39900, 40200], [0, 0, 0, 0])},
+        "4000SAMPLE22": {"Circular": ([36600, 40200], [0, 0])},
+    },
+}
+
+# Read a sample file with ProcessData, which is given the file's contents, or StreamProcessData, which is given its path
+def load_sample(process_class, filename, atco_code):
+    path = os.path.join(SAMPLES_DIR, filename)
+    if process_class is ProcessData:
+        with open(path, "rb") as sample_file:
+            return ProcessData(sample_file.read(), atco_code)
+    return StreamProcessData(path, atco_code)
+
+# Turn {destination: (times, calendars)} into plain lists, which compare the order of destinations too
+def as_lists(arrival_times):
+    return [(destination, (list(times), list(calendar_ids))) for destination, (times, calendar_ids) in arrival_times.items()]
+
+@pytest.mark.parametrize("process_class", [ProcessData, StreamProcessData])
+@pytest.mark.parametrize("filename", sorted(EXPECTED_ARRIVAL_TIMES))
+def test_arrival_times_by_destination(process_class, filename):
+    for atco_code, expected in EXPECTED_ARRIVAL_TIMES[filename].items():
+        bus_data = load_sample(process_class, filename, atco_code)
+        assert as_lists(bus_data.find_arrival_times_by_destination()) == as_lists(expected)
+
+@pytest.mark.parametrize("process_class", [ProcessData, StreamProcessData])
+@pytest.mark.parametrize("filename", sorted(EXPECTED_ARRIVAL_TIMES))
+def test_arrival_times_for_all_stops(process_class, filename):
+    arrival_times_by_stop = load_sample(process_class, filename, None).find_arrival_times_for_all_stops()
+    assert sorted(arrival_times_by_stop) == sorted(EXPECTED_ARRIVAL_TIMES[filename])
+    for atco_code, expected in EXPECTED_ARRIVAL_TIMES[filename].items():
+        assert as_lists(arrival_times_by_stop[atco_code]) == as_lists(expected)
+
+@pytest.mark.parametrize("process_class", [ProcessData, StreamProcessData])
+def test_stop_without_times(process_class):
+    # The last stop of a route is never the start of a link, so has no times
+    assert not load_sample(process_class, "wait_times.xml", "4000SAMPLE05").find_arrival_times_by_destination()
+    assert not load_sample(process_class, "wait_times.xml", "4000NOTHERE").find_arrival_times_by_destination()
+
+@pytest.mark.parametrize("process_class", [ProcessData, StreamProcessData])
+def test_calendars_and_line_number(process_class):
+    bus_data = load_sample(process_class, "wait_times.xml", "4000SAMPLE01")
+    bus_data.find_arrival_times_by_destination()
+    assert bus_data.get_line_number() == "1"
+    # The first journey uses the service's Monday to Friday profile, the second runs on Saturdays
+    weekday, saturday = bus_data.calendars
+    assert weekday.operates_on(date(2026, 3, 2)) and not weekday.operates_on(date(2026, 3, 7))
+    assert saturday.operates_on(date(2026, 3, 7)) and not saturday.operates_on(date(2026, 3, 2))
+
+@pytest.mark.parametrize("duration, seconds", [("PT5M", 300), ("PT1H2M3S", 3723), ("PT0S", 0), ("PT1.5S", 1.5), ("P1DT1S", 86401)])
+def test_parse_duration_seconds(duration, seconds):
+    assert parse_duration_seconds(duration) == seconds
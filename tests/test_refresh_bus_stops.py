@@ -0,0 +1,79 @@
+import hashlib
+import json
+from refresh_bus_stops import RefreshBusStops
+
+STOPS_V1 = b"<NaPTAN>first version</NaPTAN>"
+STOPS_V2 = b"<NaPTAN>second version</NaPTAN>"
+LAST_MODIFIED = "Wed, 01 Jan 2026 00:00:00 GMT"
+
+# Serve bus stop data with an ETag, answering 304 if the client already has this version
+def serve_stops(server, body, etag):
+    def answer(headers, path):
+        if headers.get("If-None-Match") == etag:
+            return 304, {"ETag": etag}, b""
+        return 200, {"ETag": etag, "Last-Modified": LAST_MODIFIED}, body
+    server.routes["/stops"] = answer
+
+def make_refresher(server, tmp_path, ttl=0):
+    return RefreshBusStops(url=server.url + "/stops", file_path=str(tmp_path / "400.xml"),
+                           state_path=str(tmp_path / "400_state.json"), ttl=ttl)
+
+def test_first_download_saves_file_and_state(stand_in_server, tmp_path):
+    serve_stops(stand_in_server, STOPS_V1, '"v1"')
+    refresher = make_refresher(stand_in_server, tmp_path)
+    assert refresher.refresh()
+    assert refresher.is_updated
+    assert (tmp_path / "400.xml").read_bytes() == STOPS_V1
+    state = json.loads((tmp_path / "400_state.json").read_text())
+    assert state["etag"] == '"v1"' and state["last_modified"] == LAST_MODIFIED
+    assert state["hash"] == refresher.stops_hash == hashlib.md5(STOPS_V1).hexdigest()
+    # No temporary files are left behind
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["400.xml", "400_state.json"]
+
+def test_not_modified_keeps_file(stand_in_server, tmp_path):
+    serve_stops(stand_in_server, STOPS_V1, '"v1"')
+    make_refresher(stand_in_server, tmp_path).refresh()
+    checked_at = json.loads((tmp_path / "400_state.json").read_text())["checked_at"]
+
+    refresher = make_refresher(stand_in_server, tmp_path)
+    assert refresher.refresh()
+    assert not refresher.is_updated
+    # The saved ETag and Last-Modified were sent, and the server answered 304
+    _, headers = stand_in_server.requests[-1]
+    assert headers["If-None-Match"] == '"v1"' and headers["If-Modified-Since"] == LAST_MODIFIED
+    assert (tmp_path / "400.xml").read_bytes() == STOPS_V1
+    assert json.loads((tmp_path / "400_state.json").read_text())["checked_at"] >= checked_at
+
+def test_fresh_data_is_not_checked(stand_in_server, tmp_path):
+    serve_stops(stand_in_server, STOPS_V1, '"v1"')
+    make_refresher(stand_in_server, tmp_path).refresh()
+    request_count = len(stand_in_server.requests)
+
+    # Checked less than an hour ago, so the server is not asked again
+    refresher = make_refresher(stand_in_server, tmp_path, ttl=3600)
+    assert refresher.refresh()
+    assert len(stand_in_server.requests) == request_count
+    # Unless the check is forced
+    assert refresher.refresh(force=True)
+    assert len(stand_in_server.requests) == request_count + 1
+
+def test_new_data_replaces_file(stand_in_server, tmp_path):
+    serve_stops(stand_in_server, STOPS_V1, '"v1"')
+    make_refresher(stand_in_server, tmp_path).refresh()
+
+    serve_stops(stand_in_server, STOPS_V2, '"v2"')
+    refresher = make_refresher(stand_in_server, tmp_path)
+    assert refresher.refresh()
+    assert refresher.is_updated
+    assert (tmp_path / "400.xml").read_bytes() == STOPS_V2
+    state = json.loads((tmp_path / "400_state.json").read_text())
+    assert state["etag"] == '"v2"' and state["hash"] == hashlib.md5(STOPS_V2).hexdigest()
+
+def test_server_error_keeps_old_data(stand_in_server, tmp_path):
+    serve_stops(stand_in_server, STOPS_V1, '"v1"')
+    make_refresher(stand_in_server, tmp_path).refresh()
+
+    stand_in_server.routes["/stops"] = lambda headers, path: (500, {}, b"")
+    refresher = make_refresher(stand_in_server, tmp_path)
+    assert refresher.refresh()
+    assert (tmp_path / "400.xml").read_bytes() == STOPS_V1
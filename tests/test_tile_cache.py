@@ -0,0 +1,78 @@
+import os
+import time
+import pytest
+from tile_cache import TileCache, OSM_TILE_URL, prefetch_tiles, get_tiles_in_bbox
+
+# Every tile served is 100 bytes, so the cache's size limit can be given in tiles
+TILE_SIZE = 100
+
+@pytest.fixture
+def tile_server(stand_in_server):
+    stand_in_server.routes["*"] = lambda headers, path: (200, {"Content-Type": "image/png"}, b"t" * TILE_SIZE)
+    return stand_in_server
+
+def make_tile_cache(server, tmp_path, max_bytes=10 * TILE_SIZE):
+    return TileCache(cache_dir=str(tmp_path / "tiles"), max_bytes=max_bytes, url=server.url + "/{z}/{x}/{y}.png")
+
+def test_miss_downloads_and_stores_tile(tile_server, tmp_path):
+    tile_cache = make_tile_cache(tile_server, tmp_path)
+    path = tile_cache.fetch(12, 2040, 1370)
+    assert [path for path, _ in tile_server.requests] == ["/12/2040/1370.png"]
+    assert path == tile_cache.get_path(12, 2040, 1370)
+    with open(path, "rb") as tile_file:
+        assert tile_file.read() == b"t" * TILE_SIZE
+    assert tile_cache.get(12, 2040, 1370) == path
+    assert tile_cache.total_bytes == TILE_SIZE
+    tile_cache.close()
+
+def test_hit_makes_no_request(tile_server, tmp_path):
+    tile_cache = make_tile_cache(tile_server, tmp_path)
+    path = tile_cache.fetch(12, 2040, 1370)
+    assert tile_cache.fetch(12, 2040, 1370) == path
+    assert len(tile_server.requests) == 1
+    tile_cache.close()
+
+    # Still cached after the app is opened again
+    tile_cache = make_tile_cache(tile_server, tmp_path)
+    assert tile_cache.fetch(12, 2040, 1370) == path
+    assert len(tile_server.requests) == 1
+    tile_cache.close()
+
+def test_least_recently_used_tile_is_evicted(tile_server, tmp_path):
+    tile_cache = make_tile_cache(tile_server, tmp_path, max_bytes=2 * TILE_SIZE)
+    first_path = tile_cache.fetch(12, 1, 1)
+    time.sleep(0.01)
+    second_path = tile_cache.fetch(12, 2, 2)
+    time.sleep(0.01)
+    # Using the first tile again makes the second the least recently used
+    assert tile_cache.fetch(12, 1, 1) == first_path
+    time.sleep(0.01)
+    third_path = tile_cache.fetch(12, 3, 3)
+
+    assert tile_cache.total_bytes == 2 * TILE_SIZE
+    assert os.path.exists(first_path) and os.path.exists(third_path)
+    assert not os.path.exists(second_path)
+    assert tile_cache.get(12, 2, 2) is None
+    tile_cache.close()
+
+def test_failed_download_is_not_cached(stand_in_server, tmp_path):
+    stand_in_server.routes["*"] = lambda headers, path: (503, {}, b"")
+    tile_cache = make_tile_cache(stand_in_server, tmp_path)
+    assert tile_cache.fetch(12, 1, 1) is None
+    assert tile_cache.get(12, 1, 1) is None
+    assert tile_cache.total_bytes == 0
+    tile_cache.close()
+
+def test_prefetch_caches_area(tile_server, tmp_path):
+    tile_cache = make_tile_cache(tile_server, tmp_path, max_bytes=100 * TILE_SIZE)
+    bbox = (51.23, -0.58, 51.25, -0.56) # Around Guildford
+    tiles = get_tiles_in_bbox(bbox, range(10, 13))
+    assert prefetch_tiles(tile_cache, bbox, range(10, 13)) == (len(tiles), 0)
+    assert all(tile_cache.get(*tile) is not None for tile in tiles)
+    tile_cache.close()
+
+def test_prefetch_refuses_openstreetmap(tmp_path):
+    tile_cache = TileCache(cache_dir=str(tmp_path / "tiles"), url=OSM_TILE_URL)
+    with pytest.raises(ValueError):
+        prefetch_tiles(tile_cache)
+    tile_cache.close()
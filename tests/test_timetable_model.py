@@ -0,0 +1,64 @@
+from array import array
+from datetime import date
+from operating_calendar import OperatingCalendar, DAYS_OF_WEEK
+from timetable_model import StopTimetable, TIME_TYPECODE, SECONDS_IN_DAY, parse_time_of_day, format_time_of_day
+
+EVERY_DAY = OperatingCalendar(None, (None, None))
+WEEKDAYS = OperatingCalendar((DAYS_OF_WEEK["MondayToFriday"], False, (), (), (), ()), (None, None))
+
+FRIDAY = date(2026, 10, 16)
+SATURDAY = date(2026, 10, 17)
+SUNDAY = date(2026, 10, 18)
+
+# A stop with a weekday night bus running past midnight, and an every day service
+def make_timetable():
+    timetable = StopTimetable()
+    # Line 1 leaves at 08:00 and 23:50 every day, and its weekday night buses reach the stop at 00:15 and 00:40
+    timetable.add_service("1", {"Guildford": (array(TIME_TYPECODE, [28800, 85800, SECONDS_IN_DAY + 900, SECONDS_IN_DAY + 2400]),
+                                              [0, 0, 1, 1])},
+                          [EVERY_DAY, WEEKDAYS])
+    # Line 2 leaves at 00:30 and 09:00 every day
+    timetable.add_service("2", {"Woking": (array(TIME_TYPECODE, [1800, 32400]), [0, 0])}, [EVERY_DAY])
+    return timetable
+
+def test_parse_and_format_time_of_day():
+    assert parse_time_of_day("07:45:30") == 27930
+    assert format_time_of_day(27930) == "07:45:30"
+    # Times after midnight carry on from 00:00
+    assert format_time_of_day(SECONDS_IN_DAY + 900) == "00:15:00"
+
+def test_next_departures_include_previous_day_after_midnight():
+    # Early on Saturday, the Friday night buses are merged in with Saturday's own, in time order
+    assert make_timetable().next_departures(0, 10, SATURDAY) == [
+        (900, "1", "Guildford"), (1800, "2", "Woking"), (2400, "1", "Guildford"),
+        (28800, "1", "Guildford"), (32400, "2", "Woking"), (85800, "1", "Guildford"),
+    ]
+
+def test_next_departures_leave_out_previous_day_not_running():
+    # Saturday night has no night buses, so early Sunday only has Sunday's own buses
+    assert make_timetable().next_departures(0, 3, SUNDAY) == [
+        (1800, "2", "Woking"), (28800, "1", "Guildford"), (32400, "2", "Woking"),
+    ]
+
+def test_next_departures_after_time_and_limit():
+    timetable = make_timetable()
+    assert timetable.next_departures(1000, 2, SATURDAY) == [(1800, "2", "Woking"), (2400, "1", "Guildford")]
+    assert timetable.next_departures(2401, 1, SATURDAY) == [(28800, "1", "Guildford")]
+    assert timetable.next_departures(85801, 10, SATURDAY) == []
+
+def test_next_departures_on_weekday_keep_own_night_buses():
+    # On Friday the night buses are Friday's own, given after midnight at the end of the day
+    assert make_timetable().next_departures(85000, 10, FRIDAY) == [
+        (85800, "1", "Guildford"), (SECONDS_IN_DAY + 900, "1", "Guildford"), (SECONDS_IN_DAY + 2400, "1", "Guildford"),
+    ]
+
+def test_next_departures_without_day():
+    # Without a day every arrival counts, with times after midnight left as they are
+    assert [seconds for seconds, line, destination in make_timetable().next_departures(30000)] == [
+        32400, 85800, SECONDS_IN_DAY + 900, SECONDS_IN_DAY + 2400,
+    ]
+
+def test_get_services_on_day():
+    services = [(line, [(destination, list(times)) for destination, times in destinations])
+                for line, destinations in make_timetable().get_services(SATURDAY)]
+    assert services == [("1", [("Guildford", [28800, 85800])]), ("2", [("Woking", [1800, 32400])])]
@@ -0,0 +1,168 @@
+import sqlite3 # Enable keeping track of cached tiles in a single file database
+import threading
+import math
+import time
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Area of Surrey as (lowest latitude, lowest longitude, highest latitude, highest longitude), around 51.25, -0.33
+SURREY_BBOX = (51.07, -0.85, 51.47, 0.06)
+# Zoom levels downloaded in advance: from the whole county down to streets
+PREFETCH_ZOOMS = range(10, 15)
+
+# The tile server is asked to identify the app
+USER_AGENT = "Surrey-Bus-Timetable"
+
+# Tiles shown on the map come from OpenStreetMap unless another server is set
+OSM_TILE_URL = "https://tile.openstreetmap.org/{z}/{x}/{y}.png"
+
+class TileCache:
+    def __init__(self, cache_dir="tile_cache", max_bytes=None, url=None, timeout=10):
+        # Tiles are kept as files, named by zoom, x and y, so the map can load them directly
+        self.cache_dir = cache_dir
+        # Most space the tiles may use (200 MB) unless set otherwise, after which the least recently used are deleted
+        self.max_bytes = max_bytes if max_bytes is not None else int(float(os.getenv("TILE_CACHE_MAX_MB", 200)) * 1024 * 1024)
+        # Tile server, which can be pointed somewhere else e.g. a local server for testing
+        self.url = url if url is not None else os.getenv("TILE_SERVER_URL", OSM_TILE_URL)
+        self.timeout = timeout
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Tiles are loaded on several threads at once, so one connection is shared behind a lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(self.cache_dir, "tiles.db"), check_same_thread=False)
+        with self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS tiles
+                                       (zoom INTEGER, x INTEGER, y INTEGER, size INTEGER, last_used REAL, PRIMARY KEY (zoom, x, y))""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS tiles_last_used ON tiles (last_used)")
+        self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+        # Made when the first tile is downloaded, so requests is not loaded before the first map is made
+        self.session = None
+
+        # Cut the cache down if the size limit has been lowered since it was filled
+        with self.lock:
+            self.evict()
+
+    # Where a tile is kept. x and y count from the top left, as in the tile server's URLs
+    def get_path(self, zoom, x, y):
+        return os.path.join(self.cache_dir, str(zoom), str(x), f"{y}.png")
+
+    # Get the path of a tile if it is cached, noting that it has just been used
+    def get(self, zoom, x, y):
+        path = self.get_path(zoom, x, y)
+        with self.lock:
+            with self.connection:
+                is_cached = self.connection.execute("UPDATE tiles SET last_used = ? WHERE zoom = ? AND x = ? AND y = ?",
+                                                    (time.time(), zoom, x, y)).rowcount > 0
+                if is_cached and not os.path.exists(path):
+                    # File was deleted outside the cache, so forget it
+                    self.forget(zoom, x, y)
+                    return None
+        return path if is_cached else None
+
+    # Add a tile to the cache, deleting the least recently used tiles if the cache is too big
+    def put(self, zoom, x, y, data):
+        path = self.get_path(zoom, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as tile_file:
+            tile_file.write(data)
+        os.replace(path + ".tmp", path)
+
+        with self.lock:
+            with self.connection:
+                self.forget(zoom, x, y) # Replace the tile if it was already cached
+                self.connection.execute("INSERT INTO tiles VALUES (?, ?, ?, ?, ?)", (zoom, x, y, len(data), time.time()))
+                self.total_bytes += len(data)
+            self.evict()
+        return path
+
+    # Remove a tile from the database. Called with the lock held
+    def forget(self, zoom, x, y):
+        row = self.connection.execute("SELECT size FROM tiles WHERE zoom = ? AND x = ? AND y = ?", (zoom, x, y)).fetchone()
+        if row is not None:
+            self.connection.execute("DELETE FROM tiles WHERE zoom = ? AND x = ? AND y = ?", (zoom, x, y))
+            self.total_bytes -= row[0]
+
+    # Delete least recently used tiles until the cache fits in its size limit. Called with the lock held
+    def evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        with self.connection:
+            for zoom, x, y, size in self.connection.execute("SELECT zoom, x, y, size FROM tiles ORDER BY last_used").fetchall():
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self.connection.execute("DELETE FROM tiles WHERE zoom = ? AND x = ? AND y = ?", (zoom, x, y))
+                self.total_bytes -= size
+                path = self.get_path(zoom, x, y)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    # Get the session used to download tiles, making it the first time
+    def get_session(self):
+        import requests # Imported here rather than at the top, as it is slow to load
+        with self.lock:
+            if self.session is None:
+                self.session = requests.Session()
+                self.session.headers["User-Agent"] = USER_AGENT
+        return self.session
+
+    # Get the path of a tile, downloading it only if it is not cached. Returns None if it cannot be downloaded
+    def fetch(self, zoom, x, y):
+        path = self.get(zoom, x, y)
+        if path is not None:
+            return path
+        import requests
+        try:
+            response = self.get_session().get(self.url.format(z=zoom, x=x, y=y), timeout=self.timeout)
+        except (requests.RequestException, requests.ConnectionError, requests.Timeout):
+            return None
+        if response.status_code != 200:
+            return None
+        return self.put(zoom, x, y, response.content)
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+        self.connection.close()
+
+# Get the x and y of the tile containing a coordinate at a zoom level
+def get_tile_xy(zoom, lat, lon):
+    tile_count = 2 ** zoom
+    x = int((lon + 180) / 360 * tile_count)
+    lat_radians = math.radians(lat)
+    y = int((1 - math.log(math.tan(lat_radians) + 1 / math.cos(lat_radians)) / math.pi) / 2 * tile_count)
+    return min(max(x, 0), tile_count - 1), min(max(y, 0), tile_count - 1)
+
+# Get (zoom, x, y) of every tile covering a bounding box at the given zoom levels
+def get_tiles_in_bbox(bbox, zooms):
+    lat_min, lon_min, lat_max, lon_max = bbox
+    tiles = []
+    for zoom in zooms:
+        x_min, y_min = get_tile_xy(zoom, lat_max, lon_min) # y counts down from the top
+        x_max, y_max = get_tile_xy(zoom, lat_min, lon_max)
+        tiles.extend((zoom, x, y) for x in range(x_min, x_max + 1) for y in range(y_min, y_max + 1))
+    return tiles
+
+# Download every tile of an area which is not already cached, so the map can be shown without
+# the internet. A few tiles are downloaded at a time, to go easy on the tile server.
+# Returns (number of tiles now cached, number which could not be downloaded)
+def prefetch_tiles(tile_cache, bbox=SURREY_BBOX, zooms=PREFETCH_ZOOMS, max_workers=2):
+    # OpenStreetMap's tile usage policy does not allow downloading tiles in bulk, so a server
+    # which does (e.g. one run for the kiosk) has to be set with TILE_SERVER_URL
+    if "tile.openstreetmap.org" in tile_cache.url:
+        raise ValueError("Tiles cannot be prefetched from OpenStreetMap's tile servers, set TILE_SERVER_URL to another server")
+    tiles = get_tiles_in_bbox(bbox, zooms)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        paths = list(executor.map(lambda tile: tile_cache.fetch(*tile), tiles))
+    failed_count = sum(1 for path in paths if path is None)
+    return len(tiles) - failed_count, failed_count
+
+# Fill the cache before the app is used, e.g. when setting up a kiosk
+if __name__ == "__main__":
+    tile_cache = TileCache()
+    try:
+        cached_count, failed_count = prefetch_tiles(tile_cache)
+        print(f"{cached_count} tiles cached, {failed_count} could not be downloaded")
+    except ValueError as error:
+        print(error)
+    finally:
+        tile_cache.close()
@@ -0,0 +1,110 @@
+import sqlite3 # Enable keeping timetables between runs in a single file database
+from collections import OrderedDict # Enable keeping track of which timetables were used least recently
+import threading
+import pickle
+import time
+import os
+
+# Get a value which changes whenever new bus data is installed: the bus store's manifest is
+# rewritten when datasets are added or removed, the dataset store when the list of datasets changes,
+# and the timetable index when it is built or updated, as lookups read from it once it is built
+def get_dataset_version(store_dir="bus_services", dataset_store_path="datasets.db", index_path="timetable_index.db"):
+    version = []
+    for path in (os.path.join(store_dir, "manifest.json"), dataset_store_path, index_path):
+        try:
+            path_stat = os.stat(path)
+            version.append(f"{path_stat.st_mtime_ns}:{path_stat.st_size}")
+        except OSError:
+            version.append("missing")
+    return "-".join(version)
+
+# Keeps recently looked up stop timetables, first in memory and then on disk, so the same
+# stop does not go through the bus files again until the bus data changes
+class TimetableCache:
+    def __init__(self, cache_path="timetable_cache.db", max_entries=None, max_disk_entries=None):
+        self.cache_path = cache_path
+        # Most timetables kept in memory (128) and on disk (2000) unless set otherwise
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv("TIMETABLE_CACHE_SIZE", 128))
+        self.max_disk_entries = max_disk_entries if max_disk_entries is not None else int(os.getenv("TIMETABLE_DISK_CACHE_SIZE", 2000))
+        self.timetables = OrderedDict() # {(stop key, dataset version): timetable}, least recently used first
+
+        # Number of lookups found in memory, found on disk, not found, and timetables dropped to make space
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Lookups run on background threads, so one connection is shared behind a lock. The worker processes
+        # of the timetable service share the file too, so wait up to 30 seconds for another process's write
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.cache_path, check_same_thread=False, timeout=30)
+        with self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS timetables
+                                       (stop_key TEXT PRIMARY KEY, dataset_version TEXT, timetable BLOB, last_used REAL)""")
+
+    # Get a cached timetable, or None if it is not cached for this version of the bus data
+    def get(self, stop_key, dataset_version):
+        with self.lock:
+            timetable = self.timetables.get((stop_key, dataset_version))
+            if timetable is not None:
+                self.timetables.move_to_end((stop_key, dataset_version))
+                self.memory_hits += 1
+                return timetable
+
+            with self.connection:
+                row = self.connection.execute("SELECT dataset_version, timetable FROM timetables WHERE stop_key = ?", (stop_key,)).fetchone()
+                if row is None or row[0] != dataset_version:
+                    self.misses += 1
+                    return None
+                self.connection.execute("UPDATE timetables SET last_used = ? WHERE stop_key = ?", (time.time(), stop_key))
+            timetable = pickle.loads(row[1])
+            self.disk_hits += 1
+            self.remember(stop_key, dataset_version, timetable)
+            return timetable
+
+    def put(self, stop_key, dataset_version, timetable):
+        with self.lock:
+            self.remember(stop_key, dataset_version, timetable)
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO timetables VALUES (?, ?, ?, ?)",
+                                        (stop_key, dataset_version, pickle.dumps(timetable, protocol=pickle.HIGHEST_PROTOCOL), time.time()))
+                # Drop the least recently used timetables from disk once there are too many
+                row_count = self.connection.execute("SELECT COUNT(*) FROM timetables").fetchone()[0]
+                if row_count > self.max_disk_entries:
+                    self.connection.execute("""DELETE FROM timetables WHERE stop_key IN
+                                               (SELECT stop_key FROM timetables ORDER BY last_used LIMIT ?)""", (row_count - self.max_disk_entries,))
+                    self.evictions += row_count - self.max_disk_entries
+
+    # Keep a timetable in memory, dropping the least recently used one if there are too many. Called with the lock held
+    def remember(self, stop_key, dataset_version, timetable):
+        self.timetables[(stop_key, dataset_version)] = timetable
+        self.timetables.move_to_end((stop_key, dataset_version))
+        while len(self.timetables) > self.max_entries:
+            self.timetables.popitem(last=False)
+            self.evictions += 1
+
+    # Forget every timetable, e.g. once new bus data has been installed
+    def clear(self):
+        with self.lock:
+            self.timetables.clear()
+            with self.connection:
+                self.connection.execute("DELETE FROM timetables")
+
+    def get_stats(self):
+        with self.lock:
+            return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "evictions": self.evictions, "memory_entries": len(self.timetables)}
+
+    def close(self):
+        self.connection.close()
+
+# One cache is shared by every lookup in this process
+loaded_timetable_cache = None
+loaded_timetable_cache_lock = threading.Lock()
+
+def get_timetable_cache():
+    global loaded_timetable_cache
+    with loaded_timetable_cache_lock:
+        if loaded_timetable_cache is None:
+            loaded_timetable_cache = TimetableCache()
+    return loaded_timetable_cache
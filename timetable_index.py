@@ -0,0 +1,218 @@
+import sqlite3 # Enable storing the index in a single file database
+import os
+import json
+from array import array
+from processing_timetable_data import StreamProcessData
+from timetable_model import TIME_TYPECODE, StopTimetable
+from operating_calendar import OperatingCalendar
+from bus_files import get_bus_files
+from bus_store import BusStore
+
+# Changed whenever the layout of the index changes, so older indexes are rebuilt
+INDEX_VERSION = 4
+
+class TimetableIndex:
+    def __init__(self, index_path="timetable_index.db"):
+        # Store where the index is kept
+        self.index_path = index_path
+
+    # Check if a complete index of the current version has been built. Indexes are built in a temporary
+    # file and only moved into place once finished, so a half-built index is never used
+    def is_built(self):
+        if not os.path.exists(self.index_path):
+            return False
+        connection = sqlite3.connect(self.index_path)
+        try:
+            return connection.execute("PRAGMA user_version").fetchone()[0] == INDEX_VERSION
+        finally:
+            connection.close()
+
+    # Make the tables of a new, empty index
+    def create_tables(self, connection):
+        # Arrival times of each bus line at each stop, numbered in the order they come within their file,
+        # one row per destination. Times are stored as the bytes of an array of seconds since midnight,
+        # and the days each arrival runs on as the bytes of an array of positions in the dataset's calendars
+        connection.execute("""CREATE TABLE timetables (atco_code TEXT, dataset_id INTEGER, row_order INTEGER, destination_order INTEGER,
+                                                 line TEXT, destination TEXT, arrival_seconds BLOB, arrival_calendars BLOB)""")
+        # Operating profile and period of each calendar used by a dataset
+        connection.execute("CREATE TABLE calendars (dataset_id INTEGER, calendar_order INTEGER, definition TEXT)")
+        # Order in which files are looked at, matching LocateBusFile.get_bus_stop_timetable
+        connection.execute("CREATE TABLE datasets (dataset_id INTEGER PRIMARY KEY, file_order INTEGER)")
+        # Localities of each dataset, so lookups only use files relevant to the stop's area
+        connection.execute("CREATE TABLE dataset_localities (dataset_id INTEGER, gazetteer_id TEXT)")
+        # Modification time of each dataset when it was indexed, so only changed datasets are indexed again
+        connection.execute("CREATE TABLE indexed_datasets (dataset_id INTEGER PRIMARY KEY, modified TEXT)")
+        connection.execute("CREATE INDEX timetables_atco_code ON timetables (atco_code)")
+        connection.execute("CREATE INDEX timetables_dataset_id ON timetables (dataset_id)")
+        connection.execute("CREATE INDEX calendars_dataset_id ON calendars (dataset_id)")
+        connection.execute("CREATE INDEX dataset_localities_gazetteer_id ON dataset_localities (gazetteer_id, dataset_id)")
+
+    # Build the whole index from scratch
+    def build(self, results, bus_store=None):
+        # Build into a temporary file so lookups carry on reading the bus files until the index is finished
+        temporary_path = self.index_path + ".tmp"
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+        connection = sqlite3.connect(temporary_path)
+        try:
+            with connection:
+                self.create_tables(connection)
+                self.add_datasets(connection, results, bus_store)
+            # The version is only set once everything else is in place
+            connection.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+        finally:
+            connection.close()
+        os.replace(temporary_path, self.index_path)
+
+    # Bring the index up to date, only indexing datasets that are new or have changed. An index which
+    # is missing or made by an older version is built again from scratch
+    def update(self, results, bus_store=None):
+        if not self.is_built():
+            self.build(results, bus_store)
+            return
+
+        connection = sqlite3.connect(self.index_path)
+        try:
+            # All changes are made in one transaction, so lookups never see a half-updated index
+            with connection:
+                self.add_datasets(connection, results, bus_store)
+        finally:
+            connection.close()
+
+    # Add datasets which are new or have changed to the index, and remove those which have changed or gone
+    def add_datasets(self, connection, results, bus_store=None):
+        if bus_store is None:
+            bus_store = BusStore()
+        bus_files = get_bus_files(results)
+        # {dataset id: modification time} of the datasets in the bus store, which should be in the index. The time of
+        # the copy in the store is used, as an older copy is kept if a newer one could not be downloaded
+        wanted_datasets = {result["id"]: bus_store.manifest[str(result["id"])]["modified"]
+                           for result, filename in bus_files if bus_store.has_dataset(result["id"], filename)}
+
+        indexed_datasets = dict(connection.execute("SELECT dataset_id, modified FROM indexed_datasets"))
+
+        # Remove datasets which have been removed or changed since they were indexed
+        for dataset_id, modified in indexed_datasets.items():
+            if dataset_id not in wanted_datasets or wanted_datasets[dataset_id] != modified:
+                connection.execute("DELETE FROM timetables WHERE dataset_id = ?", (dataset_id,))
+                connection.execute("DELETE FROM calendars WHERE dataset_id = ?", (dataset_id,))
+                connection.execute("DELETE FROM indexed_datasets WHERE dataset_id = ?", (dataset_id,))
+
+        # Xml files are looked at first, then zip files
+        ordered_files = ([(result, filename) for result, filename in bus_files if result["extension"] == "xml"]
+                         + [(result, filename) for result, filename in bus_files if result["extension"] == "zip"])
+        connection.execute("DELETE FROM datasets")
+        connection.executemany("INSERT INTO datasets VALUES (?, ?)",
+                               [(result["id"], file_order) for file_order, (result, _) in enumerate(ordered_files)])
+        connection.execute("DELETE FROM dataset_localities")
+        connection.executemany("INSERT INTO dataset_localities VALUES (?, ?)",
+                               [(result["id"], place["gazetteer_id"]) for result, _ in bus_files for place in result["localities"]])
+
+        # Find datasets which still need indexing. Files which could not be downloaded are tried again next update
+        new_files = [(result, filename) for result, filename in ordered_files if result["id"] in wanted_datasets
+                     and (result["id"] not in indexed_datasets or indexed_datasets[result["id"]] != wanted_datasets[result["id"]])]
+        for result, filename in new_files:
+            rows, calendars = self.process_dataset(bus_store, filename)
+            connection.executemany("INSERT INTO timetables VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                   [(atco_code, result["id"], row_order, destination_order, line_number, destination,
+                                     times.tobytes(), calendar_ids.tobytes())
+                                    for row_order, (atco_code, line_number, arrival_times) in enumerate(rows)
+                                    for destination_order, (destination, (times, calendar_ids)) in enumerate(arrival_times.items())])
+            connection.executemany("INSERT INTO calendars VALUES (?, ?, ?)",
+                                   [(result["id"], calendar_order, json.dumps(calendar.key))
+                                    for calendar_order, calendar in enumerate(calendars)])
+            connection.execute("INSERT INTO indexed_datasets VALUES (?, ?)", (result["id"], wanted_datasets[result["id"]]))
+
+    # Get the index rows of a dataset in the bus store, and the calendars they refer to
+    def process_dataset(self, bus_store, filename):
+        xml_files = bus_store.get_xml_files(filename)
+        if not filename.endswith(".zip"):
+            return self.process_file(xml_files[0])
+
+        rows = []
+        # Bus lines already added for each stop, so only the first file of each line is used
+        checked_lines = {}
+        # Calendars of every file in the zip file, so rows from different files can share one list
+        calendars = []
+        calendar_ids = {}
+
+        # Go through all xml files of the zip file in reverse order
+        for xml_file in reversed(xml_files):
+            file_rows, file_calendars = self.process_file(xml_file)
+
+            # Positions of the file's calendars in the zip file's list
+            file_calendar_ids = []
+            for calendar in file_calendars:
+                if calendar.key not in calendar_ids:
+                    calendar_ids[calendar.key] = len(calendars)
+                    calendars.append(calendar)
+                file_calendar_ids.append(calendar_ids[calendar.key])
+
+            for atco_code, line_number, arrival_times in file_rows:
+                # Check if data of that bus line was already added for this stop
+                if line_number in checked_lines.setdefault(atco_code, set()):
+                    continue
+                checked_lines[atco_code].add(line_number)
+                rows.append((atco_code, line_number,
+                             {destination: (times, array('I', [file_calendar_ids[calendar] for calendar in times_calendars]))
+                              for destination, (times, times_calendars) in arrival_times.items()}))
+        return rows, calendars
+
+    # Get (ATCO code, line number, arrival times) for every stop served by a bus file, and the calendars they refer to
+    def process_file(self, xml_path):
+        try:
+            # Read the file a bit at a time rather than loading all of it
+            bus_data = StreamProcessData(xml_path, None)
+            arrival_times_by_stop = bus_data.find_arrival_times_for_all_stops()
+            if not arrival_times_by_stop:
+                return [], []
+            line_number = bus_data.get_line_number()
+        except:
+            return [], [] # Skip files that cannot be read
+        return ([(atco_code, line_number, arrival_times) for atco_code, arrival_times in arrival_times_by_stop.items() if arrival_times],
+                bus_data.calendars)
+
+    # Get the timetable of a bus stop, using files operating in any of the given localities,
+    # in the same format as LocateBusFile.get_bus_stop_timetable
+    def get_bus_stop_timetable(self, atco_code, gazetteer_ids):
+        placeholders = ", ".join("?" for _ in gazetteer_ids)
+        connection = sqlite3.connect(self.index_path)
+        try:
+            rows = connection.execute(f"""SELECT timetables.dataset_id, timetables.row_order, timetables.line, timetables.destination,
+                                                 timetables.arrival_seconds, timetables.arrival_calendars
+                                          FROM timetables JOIN datasets ON timetables.dataset_id = datasets.dataset_id
+                                          WHERE timetables.atco_code = ?
+                                          AND timetables.dataset_id IN (SELECT dataset_id FROM dataset_localities WHERE gazetteer_id IN ({placeholders}))
+                                          ORDER BY datasets.file_order, timetables.row_order, timetables.destination_order""", (atco_code, *gazetteer_ids)).fetchall()
+
+            # Calendars of the datasets the rows come from
+            dataset_ids = sorted({row[0] for row in rows})
+            calendars = {dataset_id: [] for dataset_id in dataset_ids}
+            for dataset_id, definition in connection.execute(f"""SELECT dataset_id, definition FROM calendars
+                                                                WHERE dataset_id IN ({", ".join("?" for _ in dataset_ids)})
+                                                                ORDER BY dataset_id, calendar_order""", dataset_ids):
+                operating_profile, operating_period = json.loads(definition)
+                calendars[dataset_id].append(OperatingCalendar(operating_profile, operating_period))
+        finally:
+            connection.close()
+
+        # Rows with the same dataset and row order are the destinations of one bus line
+        timetable = StopTimetable()
+        service = None
+        arrival_times = {}
+        for dataset_id, row_order, line, destination, arrival_seconds, arrival_calendars in rows:
+            if (dataset_id, row_order) != service:
+                if arrival_times:
+                    timetable.add_service(service_line, arrival_times, calendars[service[0]])
+                service = (dataset_id, row_order)
+                service_line = line
+                arrival_times = {}
+            times = array(TIME_TYPECODE)
+            times.frombytes(arrival_seconds)
+            calendar_ids = array('I')
+            calendar_ids.frombytes(arrival_calendars)
+            arrival_times[destination] = (times, calendar_ids)
+        if arrival_times:
+            timetable.add_service(service_line, arrival_times, calendars[service[0]])
+        return timetable
@@ -0,0 +1,165 @@
+from array import array # Enable storing times compactly, without an object for each one
+from bisect import bisect_left
+from datetime import timedelta
+import sys
+
+# Type of the arrays holding times, as whole seconds since midnight
+TIME_TYPECODE = 'i'
+
+# Convert a time such as "07:45:00" to seconds since midnight
+def parse_time_of_day(time_text):
+    hours, minutes, seconds = time_text.split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+# Convert seconds since midnight to a time such as "07:45:00". Times after midnight
+# (from journeys which started the day before) carry on from "00:00:00"
+def format_time_of_day(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours % 24:02d}:{minutes:02d}:{seconds:02d}"
+
+# Number of seconds in a day. Journeys running past midnight have arrival times of this or more
+SECONDS_IN_DAY = 86400
+
+# Timetable of a bus stop, kept as columns of numbers rather than lists of strings
+class StopTimetable:
+    def __init__(self):
+        # Names of bus lines and destinations, each stored once and referred to by position
+        self.lines = []
+        self.destinations = []
+        self.line_ids = {}
+        self.destination_ids = {}
+        # Days the journeys run on, each stored once and referred to by position
+        self.calendars = []
+        self.calendar_ids = {}
+
+        # One entry per service (a bus line from one file), in the order they were added
+        self.service_lines = array('I') # Position of the service's line in lines
+        self.service_starts = array('I') # Position of the service's first arrival
+
+        # One entry per arrival, grouped by service and then by destination
+        self.arrival_destinations = array('I') # Position of the arrival's destination in destinations
+        self.arrival_seconds = array(TIME_TYPECODE) # Arrival time in seconds since midnight
+        self.arrival_calendars = array('I') # Position of the arrival's calendar in calendars
+
+        # Arrivals sorted by time, only worked out when next departures are first asked for
+        self.sorted_seconds = None
+        self.sorted_arrivals = None
+        self.arrival_lines = None
+
+    def __len__(self):
+        return len(self.service_lines)
+
+    def get_line_id(self, line):
+        if line not in self.line_ids:
+            self.line_ids[line] = len(self.lines)
+            self.lines.append(sys.intern(line))
+        return self.line_ids[line]
+
+    def get_destination_id(self, destination):
+        if destination not in self.destination_ids:
+            self.destination_ids[destination] = len(self.destinations)
+            self.destinations.append(sys.intern(destination))
+        return self.destination_ids[destination]
+
+    def get_calendar_id(self, calendar):
+        if calendar.key not in self.calendar_ids:
+            self.calendar_ids[calendar.key] = len(self.calendars)
+            self.calendars.append(calendar)
+        return self.calendar_ids[calendar.key]
+
+    # Add the arrival times of a bus line, given as {destination: (arrival times in seconds, calendar positions)}
+    # along with the list of calendars the positions refer to
+    def add_service(self, line, arrival_times, calendars):
+        self.service_lines.append(self.get_line_id(line))
+        self.service_starts.append(len(self.arrival_seconds))
+        calendar_ids = [self.get_calendar_id(calendar) for calendar in calendars]
+        for destination, (times, times_calendars) in arrival_times.items():
+            destination_id = self.get_destination_id(destination)
+            self.arrival_destinations.extend(array('I', [destination_id]) * len(times))
+            self.arrival_seconds.extend(times)
+            self.arrival_calendars.extend(calendar_ids[calendar] for calendar in times_calendars)
+        self.sorted_seconds = None
+        self.sorted_arrivals = None
+        self.arrival_lines = None
+
+    # Get which calendars run on a day, worked out once per calendar rather than once per arrival
+    def get_running_calendars(self, day):
+        return [calendar.runs_on(day) for calendar in self.calendars]
+
+    # Get (line, [(destination, arrival times in seconds)]) of each service, in the order they were added.
+    # If a day is given, only arrivals of journeys running that day are included, and services with none are left out
+    def get_services(self, day=None):
+        running_calendars = self.get_running_calendars(day) if day is not None else None
+        for service, line_id in enumerate(self.service_lines):
+            start = self.service_starts[service]
+            end = self.service_starts[service + 1] if service + 1 < len(self.service_starts) else len(self.arrival_seconds)
+
+            # Split the service's arrivals where the destination changes
+            destinations = []
+            position = start
+            while position < end:
+                destination_id = self.arrival_destinations[position]
+                run_end = position
+                while run_end < end and self.arrival_destinations[run_end] == destination_id:
+                    run_end += 1
+                times = self.arrival_seconds[position:run_end]
+                if running_calendars is not None:
+                    times = array(TIME_TYPECODE, [seconds for seconds, calendar in zip(times, self.arrival_calendars[position:run_end])
+                                                  if running_calendars[calendar]])
+                if times:
+                    destinations.append((self.destinations[destination_id], times))
+                position = run_end
+            if destinations or running_calendars is None:
+                yield self.lines[line_id], destinations
+
+    # Get the line of every arrival, matching arrival_seconds
+    def get_arrival_lines(self):
+        arrival_lines = array('I')
+        for service, line_id in enumerate(self.service_lines):
+            end = self.service_starts[service + 1] if service + 1 < len(self.service_starts) else len(self.arrival_seconds)
+            arrival_lines.extend(array('I', [line_id]) * (end - self.service_starts[service]))
+        return arrival_lines
+
+    # Get the arrivals from a time onwards on the given running calendars, earliest first, as (seconds, arrival)
+    def get_arrivals_from(self, from_seconds, running_calendars):
+        # Jump straight to the first arrival at or after the time, rather than checking every arrival
+        first = bisect_left(self.sorted_seconds, from_seconds)
+        for position in range(first, len(self.sorted_seconds)):
+            arrival = self.sorted_arrivals[position]
+            if running_calendars is None or running_calendars[self.arrival_calendars[arrival]]:
+                yield self.sorted_seconds[position], arrival
+
+    # Get (arrival time in seconds, line, destination) of the next arrivals at or after a time, earliest first.
+    # If a day is given, only journeys running that day are included, along with journeys from the day before
+    # which run past midnight, whose times are given as seconds since midnight of the day asked for
+    def next_departures(self, after_seconds, limit=10, day=None):
+        if self.sorted_seconds is None:
+            order = sorted(range(len(self.arrival_seconds)), key=self.arrival_seconds.__getitem__)
+            self.sorted_arrivals = array('I', order)
+            self.sorted_seconds = array(TIME_TYPECODE, [self.arrival_seconds[arrival] for arrival in order])
+            self.arrival_lines = self.get_arrival_lines()
+
+        if day is None:
+            arrivals = self.get_arrivals_from(after_seconds, None)
+            previous_day_arrivals = iter(())
+        else:
+            arrivals = self.get_arrivals_from(after_seconds, self.get_running_calendars(day))
+            previous_day_arrivals = self.get_arrivals_from(after_seconds + SECONDS_IN_DAY, self.get_running_calendars(day - timedelta(days=1)))
+
+        # Take the earliest of the two days' arrivals each time until there are enough
+        departures = []
+        next_arrival = next(arrivals, None)
+        next_previous_day_arrival = next(previous_day_arrivals, None)
+        while len(departures) < limit:
+            if next_previous_day_arrival is not None and (next_arrival is None or next_previous_day_arrival[0] - SECONDS_IN_DAY < next_arrival[0]):
+                seconds, arrival = next_previous_day_arrival
+                seconds -= SECONDS_IN_DAY
+                next_previous_day_arrival = next(previous_day_arrivals, None)
+            elif next_arrival is not None:
+                seconds, arrival = next_arrival
+                next_arrival = next(arrivals, None)
+            else:
+                break # No more arrivals
+            departures.append((seconds, self.lines[self.arrival_lines[arrival]], self.destinations[self.arrival_destinations[arrival]]))
+        return departures
@@ -0,0 +1,197 @@
+import asyncio # Enable serving many clients at once from one process
+import json
+import os
+import signal
+from concurrent.futures import ProcessPoolExecutor # Enable running lookups on every core
+from datetime import date, datetime
+from urllib.parse import urlsplit, parse_qs, unquote
+from geocoding import NearbyStops
+from locate_zipfile import LocateBusFile
+from refresh_bus_stops import RefreshBusStops
+from stop_index import load_stop_index
+from timetable_model import format_time_of_day
+from warm_up import warm_up_lookups
+
+# Headless HTTP service answering the same lookups as the app, for displays and web pages:
+#   GET /stops?postcode=GU1 1AA                                     bus stops near a postcode
+#   GET /stops/<ATCO code>/timetable?date=2026-10-19                timetable of a stop, optionally on one day
+#   GET /stops/<ATCO code>/departures?date=2026-10-19&time=08:30&count=10   next buses at a stop
+# Lookups run in worker processes, which keep the bus stop index and timetable caches in memory between requests
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               500: "Internal Server Error", 503: "Service Unavailable"}
+
+# The functions below run in the worker processes, and return (status, JSON body). Lookups already run
+# in parallel across the workers, so each one reads its bus files itself rather than using LOOKUP_WORKERS
+
+# Hash of the bus stop data the worker's index is for. It is noted when the worker starts and whenever a
+# postcode search refreshes the bus stops, rather than reading 400_state.json again for every request
+worker_stops_hash = None
+
+# Load the bus stop index and other lookup data when a worker starts, so the first request does not have to
+def warm_up_worker():
+    global worker_stops_hash
+    warm_up_lookups()
+    worker_stops_hash = RefreshBusStops().stops_hash
+
+def find_nearby_stops(postcode):
+    global worker_stops_hash
+    postcode_info = NearbyStops(postcode)
+    if postcode_info.is_bus_stop_request:
+        worker_stops_hash = postcode_info.stops_hash
+    if not postcode_info.is_postcode_request:
+        return 404, {"error": "Postcode is not found"}
+    if not postcode_info.is_in_Surrey:
+        return 404, {"error": "The postcode is not in Surrey"}
+    if not postcode_info.is_bus_stop_request:
+        return 503, {"error": "Bus stop data could not be loaded"}
+    return 200, {"latitude": postcode_info.postcode_lat, "longitude": postcode_info.postcode_lon,
+                 "stops": postcode_info.find_nearest_bus_stops()}
+
+# Get the details of a bus stop from the bus stop index
+def find_stop(atco_code):
+    if worker_stops_hash is None or not os.path.exists("400.xml"):
+        return None # No bus stop data has been downloaded yet
+    return load_stop_index(worker_stops_hash).find_stop(atco_code)
+
+def find_stop_timetable(atco_code, day):
+    stop_data = find_stop(atco_code)
+    if stop_data is None:
+        return 404, {"error": "Bus stop is not found"}
+    timetable = LocateBusFile(stop_data, max_workers=1).get_bus_stop_timetable()
+    services = []
+    for line, arrival_times in timetable.get_services(day):
+        services.append({"line": line,
+                         "arrival_times": {destination: [format_time_of_day(seconds) for seconds in times]
+                                           for destination, times in arrival_times}})
+    return 200, {"stop": stop_data, "services": services}
+
+def find_next_departures(atco_code, when, limit):
+    stop_data = find_stop(atco_code)
+    if stop_data is None:
+        return 404, {"error": "Bus stop is not found"}
+    departures = LocateBusFile(stop_data, max_workers=1).get_next_departures(when, limit)
+    return 200, {"stop": stop_data,
+                 "departures": [{"time": format_time_of_day(seconds), "line": line, "destination": destination}
+                                for seconds, line, destination in departures]}
+
+class TimetableService:
+    def __init__(self, host=None, port=None, max_workers=None, max_concurrent_requests=None, max_waiting_requests=None, timeout=30):
+        self.host = host if host is not None else os.getenv("TIMETABLE_SERVICE_HOST", "127.0.0.1")
+        self.port = port if port is not None else int(os.getenv("TIMETABLE_SERVICE_PORT", 8080))
+        # Number of worker processes, one per core unless set otherwise
+        self.max_workers = max_workers if max_workers is not None else (os.cpu_count() or 1)
+        # Lookups running at once, and lookups allowed to wait for a turn before new ones are turned away
+        self.max_concurrent_requests = max_concurrent_requests if max_concurrent_requests is not None else self.max_workers * 2
+        self.max_waiting_requests = max_waiting_requests if max_waiting_requests is not None else 100
+        # Seconds allowed for a client to send its request
+        self.timeout = timeout
+
+        self.waiting_requests = 0
+        self.semaphore = None
+        self.process_pool = None
+
+    # Run a lookup in a worker process, as long as too many lookups are not already waiting
+    async def run_lookup(self, function, *args):
+        if self.waiting_requests >= self.max_waiting_requests:
+            return 503, {"error": "Too many requests, please try again"}
+        self.waiting_requests += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting_requests -= 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.process_pool, function, *args)
+        finally:
+            self.semaphore.release()
+
+    # Work out which lookup a request is for, returning (status, JSON body)
+    async def route(self, method, target):
+        url = urlsplit(target)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        path = [unquote(part) for part in url.path.strip("/").split("/") if part]
+
+        if method != "GET":
+            return 405, {"error": "Only GET requests are supported"}
+        if path == ["health"]:
+            return 200, {"status": "ok"}
+
+        # Query values are checked before running a lookup, so a bad value gets a clear message
+        try:
+            day = date.fromisoformat(query["date"]) if "date" in query else None
+        except ValueError:
+            return 400, {"error": "date must be given as YYYY-MM-DD"}
+
+        if path == ["stops"]:
+            if not query.get("postcode"):
+                return 400, {"error": "A postcode is needed"}
+            return await self.run_lookup(find_nearby_stops, query["postcode"])
+
+        if len(path) == 3 and path[0] == "stops" and path[2] == "timetable":
+            return await self.run_lookup(find_stop_timetable, path[1], day)
+
+        if len(path) == 3 and path[0] == "stops" and path[2] == "departures":
+            when = datetime.now()
+            if day is not None:
+                when = datetime.combine(day, when.time())
+            if "time" in query:
+                try:
+                    when = datetime.combine(when.date(), datetime.strptime(query["time"], "%H:%M").time())
+                except ValueError:
+                    return 400, {"error": "time must be given as HH:MM"}
+            count_text = query.get("count", "10")
+            if not count_text.isdecimal() or not 0 < int(count_text) <= 100:
+                return 400, {"error": "count must be a positive integer no more than 100"}
+            return await self.run_lookup(find_next_departures, path[1], when, int(count_text))
+
+        return 404, {"error": "Not found"}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            try:
+                # Read the request line and headers. Requests have no body, so it is not read
+                request_line = await asyncio.wait_for(reader.readline(), self.timeout)
+                while True:
+                    header = await asyncio.wait_for(reader.readline(), self.timeout)
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            except (asyncio.TimeoutError, ValueError, UnicodeDecodeError):
+                status, body = 400, {"error": "Bad request"}
+            else:
+                try:
+                    status, body = await self.route(method, target)
+                except Exception:
+                    status, body = 500, {"error": "An error occurred"}
+
+            content = json.dumps(body).encode()
+            writer.write(f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+                         f"Content-Type: application/json\r\n"
+                         f"Content-Length: {len(content)}\r\n"
+                         f"Connection: close\r\n\r\n".encode("latin-1") + content)
+            await writer.drain()
+        except ConnectionError:
+            pass # Client went away
+        finally:
+            writer.close()
+
+    async def serve(self):
+        self.semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        self.process_pool = ProcessPoolExecutor(max_workers=self.max_workers, initializer=warm_up_worker)
+        try:
+            server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+            print(f"Serving timetables on http://{self.host}:{self.port}", flush=True)
+
+            # Stop serving when asked to, e.g. by a service manager, so the worker processes are shut down too
+            stop_event = asyncio.Event()
+            try:
+                asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_event.set)
+            except NotImplementedError:
+                pass # Signals cannot be handled this way on Windows
+            async with server:
+                await stop_event.wait()
+        finally:
+            self.process_pool.shutdown(cancel_futures=True)
+
+if __name__ == "__main__":
+    asyncio.run(TimetableService().serve())
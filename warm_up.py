@@ -0,0 +1,17 @@
+import os
+from refresh_bus_stops import RefreshBusStops
+from stop_index import load_stop_index
+from postcode_cache import load_offline_postcodes
+from bus_store import load_bus_store
+# Imported here so requests, lxml and isodate are loaded before the first search needs them
+import geocoding
+import locate_zipfile
+
+# Load the indexes used by lookups from the copies saved by earlier runs, so the first search and
+# timetable do not have to. Run in the background when the app starts
+def warm_up_lookups():
+    # The hash noted down when 400.xml was downloaded is used, so the file is not read to work it out
+    if os.path.exists("400.xml"):
+        load_stop_index(RefreshBusStops().stops_hash)
+    load_offline_postcodes()
+    load_bus_store()